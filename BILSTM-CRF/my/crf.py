@@ -0,0 +1,50 @@
+"""Batched Viterbi decoding for the linear-chain CRF, outside the TF graph."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def viterbi_decode(score, transition_params, sequence_length):
+  """Decodes the highest scoring tag sequence of every sentence in a batch.
+
+  Matches tf.contrib.crf.crf_decode, but runs in numpy over any number of
+  sentences at once: the loop is over time steps only.
+
+  Args:
+    score: [batch_size, max_seq_len, num_tags] emission scores.
+    transition_params: [num_tags, num_tags] transition matrix, as learned by
+      tf.contrib.crf.crf_log_likelihood.
+    sequence_length: [batch_size] valid length of each sentence.
+
+  Returns:
+    tags: [batch_size, max_seq_len] int32, 0 beyond each length.
+    best_score: [batch_size] score of the returned sequences.
+  """
+  score = np.asarray(score, dtype=np.float32)
+  transition_params = np.asarray(transition_params, dtype=np.float32)
+  batch_size, max_seq_len, num_tags = score.shape
+  sequence_length = np.clip(
+      np.asarray(sequence_length, dtype=np.int32).reshape(-1), 1, max_seq_len)
+  rows = np.arange(batch_size)
+
+  alpha = score[:, 0, :]
+  backpointers = np.zeros((batch_size, max_seq_len, num_tags), dtype=np.int32)
+  for t in range(1, max_seq_len):
+    # [batch, previous tag, current tag]
+    candidates = alpha[:, :, None] + transition_params[None, :, :]
+    backpointers[:, t] = np.argmax(candidates, axis=1)
+    active = (t < sequence_length)[:, None]
+    alpha = np.where(active, np.max(candidates, axis=1) + score[:, t], alpha)
+
+  last = np.argmax(alpha, axis=1).astype(np.int32)
+  best_score = alpha[rows, last]
+  tags = np.zeros((batch_size, max_seq_len), dtype=np.int32)
+  tags[rows, sequence_length - 1] = last
+  current = last
+  for t in range(max_seq_len - 1, 0, -1):
+    active = t < sequence_length
+    current = np.where(active, backpointers[rows, t, current], current)
+    tags[active, t - 1] = current[active]
+  return tags, best_score
@@ -0,0 +1,153 @@
+"""Time and memory high-water marks of the data layer stages, opt in.
+
+The readers, producers and reports wrap their stages in stage() or timed().
+Both do nothing until a trainer sets `watch` to a MemWatch, so the stages
+cost nothing in ordinary runs.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import functools
+import resource
+import threading
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# the MemWatch recording the stages, None leaves them untimed
+watch = None
+
+_MB = 1024.0 * 1024.0
+
+
+def _rss():
+  """Resident set size in bytes, None where /proc is missing."""
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except (IOError, OSError):
+    return None
+
+
+def _max_rss():
+  """High-water mark of the resident set in bytes, ru_maxrss is in KB on Linux."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemWatch(object):
+  """Per-stage wall time, traced allocation peaks and RSS watermarks.
+
+  With trace, tracemalloc follows every Python and numpy allocation and a
+  stage's peak is the most memory it held above what was allocated when it
+  started, nested stages included. Tracing slows allocations down, without
+  it only time and RSS are kept. "hwm" is how much the stage raised the
+  process's RSS high-water mark, the number to look at after an OOM kill:
+  the stage with the largest one set the peak. Stages on other threads,
+  such as the background evaluation, share the process-wide peak.
+  """
+
+  def __init__(self, trace=True):
+    self._trace = trace and tracemalloc is not None and hasattr(tracemalloc, "reset_peak")
+    if self._trace and not tracemalloc.is_tracing():
+      tracemalloc.start()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._stats = collections.OrderedDict()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    stack = self._local.__dict__.setdefault("stack", [])
+    rss, max_rss = _rss(), _max_rss()
+    if self._trace:
+      current, peak = tracemalloc.get_traced_memory()
+      if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+      tracemalloc.reset_peak()
+      stack.append([current, 0])
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      seconds = time.time() - start_time
+      traced_peak = traced_net = None
+      if self._trace:
+        current, peak = tracemalloc.get_traced_memory()
+        start, inner_peak = stack.pop()
+        peak = max(peak, inner_peak)
+        traced_peak, traced_net = peak - start, current - start
+        if stack:
+          stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+      rss_after = _rss()
+      self._add(name, seconds, traced_peak, traced_net,
+                None if rss is None or rss_after is None else rss_after - rss,
+                _max_rss() - max_rss, rss_after)
+
+  def _add(self, name, seconds, traced_peak, traced_net, rss_delta, hwm, rss):
+    with self._lock:
+      stats = self._stats.setdefault(name, collections.defaultdict(float))
+      stats["calls"] += 1
+      stats["seconds"] += seconds
+      stats["max_seconds"] = max(stats["max_seconds"], seconds)
+      if traced_peak is not None:
+        stats["peak"] = max(stats["peak"], traced_peak)
+        stats["net"] += traced_net
+      if rss_delta is not None:
+        stats["rss_delta"] += rss_delta
+        stats["rss"] = rss
+      stats["hwm"] += hwm
+
+  def table(self, title=""):
+    """The stages in the order they first finished, sizes in MB."""
+    lines = ["Data layer stages %s, RSS high-water mark %.1f MB" % (title, _max_rss() / _MB),
+             "%-34s %6s %9s %9s %9s %9s %9s %9s %9s" % (
+                 "stage", "calls", "total s", "max s", "peak", "net", "rss +/-",
+                 "hwm +", "rss")]
+    with self._lock:
+      for name, stats in self._stats.items():
+        lines.append("%-34s %6d %9.3f %9.3f %9s %9s %9.1f %9.1f %9.1f" % (
+            name, stats["calls"], stats["seconds"], stats["max_seconds"],
+            "%.1f" % (stats["peak"] / _MB) if self._trace else "-",
+            "%.1f" % (stats["net"] / _MB) if self._trace else "-",
+            stats["rss_delta"] / _MB, stats["hwm"] / _MB, stats["rss"] / _MB))
+    return "\n".join(lines) + "\n"
+
+  def report(self, title=""):
+    """table() of the stages since the last report, then starts over."""
+    table = self.table(title)
+    with self._lock:
+      self._stats.clear()
+    return table
+
+
+def stage(name):
+  """Context manager timing the enclosed block as stage name, if watched."""
+  if watch is None:
+    return _unwatched()
+  return watch.stage(name)
+
+
+@contextlib.contextmanager
+def _unwatched():
+  yield
+
+
+def timed(name=None):
+  """Decorator timing every call of a function as a stage."""
+  def decorator(fn):
+    label = name or fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if watch is None:
+        return fn(*args, **kwargs)
+      with watch.stage(label):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
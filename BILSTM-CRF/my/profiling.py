@@ -0,0 +1,91 @@
+"""Chrome-trace timelines and per-op times of sampled session.run calls."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+def parse_steps(spec):
+  """Step numbers from "100,200" or ranges like "100-104"."""
+  steps = set()
+  for part in spec.split(","):
+    part = part.strip()
+    if not part:
+      continue
+    if "-" in part:
+      first, last = part.split("-")
+      steps.update(range(int(first), int(last) + 1))
+    else:
+      steps.add(int(part))
+  return steps
+
+
+class StepProfiler(object):
+  """Traces the chosen steps of every kind of run_epoch pass.
+
+  Steps are counted per name ("train", "eval") over the whole run. A traced
+  step runs with FULL_TRACE and writes timeline_<name>_<step>.json, which
+  chrome://tracing opens, and op_times_<name>.txt, with the time per op
+  summed over the steps traced so far. Steps that are not traced run with
+  no options at all.
+  """
+
+  def __init__(self, steps, out_dir):
+    self._steps = steps
+    self._out_dir = out_dir
+    self._counts = collections.defaultdict(int)
+    self._traced = collections.defaultdict(int)
+    self._op_micros = collections.defaultdict(lambda: collections.defaultdict(int))
+    self._op_calls = collections.defaultdict(lambda: collections.defaultdict(int))
+    if not os.path.exists(out_dir):
+      os.makedirs(out_dir)
+
+  def options(self, name):
+    """(run_options, run_metadata) for the next step of name, or (None, None)."""
+    step = self._counts[name]
+    self._counts[name] += 1
+    if step not in self._steps:
+      return None, None
+    return (tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            tf.RunMetadata())
+
+  def collect(self, name, run_metadata):
+    """Writes the timeline of the step just traced and updates the op table."""
+    step = self._counts[name] - 1
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(os.path.join(self._out_dir, "timeline_%s_%d.json" % (name, step)), "w") as f:
+      f.write(trace.generate_chrome_trace_format())
+    for dev_stats in run_metadata.step_stats.dev_stats:
+      for node in dev_stats.node_stats:
+        label = node.timeline_label
+        op = label.split(" = ")[1].split("(")[0] if " = " in label else node.node_name
+        key = (dev_stats.device, node.node_name, op)
+        self._op_micros[name][key] += node.all_end_rel_micros
+        self._op_calls[name][key] += 1
+    self._traced[name] += 1
+    table = self.table(name)
+    with open(os.path.join(self._out_dir, "op_times_%s.txt" % name), "w") as f:
+      f.write(table)
+    if self._traced[name] == len(self._steps):
+      print(table)
+
+  def table(self, name, top=None):
+    """Ops of name by total time over the traced steps, longest first."""
+    micros = self._op_micros[name]
+    total = float(sum(micros.values())) or 1.0
+    lines = ["%d traced %s steps, %.1f ms of op time per step" % (
+        self._traced[name], name, total / 1000.0 / max(self._traced[name], 1)),
+             "%9s %7s %6s  %-22s %-24s %s" % (
+                 "total ms", "share", "calls", "op", "device", "node")]
+    ranked = sorted(micros.items(), key=lambda item: item[1], reverse=True)
+    for (device, node, op), value in ranked[:top]:
+      lines.append("%9.2f %6.1f%% %6d  %-22s %-24s %s" % (
+          value / 1000.0, 100.0 * value / total,
+          self._op_calls[name][(device, node, op)], op,
+          device.split("/")[-1] if device else "-", node))
+    return "\n".join(lines) + "\n"
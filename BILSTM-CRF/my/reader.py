@@ -1,17 +1,26 @@
 import collections
 import os
 import sys
+import time
 from copy import deepcopy
 import tensorflow as tf
 import numpy as np
-from random import randint
-from sklearn.model_selection import train_test_split
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from random import Random
 from numpy import *
+from my import memwatch
 
 Py3 = sys.version_info[0] == 3
 length = 0
 sequence_length = []
 word_to_id = {}
+# name prefix of a corpus published by my/shared_corpus.py, None reads files
+shm_prefix = None
+# my/shard_cache.ShardCache kept across outer epochs, None reloads every time
+shard_cache = None
+# my/instrument.StepInstrument recording shard load and corruption times
+timings = None
 similar = eval(open("./similarList.txt").read())
 
 def _read_words(filename):
@@ -50,6 +59,216 @@ def _file_to_word_ids(filename):
   return [word_to_id[word] for word in data if word in word_to_id]
 
 
+# bytes of shard text scanned at a time when counting row widths
+WIDTH_CHUNK = 1 << 24
+# ids moved at a time when dropping rows of the wrong width
+MOVE_IDS = 1 << 20
+
+def _row_widths(text):
+  """Number of ids on every line of text, blank lines at either end skipped."""
+  b = frombuffer(text, dtype = uint8)
+  start, end = 0, len(b)
+  while start < end and b[start] <= 32:
+    start += 1
+  while end > start and b[end-1] <= 32:
+    end -= 1
+  widths = []
+  while start < end:
+    stop = end
+    if start + WIDTH_CHUNK < end:
+      stop = start + WIDTH_CHUNK
+      # whole lines only
+      cut = text.rfind(b"\n", start, stop) + 1
+      stop = cut if cut > start else (text.find(b"\n", stop, end) + 1 or end)
+    part = b[start:stop]
+    space = part <= 32
+    first = ~space
+    first[1:] &= space[:-1]
+    line_ends = flatnonzero(part == 10)
+    if stop == end:
+      line_ends = append(line_ends, len(part))
+    widths.append(diff(searchsorted(flatnonzero(first), line_ends), prepend = 0))
+    start = stop
+  return concatenate(widths) if widths else zeros(0, dtype = int64)
+
+def _parse_rows(train_path, num_steps = 47):
+  """(ids, keep) of a shard file: the ids of its num_steps wide lines, flat.
+
+  The text is parsed once into a single int32 buffer. keep marks the lines
+  that are num_steps wide; the others are squeezed out of the buffer in
+  place, so the rows are never split into lists or copied as a whole.
+  """
+  with open(train_path, "rb") as f:
+    text = f.read()
+  data = np.fromstring(text, dtype = int32, sep = " ")
+  widths = _row_widths(text)
+  del text
+  keep = widths == num_steps
+  if keep.all():
+    return data, keep
+  with memwatch.stage("read_shard/filter_rows"):
+    offsets = concatenate([[0], cumsum(widths)])
+    edges = flatnonzero(diff(concatenate([[0], keep.astype(int8), [0]])))
+    dst = 0
+    for first, last in zip(edges[0::2], edges[1::2]):
+      src, size = offsets[first], offsets[last] - offsets[first]
+      # front to back, a block is written no further than it was read
+      for done in range(0, size, MOVE_IDS):
+        block = MOVE_IDS if size - done > MOVE_IDS else size - done
+        data[dst+done:dst+done+block] = data[src+done:src+done+block]
+      dst += size
+    return data[:dst], keep
+
+# share of every shard held out for the dev loss
+DEV_FRACTION = 0.02
+# picks, with the shard index, which rows are held out
+dev_seed = 0
+
+def _dev_rows(rows):
+  return int(ceil(rows * DEV_FRACTION))
+
+def _dev_to_tail(data, sequence_length, index, num_steps = 47):
+  """Swaps the dev rows of shard index to the end of its buffer, in place.
+
+  The rows held out depend only on dev_seed and the shard index, so a shard
+  has the same dev set on every visit, whether it is read, cached or
+  shared. ptb_raw_data then takes train and dev as views of the buffer.
+  """
+  rows = len(sequence_length)
+  dev = _dev_rows(rows)
+  chosen = np.random.RandomState([dev_seed, index]).choice(rows, dev, replace = False)
+  head = chosen[chosen < rows - dev]
+  tail = setdiff1d(arange(rows - dev, rows), chosen)
+  X = data.reshape(-1, num_steps)
+  moved, moved_length = X[head], sequence_length[head]
+  X[head], sequence_length[head] = X[tail], sequence_length[tail]
+  X[tail], sequence_length[tail] = moved, moved_length
+
+
+@memwatch.timed("load_shard")
+def _load_shard(data_path, index):
+  """Decoded (train_data, sequence_length) of one shard, rows not 47 wide dropped."""
+  if shm_prefix:
+    # multiprocessing.shared_memory needs Python 3.8, import it only when asked
+    from my import shared_corpus
+    shard = shared_corpus.attach(shm_prefix, index)
+    if shard is not None:
+      print("Attached shared shard %d"%index)
+      return shard
+  if shard_cache is not None:
+    shard = shard_cache.get(index, lambda: _read_shard(data_path, index))
+    print(shard_cache)
+    return shard
+  return _read_shard(data_path, index)
+
+
+@memwatch.timed("read_shard")
+def _read_shard(data_path, index):
+  shard = index
+  if(index<10):
+    index = "0"+str(index)
+  train_path = os.path.join(data_path, "conv.txt")
+
+  #train_path = os.path.join(data_path, "corpus_cha.txt")
+  #train_path = os.path.join(data_path, "pro_cha.txt")
+  train_path = os.path.join(data_path, "corpus/total_"+str(index))
+  with memwatch.stage("read_shard/parse"):
+    train_data, keep = _parse_rows(train_path)
+  
+  #word_to_id = _build_vocab(train_path)
+  #f = open("./cha_to_id.txt","w")
+  #f.write(str(word_to_id))
+  #f.close()
+  data_path = os.path.join(data_path,"length/length_"+str(index))
+  #data_path = os.path.join(data_path,"conv_length.txt")
+  #data_path = os.path.join(data_path,"corpus_cha_length.txt")
+  #data_path = os.path.join(data_path,"pro_cha_length.txt")
+  sequence_length = open(data_path).read().strip().split()
+  if len(sequence_length)<=1:
+    sequence_length =  open(data_path).read().strip().split("\n")
+  sequence_length = array(sequence_length, dtype = int32)
+  print(shape(sequence_length))
+  print("length before filter: %d"%shape(sequence_length)[0])
+  if len(keep) != len(sequence_length):
+    raise ValueError("%s has %d lines but %s has %d lengths" % (train_path, len(keep), data_path, len(sequence_length)))
+  if not keep.all():
+    print("length deleted index: %d"%(len(keep) - count_nonzero(keep)))
+    sequence_length = sequence_length[keep]
+    
+  print("length after filter: %d"%shape(sequence_length)[0])
+  _dev_to_tail(train_data, sequence_length, shard)
+  return train_data, sequence_length
+
+
+# test lines encoded at a time
+ENCODE_LINES = 1 << 16
+# str.split() whitespace, by code point; none lies above U+3000
+_SPACE = array([chr(c).isspace() for c in range(0x3001)])
+# (sentence, position) of every test character not in cha_to_id.txt
+oov_positions = None
+
+def unknown_id():
+  """Id of the words not in cha_to_id.txt, one past the pad id.
+
+  It has no row of its own: util.embed_ids reads it as a zero vector.
+  """
+  return len(word_to_id) + 1
+
+def encode_lines(lines, num_steps = 47):
+  """(ids [sentences, num_steps], sequence_length, oov) of test lines.
+
+  Lines longer than num_steps are skipped. Lines are split into words on
+  arrays of code points and single character words are looked up in a
+  table indexed by code point, so no per-word strings are made; the rare
+  longer words go through word_to_id. Ids are written straight into one
+  preallocated array, right padded with len(word_to_id). Words missing
+  from word_to_id get unknown_id() instead of raising KeyError, so the pad
+  id only ever follows the end of a sentence, and oov lists their
+  (sentence, position) pairs.
+  """
+  pad = len(word_to_id)
+  table = full(0x110000, -1, dtype = int32)
+  for word, i in word_to_id.items():
+    if len(word) == 1:
+      table[ord(word)] = i
+  data = full((len(lines), num_steps), pad, dtype = int32)
+  sequence_length = zeros(len(lines), dtype = int32)
+  oov = []
+  rows = 0
+  for chunk in range(0, len(lines), ENCODE_LINES):
+    text = "\n".join(lines[chunk:chunk+ENCODE_LINES])
+    points = frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype = uint32)
+    space = ones(len(points), dtype = bool_)
+    low = points <= 0x3000
+    space[low] = _SPACE[points[low]]
+    space[~low] = False
+    starts = ~space
+    starts[1:] &= space[:-1]
+    ends = ~space
+    ends[:-1] &= space[1:]
+    starts, ends = flatnonzero(starts), flatnonzero(ends) + 1
+    line_ends = append(flatnonzero(points == 10), len(points))
+    widths = diff(searchsorted(starts, line_ends), prepend = 0)
+    ids = table[points[starts]]
+    for k in flatnonzero(ends - starts > 1):
+      ids[k] = word_to_id.get(text[starts[k]:ends[k]], -1)
+    keep = widths <= num_steps
+    if not keep.all():
+      ids = ids[repeat(keep, widths)]
+      widths = widths[keep]
+    mask = arange(num_steps) < widths[:, None]
+    missing = ids < 0
+    if missing.any():
+      ids[missing] = unknown_id()
+      sentence, position = nonzero(mask)
+      oov.append(stack([sentence[missing] + rows, position[missing]], axis = 1))
+    data[rows:rows+len(widths)][mask] = ids
+    sequence_length[rows:rows+len(widths)] = widths
+    rows += len(widths)
+  oov = concatenate(oov) if oov else zeros((0, 2), dtype = int64)
+  return data[:rows], sequence_length[:rows], oov
+
+
 def ptb_raw_data(data_path=None, is_training = True, index=0):
 
   #valid_path = os.path.join(data_path, "ptb.valid.txt")
@@ -90,140 +309,159 @@ def ptb_raw_data(data_path=None, is_training = True, index=0):
   global word_to_id
   word_to_id = eval(open("./cha_to_id.txt").read())
   if is_training == True:
-    if(index<10):
-      index = "0"+str(index)
-    train_path = os.path.join(data_path, "conv.txt")
-
-    #train_path = os.path.join(data_path, "corpus_cha.txt")
-    #train_path = os.path.join(data_path, "pro_cha.txt")
-    train_path = os.path.join(data_path, "corpus/total_"+str(index))
-    train_data = array(open(train_path).read().strip().replace("\n"," ").split(),dtype=int32)
-    
-    #word_to_id = _build_vocab(train_path)
-    #f = open("./cha_to_id.txt","w")
-    #f.write(str(word_to_id))
-    #f.close()
-    data_path = os.path.join(data_path,"length/length_"+str(index))
-    #data_path = os.path.join(data_path,"conv_length.txt")
-    #data_path = os.path.join(data_path,"corpus_cha_length.txt")
-    #data_path = os.path.join(data_path,"pro_cha_length.txt")
-    sequence_length = open(data_path).read().strip().split()
-    if len(sequence_length)<=1:
-      sequence_length =  open(data_path).read().strip().split("\n")
-    sequence_length = array(sequence_length, dtype = int32)
-    print(shape(sequence_length))
-    print("length before filter: %d"%shape(sequence_length)[0])
-    if len(train_data)%47 != 0:
-      train_data = array([i.split() for i in open(train_path).read().strip().split("\n")])
-      tem_index = []
-      for i in range(len(train_data)):
-        if len(train_data[i]) != 47:
-          tem_index.append(i)
-      print("length deleted index: %d"%(len(tem_index)))
-      train_data = delete(train_data, tem_index)
-      train_data = array(concatenate(train_data),dtype=int32)
-      sequence_length = delete(sequence_length, tem_index)
-      
-    print("length after filter: %d"%shape(sequence_length)[0])
+    start_time = time.time()
+    train_data, sequence_length = _load_shard(data_path, index)
+    if timings is not None:
+      timings.event("shard_load", index, time.time() - start_time)
 
   else:
     #test_path = os.path.join(data_path, "")
     #test_path = os.path.join(data_path, "test_normal.txt")
-    global length
-    sequence_length = []
-    test_data = open(data_path).read().strip().split("\n")
-    length = len(test_data)
-    train_data = ""
-    for line in test_data:
-      line = line.split()
-      temlen = len(line)
-      if temlen>47:
-        continue
-      tems = ""
-      sequence_length.append(temlen)
-      for word in line:
-        tems += str(word_to_id[word])+" "
-      tems += "9173 "*(47-temlen)
-      train_data += tems
-    train_data = array(train_data.strip().split(),dtype=int32)
-    sequence_length = array(sequence_length, dtype=int32)
+    global length, oov_positions
+    with memwatch.stage("ptb_raw_data/test_encode"):
+      test_data = open(data_path).read().strip().split("\n")
+      length = len(test_data)
+      train_data, sequence_length, oov_positions = encode_lines(test_data)
+      train_data = train_data.reshape(-1)
+      if len(oov_positions):
+        print("%d test characters not in cha_to_id.txt, encoded as %d" % (len(oov_positions), unknown_id()))
 
   print("Getting Data Finish")
   if is_training == False:
     return train_data, sequence_length
 
   else:
-    train_data = train_data.reshape(-1,47)
-    trainx, devx, trainlength, devlength = train_test_split(train_data, sequence_length, shuffle = True, test_size = 0.02)
-    return reshape(array(trainx),[-1]), trainlength, reshape(array(devx),[-1]), devlength
+    # _read_shard moved the dev rows to the end
+    rows = len(sequence_length) - _dev_rows(len(sequence_length))
+    return train_data[:rows*47], sequence_length[:rows], train_data[rows*47:], sequence_length[rows:]
 
 
-def ptb_producer(raw_data,sequence_length, batch_size, num_steps, name=None, is_training = True, test_path = None):
-  if is_training == True:
-    raw_data = reshape(array(raw_data,dtype = int32),[-1, num_steps])
-    X = []
-    y = []
+# rows corrupted from one seed; corruption does not depend on how rows are split
+CHUNK_ROWS = 4096
+
+def epoch_seed(seed, total_epoch, index, stream = 0):
+  """Seed of one shard visit, stream 0 for its train rows and 1 for its dev rows."""
+  return ((seed * 1000 + total_epoch) * 1000 + index) * 2 + stream
+
+def _corrupt_line(xline, yline, linelength, rng):
+  if linelength < 3:
+    return
+  randmod = rng.randint(0,8)
+  if randmod<=2:
+    return
+  chosen = []
+  for _ in range(1 if randmod<=6 else 2):
+    randnum = rng.randint(1,linelength-2)
+    co = 0
+    while ( (xline[randnum] not in similar) or (len(similar[xline[randnum]])<2) or (randnum in chosen) ) and co<20:
+      randnum = rng.randint(1,linelength-2)
+      co += 1
+    if co<20:
+      chosen.append(randnum)
+      yline[randnum] = [1,0]
+      xline[randnum] = similar[xline[randnum]][rng.randint(0,len(similar[xline[randnum]])-1)]
+
+@memwatch.timed()
+def corrupt(raw_data, sequence_length, num_steps, seed = None, first_row = 0):
+  """Replaces zero, one or two characters of every row by similar ones.
+
+  Returns the ids [rows*num_steps, 1] and one-hot labels [rows*num_steps, 2],
+  [1,0] marking a replaced character. raw_data is copied, never modified.
+  Rows of each CHUNK_ROWS block, counted from first_row, draw from their own
+  seed, so a seed gives the same corruption however the rows are split up.
+  seed None draws a fresh corruption every call.
+  """
+  X = array(raw_data, dtype = int32).reshape(-1, num_steps)
+  y = zeros((shape(X)[0], num_steps, 2), dtype = int32)
+  y[:, :, 1] = 1
+  for line in range(shape(X)[0]):
+    if line == 0 or (first_row + line) % CHUNK_ROWS == 0:
+      chunk = (first_row + line) // CHUNK_ROWS
+      rng = Random(None if seed is None else seed * 1000003 + chunk)
+    _corrupt_line(X[line], y[line], sequence_length[line], rng)
+  return X.reshape(-1,1), y.reshape(-1,2)
+
+class CorruptionPool(object):
+  """Corrupts upcoming training shards in worker processes.
+
+  Create it before any session is opened, the workers are forked. While one
+  shard trains, the next one is loaded by a thread of the pool and its rows
+  are corrupted by the workers, CHUNK_ROWS at a time, so the training thread
+  only waits for what is not done when it needs the shard. Keys are
+  (total_epoch, train_round) positions, asked for in ascending order.
+  """
+
+  def __init__(self, processes):
+    self._pool = multiprocessing.Pool(processes)
+    # one loader at a time, the shard cache and reader globals are not shared
+    self._loader = ThreadPool(1)
+    self._pending = {}
+
+  def _start(self, load, num_steps, seed):
+    shard = load()
+    raw_data = reshape(shard[0], [-1, num_steps])
+    jobs = [self._pool.apply_async(corrupt, (raw_data[row:row + CHUNK_ROWS], shard[1][row:row + CHUNK_ROWS], num_steps, seed, row))
+            for row in range(0, shape(raw_data)[0], CHUNK_ROWS)]
+    return shard, jobs
+
+  def prefetch(self, key, load, num_steps, seed):
+    """Starts calling load() for the shard tuple of key and corrupting its rows."""
+    if key in self._pending:
+      return
+    self._pending[key] = self._loader.apply_async(self._start, (load, num_steps, seed))
+
+  def get(self, key, load, num_steps, seed):
+    """Returns (shard, (X, y)) for key, prefetching it now if needed."""
+    # earlier positions were skipped, by resume or the shard sampling
+    for stale in [k for k in self._pending if k < key]:
+      del self._pending[stale]
+    self.prefetch(key, load, num_steps, seed)
+    with memwatch.stage("corruption_pool/get"):
+      start_time = time.time()
+      shard, jobs = self._pending.pop(key).get()
+      parts = [job.get() for job in jobs]
+      if timings is not None:
+        # only the part not hidden behind training
+        timings.event("corruption", key[1], time.time() - start_time)
+      corrupted = concatenate([X for X, _ in parts]), concatenate([y for _, y in parts])
+    return shard, corrupted
+
+  def close(self):
+    self._loader.terminate()
+    self._pool.terminate()
+
+def training_labels(raw_data, sequence_length, num_steps, name=None, corrupted = None, seed = None):
+  """(X, y) of training rows: corrupted here unless corrupted is given."""
+  if corrupted is None:
     print("Creating Sequences...")
-    print(shape(raw_data)[0])
-    for i in range(1):
-      for line in range(shape(raw_data)[0]):
-        linelength = sequence_length[line]
-        xline = raw_data[line]
-        yline = [[0,1] for i in range(num_steps)]
-
-        randmod = randint(0,8)
-        if randmod<=2:
-          pass 
-        elif randmod<=6:
-          randnum = randint(1,linelength-2)
-          co = 0
-          while ( (xline[randnum] not in similar)  or (len(similar[xline[randnum]])<2)) and co<20:
-            randnum = randint(1,linelength-2)
-            co += 1
-          if co<20:
-            yline[randnum] = [1,0]
-            xline[randnum] = similar[xline[randnum]][randint(0,len(similar[xline[randnum]])-1)] 
-        else:
-          rand1 = randint(1, linelength-2)
-          rand2 = randint(1, linelength-2)
-
-          co = 0
-          while ( (xline[rand1] not in similar) or (len(similar[xline[rand1]])<2) ) and co<20:
-            rand1 = randint(1,linelength-2)
-            co += 1
-          if co < 20:
-            yline[rand1] = [1,0]
-            xline[rand1] = similar[xline[rand1]][randint(0,len(similar[xline[rand1]])-1)] 
-
-          co = 0
-          while ( (xline[rand2] not in similar) or (rand2 == rand1) or (len(similar[xline[rand2]])<2) ) and co<20:
-            rand2 = randint(1,linelength-2)
-            co += 1
-          if co < 20:
-            yline[rand2] = [1,0]
-            xline[rand2] = similar[xline[rand2]][randint(0,len(similar[xline[rand2]])-1)] 
-        X.append(xline)
-        y.append(yline)
-
-    print("sequences length:%d"%len(y))
-    X = array(X).reshape(-1,1)
-    y = array(y).reshape(-1,2)
-    
-    print(shape(X))  
-    print(shape(y))  
+    start_time = time.time()
+    corrupted = corrupt(raw_data, sequence_length, num_steps, seed)
+    if timings is not None:
+      timings.event("corruption", name, time.time() - start_time)
+  X, y = corrupted
+  return X, y
+
+@memwatch.timed()
+def ptb_producer(raw_data,sequence_length, batch_size, num_steps, name=None, is_training = True, test_path = None, corrupted = None, seed = None):
+  if is_training == True:
+    X, y = training_labels(raw_data, sequence_length, num_steps, name, corrupted, seed)
+    print("sequences length:%d"%(shape(y)[0]//num_steps))
+    print(shape(X))
+    print(shape(y))
 
   else:
-    X = array(raw_data).reshape(-1,1)
-    f = open(test_path+"_ans","r").read().strip().split("\n")
-    y = [[[0,1] for _ in range(47)] for i in range(shape(X)[0]//47) ]
-    for line in range(len(f)):
-      fline = f[line].split()
-      if fline[0]=="-1":
-        continue
-      else:
-        for i in fline:
-          y[line][int(i)] = [1,0]
-    y = reshape(y,[-1,2])
+    with memwatch.stage("ptb_producer/test_labels"):
+      X = array(raw_data).reshape(-1,1)
+      f = open(test_path+"_ans","r").read().strip().split("\n")
+      y = [[[0,1] for _ in range(47)] for i in range(shape(X)[0]//47) ]
+      for line in range(len(f)):
+        fline = f[line].split()
+        if fline[0]=="-1":
+          continue
+        else:
+          for i in fline:
+            y[line][int(i)] = [1,0]
+      y = reshape(y,[-1,2])
     print(shape(X))
 
 
@@ -231,9 +469,10 @@ def ptb_producer(raw_data,sequence_length, batch_size, num_steps, name=None, is_
   with tf.name_scope(name, "PTBProducer", [X,y, batch_size, num_steps]):
     print(shape(X))
     print(shape(y))
-    x = tf.convert_to_tensor(X, name="x", dtype=tf.int32)
-    y = tf.convert_to_tensor(y, name="y", dtype=tf.int32)
-    sequence_length = tf.convert_to_tensor(sequence_length, name="sequence_length", dtype=tf.int32)
+    with memwatch.stage("ptb_producer/to_tensors"):
+      x = tf.convert_to_tensor(X, name="x", dtype=tf.int32)
+      y = tf.convert_to_tensor(y, name="y", dtype=tf.int32)
+      sequence_length = tf.convert_to_tensor(sequence_length, name="sequence_length", dtype=tf.int32)
     
     data_len = tf.size(x)
     batch_len = data_len // batch_size
@@ -248,7 +487,9 @@ def ptb_producer(raw_data,sequence_length, batch_size, num_steps, name=None, is_
     with tf.control_dependencies([assertion]):
       epoch_size = tf.identity(epoch_size, name="epoch_size")
 
-    i = tf.train.range_input_producer(epoch_size, shuffle=True).dequeue()
+    # the test pass goes in file order, predict_result.genPredict matches
+    # its rows to the lines of the test file by counting
+    i = tf.train.range_input_producer(epoch_size, shuffle=is_training).dequeue()
     x = tf.strided_slice(x, [0, i * num_steps],[batch_size, (i + 1) * num_steps])
     x.set_shape([batch_size, num_steps])
 
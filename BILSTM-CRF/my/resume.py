@@ -0,0 +1,74 @@
+"""Loop position of a training run, kept next to its checkpoints.
+
+On restart the Supervisor restores the weights but not how far the shard
+loops had got. save() runs right after each checkpoint and records the
+(total_epoch, train_round, epoch) position just finished, the checkpoint
+written for it, the learning rate, the Python and numpy RNG states and the
+state of my/dev_monitor.py, when the trainer has one.
+On restart, load() reads them back, restore() goes back to that checkpoint
+and those RNG states, and done() tells the loops which positions to skip.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import pickle
+import random
+
+import numpy as np
+import tensorflow as tf
+
+STATE_FILE = "train_state.pkl"
+
+
+def save(save_path, position, checkpoint, learning_rate, monitor=None):
+  """Records position as finished, with the checkpoint just written for it.
+
+  monitor is a DevMonitor.state(), read back by the trainer from load().
+  """
+  state = {"position": tuple(position),
+           "checkpoint": checkpoint,
+           "learning_rate": learning_rate,
+           "python_random": random.getstate(),
+           "numpy_random": np.random.get_state(),
+           "monitor": monitor}
+  path = os.path.join(save_path, STATE_FILE)
+  with open(path + ".tmp", "wb") as f:
+    pickle.dump(state, f)
+  os.replace(path + ".tmp", path)
+
+
+def load(save_path):
+  """The state saved in save_path, or None when the run starts afresh."""
+  path = os.path.join(save_path, STATE_FILE)
+  if not os.path.exists(path):
+    return None
+  with open(path, "rb") as f:
+    state = pickle.load(f)
+  print("Resuming after outer epoch %d, shard %d, epoch %d, learning rate %.6f"
+        % (state["position"] + (state["learning_rate"],)))
+  return state
+
+
+def restore(session, saver, state):
+  """Restores the checkpoint and RNG states saved with state.
+
+  The Supervisor may have restored a newer checkpoint, autosaved part way
+  through the next position. That position is trained again from the start,
+  so the weights go back to the checkpoint matching the cursor when it is
+  still on disk.
+  """
+  if state is None:
+    return
+  if tf.train.checkpoint_exists(state["checkpoint"]):
+    saver.restore(session, state["checkpoint"])
+  else:
+    print("Checkpoint %s is gone, keeping the latest one." % state["checkpoint"])
+  random.setstate(state["python_random"])
+  np.random.set_state(state["numpy_random"])
+
+
+def done(state, total_epoch, train_round, epoch):
+  """Whether this position was finished before the restart."""
+  return state is not None and (total_epoch, train_round, epoch) <= state["position"]
@@ -0,0 +1,101 @@
+"""LRU cache of decoded training shards across outer epochs."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import collections
+import os
+import time
+
+import numpy as np
+
+
+class ShardCache(object):
+  """Keeps decoded (data, sequence_length) shards resident under a budget.
+
+  Shards pushed out of memory are spilled to .npy files in spill_dir, when
+  one is given, and come back memory-mapped instead of being parsed from
+  text again. Cached arrays are read-only. The spill files belong to this
+  process and are removed by close(), which also runs at exit.
+  """
+
+  def __init__(self, budget_bytes, spill_dir=None):
+    self._budget_bytes = budget_bytes
+    self._spill_dir = spill_dir
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._spilled = set()
+    # seconds the first, uncached load of each shard took
+    self._load_seconds = {}
+    self.hits = 0
+    self.spill_hits = 0
+    self.misses = 0
+    self.seconds_saved = 0.0
+    if spill_dir and not os.path.exists(spill_dir):
+      os.makedirs(spill_dir)
+    if spill_dir:
+      atexit.register(self.close)
+
+  def get(self, index, load):
+    """Returns shard `index`, calling load() only when it is not cached."""
+    if index in self._entries:
+      self._entries.move_to_end(index)
+      self.hits += 1
+      self.seconds_saved += self._load_seconds[index]
+      return self._entries[index]
+    start_time = time.time()
+    if index in self._spilled:
+      shard = (np.load(self._spill_path(index, "data"), mmap_mode="r"),
+               np.load(self._spill_path(index, "length"), mmap_mode="r"))
+      self.spill_hits += 1
+      self.seconds_saved += max(
+          0.0, self._load_seconds[index] - (time.time() - start_time))
+    else:
+      data, sequence_length = load()
+      data.flags.writeable = False
+      sequence_length.flags.writeable = False
+      shard = (data, sequence_length)
+      self.misses += 1
+      self._load_seconds[index] = time.time() - start_time
+    self._insert(index, shard)
+    return shard
+
+  def _insert(self, index, shard):
+    size = shard[0].nbytes + shard[1].nbytes
+    if size > self._budget_bytes:
+      self._spill(index, shard)
+      return
+    self._entries[index] = shard
+    self._bytes += size
+    while self._bytes > self._budget_bytes:
+      old_index, old_shard = self._entries.popitem(last=False)
+      self._bytes -= old_shard[0].nbytes + old_shard[1].nbytes
+      self._spill(old_index, old_shard)
+
+  def _spill(self, index, shard):
+    if not self._spill_dir or index in self._spilled:
+      return
+    np.save(self._spill_path(index, "data"), shard[0])
+    np.save(self._spill_path(index, "length"), shard[1])
+    self._spilled.add(index)
+
+  def close(self):
+    """Removes the spill files; spilled shards are loaded again on next use."""
+    for index in self._spilled:
+      for kind in ("data", "length"):
+        try:
+          os.remove(self._spill_path(index, kind))
+        except OSError:
+          pass
+    self._spilled.clear()
+
+  def _spill_path(self, index, kind):
+    return os.path.join(self._spill_dir,
+                        "shard_%02d_%s_%d.npy" % (index, kind, os.getpid()))
+
+  def __str__(self):
+    return ("Shard cache: %d hits, %d spill hits, %d misses, %.1f MB resident, "
+            "%.1f s load time saved" % (
+                self.hits, self.spill_hits, self.misses,
+                self._bytes / 2.0**20, self.seconds_saved))
@@ -1,8 +1,10 @@
 from numpy import * 
 from my import reader
+from my import memwatch
 
 counter = 0
 resultList = []
+@memwatch.timed()
 def genPredict(result, test_path):
 	global counter, resultList
 	result = reshape(array(result),[-1,47])
@@ -14,6 +16,7 @@ def genPredict(result, test_path):
 		i+=1
 	counter += i
 
+@memwatch.timed()
 def savePredict(index, test_path, config = None, describ = None):
 	global resultList,counter
 
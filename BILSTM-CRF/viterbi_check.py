@@ -0,0 +1,63 @@
+"""Parity and throughput check of my/crf.py against tf.contrib.crf.crf_decode.
+
+$ python viterbi_check.py --num_sentences 10000
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from my import crf
+
+flags = tf.flags
+flags.DEFINE_integer("num_sentences", 10000, "Number of random sentences.")
+flags.DEFINE_integer("num_steps", 47, "Padded sentence length.")
+flags.DEFINE_integer("num_tags", 2, "Number of CRF tags.")
+flags.DEFINE_integer("seed", 0, "Random seed.")
+FLAGS = flags.FLAGS
+
+
+def main(_):
+  rng = np.random.RandomState(FLAGS.seed)
+  score = rng.randn(FLAGS.num_sentences, FLAGS.num_steps,
+                    FLAGS.num_tags).astype(np.float32)
+  transition_params = rng.randn(FLAGS.num_tags,
+                                FLAGS.num_tags).astype(np.float32)
+  seq_length = rng.randint(1, FLAGS.num_steps + 1,
+                           FLAGS.num_sentences).astype(np.int32)
+
+  start_time = time.time()
+  tags, best_score = crf.viterbi_decode(score, transition_params, seq_length)
+  numpy_time = time.time() - start_time
+
+  with tf.Graph().as_default():
+    score_t = tf.placeholder(tf.float32, [None, FLAGS.num_steps, FLAGS.num_tags])
+    length_t = tf.placeholder(tf.int32, [None])
+    decode_tags, decode_score = tf.contrib.crf.crf_decode(
+        score_t, tf.constant(transition_params), length_t)
+    with tf.Session() as session:
+      # batch-1 calls, as the test loop of lstm_crf.py used to make
+      start_time = time.time()
+      for i in range(FLAGS.num_sentences):
+        session.run([decode_tags, decode_score],
+                    {score_t: score[i:i + 1], length_t: seq_length[i:i + 1]})
+      tf_time = time.time() - start_time
+      tf_tags, tf_score = session.run([decode_tags, decode_score],
+                                      {score_t: score, length_t: seq_length})
+
+  mismatch = 0
+  for i in range(FLAGS.num_sentences):
+    if list(tags[i][:seq_length[i]]) != list(tf_tags[i][:seq_length[i]]):
+      mismatch += 1
+  print("tag mismatches: %d / %d" % (mismatch, FLAGS.num_sentences))
+  print("max score difference: %g" % np.max(np.abs(best_score - tf_score)))
+  print("crf_decode, batch 1: %.0f sentences/s"
+        % (FLAGS.num_sentences / tf_time))
+  print("viterbi_decode, batched: %.0f sentences/s"
+        % (FLAGS.num_sentences / numpy_time))
+  if mismatch:
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -6,6 +6,17 @@ import tensorflow as tf
 from my import reader
 #import reader
 from my import util
+from my import embedding
+from my import shard_cache
+from my import shard_feed
+from my import resume
+from my import background
+from my import instrument
+from my import profiling
+from my import memwatch
+from my import freeze
+from my import distill
+from my import dev_monitor
 import os
 from tensorflow.python.client import device_lib
 import predict_result
@@ -14,7 +25,7 @@ flags = tf.flags
 logging = tf.logging
 
 flags.DEFINE_string("model", "train",
-    "A type of model. Possible options are: train, test.")
+    "A type of model. Possible options are: train, test, freeze.")
 flags.DEFINE_string("data_path", "./corpus/",
                     "Where the training/test data is stored.")
 flags.DEFINE_string("save_path", "./model_proba/proba_total_bi/",
@@ -23,6 +34,74 @@ flags.DEFINE_string("test_path", "./test/new_test",
                     "Model test file.")
 flags.DEFINE_bool("use_fp16", False,
                   "Train using 16-bit floats instead of 32bit floats")
+flags.DEFINE_bool("lazy_adam", False,
+                  "Use LazyAdam, which updates the Adam moments of the "
+                  "embedding only for the ids in the batch.")
+flags.DEFINE_bool("stateless", False,
+                  "Start every batch from the zero LSTM state instead of "
+                  "feeding back the previous final state.")
+flags.DEFINE_integer("num_workers", 1,
+                     "If larger than 1, train synchronously with this many "
+                     "local worker processes and one parameter server.")
+flags.DEFINE_string("job_name", "",
+                    "Set by the launcher: ps or worker.")
+flags.DEFINE_integer("task_index", 0, "Set by the launcher: worker index.")
+flags.DEFINE_integer("ps_port", 2222,
+                     "Port of the local parameter server, workers use the "
+                     "following ports.")
+flags.DEFINE_string("shm_prefix", "",
+                    "Attach training shards published by my/shared_corpus.py "
+                    "under this name prefix instead of reading the files.")
+flags.DEFINE_integer("shard_cache_mb", 0,
+                     "Keep up to this many MB of decoded shards in memory "
+                     "across outer epochs, 0 disables the cache.")
+flags.DEFINE_string("shard_spill_dir", "",
+                    "Spill shards evicted from the shard cache to .npy files "
+                    "in this directory.")
+flags.DEFINE_integer("corrupt_workers", 0,
+                     "Worker processes corrupting the next training shard "
+                     "while the current one trains, 0 corrupts inline.")
+flags.DEFINE_integer("corrupt_seed", 0,
+                     "Base seed of the per-epoch corruption of every shard.")
+flags.DEFINE_bool("async_eval", False,
+                  "Snapshot the weights after every shard and leave checkpointing "
+                  "and dev/test evaluation to a background thread.")
+flags.DEFINE_integer("early_stop_patience", 0,
+                     "Stop after this many dev evaluations without a new best "
+                     "dev loss, 0 trains all outer epochs.")
+flags.DEFINE_integer("lr_patience", 0,
+                     "Scale the learning rate by --lr_factor after this many "
+                     "dev evaluations without a new best, 0 disables.")
+flags.DEFINE_float("lr_factor", 0.5, "Learning rate scale applied on a dev plateau.")
+flags.DEFINE_float("sample_shards", 1.0,
+                   "Share of the shards trained per outer epoch, drawn by "
+                   "their recent dev improvement.")
+flags.DEFINE_string("instrument_csv", "",
+                    "Append per-step input wait, compute and overhead times, "
+                    "shard load and error-injection times to this CSV file.")
+flags.DEFINE_integer("instrument_every", 1,
+                     "Split the input wait off every this many training steps.")
+flags.DEFINE_string("profile_steps", "",
+                    "Trace these run_epoch steps, counted per train/eval pass "
+                    "over the run, e.g. \"100,200-202\".")
+flags.DEFINE_string("profile_dir", "./profile/",
+                    "Where traced steps write Chrome-trace timelines and op tables.")
+flags.DEFINE_string("memwatch", "",
+                    "Time the reader, producer and evaluation stages and print "
+                    "their memory watermarks after every shard: \"rss\", or "
+                    "\"trace\" to add tracemalloc peaks.")
+flags.DEFINE_integer("freeze_batch_size", 64,
+                     "Batch size of the graph written by --model freeze.")
+flags.DEFINE_string("teacher_path", "",
+                    "Distill: train on the per-character error scores of the "
+                    "frozen model in this save path instead of the corruption labels.")
+flags.DEFINE_float("distill_alpha", 0.0,
+                   "Weight of the corruption labels mixed into the teacher's.")
+flags.DEFINE_integer("student_size", 0,
+                     "Hidden and embedding size of a small student, 0 keeps "
+                     "MediumConfig's. Pass it again to test or freeze the student.")
+flags.DEFINE_string("embedding_path", "../Keras/w2c_financial.txt",
+                    "Pre-trained word2vec text file, cached as embedding_<hash>.npy.")
 flags.DEFINE_integer("num_gpus", 1,
                      "If larger than 1, Grappler AutoParallel optimizer "
                      "will create multiple training replicas with each GPU "
@@ -32,12 +111,21 @@ flags.DEFINE_string("rnn_mode", "BLOCK",
                     "The low level implementation of lstm cell: one of CUDNN, "
                     "BASIC, and BLOCK, representing cudnn_lstm, basic_lstm, "
                     "and lstm_block_cell classes.")
+flags.DEFINE_string("encoder", "",
+                    "Sentence encoder: lstm, the bidirectional LSTM, or conv, "
+                    "stacked dilated 1-D convolutions. Empty keeps the config's. "
+                    "Pass it again to test or freeze the model.")
 FLAGS = flags.FLAGS
+# my/instrument.StepInstrument when --instrument_csv is set
+timings = None
+# my/profiling.StepProfiler when --profile_steps is set
+profiler = None
 BASIC = "basic"
 CUDNN = "cudnn"
 BLOCK = "block"
+LSTM = "lstm"
+CONV = "conv"
 
-embedding = None
 
 def data_type():
   return tf.float16 if FLAGS.use_fp16 else tf.float32
@@ -45,12 +133,13 @@ def data_type():
 class PTBInput(object):
   """The input data."""
 
-  def __init__(self, config, data, seq_length, name=None, is_training = True):
+  def __init__(self, config, data, seq_length, name=None, is_training = True, corrupted = None, seed = None):
     self.batch_size = batch_size = config.batch_size
     self.num_steps = num_steps = config.num_steps
     self.epoch_size = ((len(data) // batch_size) - 1) // num_steps
     self.input_data, self.targets, self.seq_length = reader.ptb_producer(
-        data,seq_length, batch_size, num_steps, name=name, is_training = is_training, test_path = FLAGS.test_path)
+        data,seq_length, batch_size, num_steps, name=name, is_training = is_training, test_path = FLAGS.test_path,
+        corrupted = corrupted, seed = seed)
     self.seq_length = tf.reshape(self.seq_length,[-1])
 
 
@@ -62,6 +151,7 @@ class PTBModel(object):
     self._input = input_
     self._rnn_params = None
     self._cell = None
+    self.sync_optimizer = None
     self.batch_size = input_.batch_size
     self.num_steps = input_.num_steps
     self.vocab_size = len(reader.word_to_id)+1
@@ -72,12 +162,9 @@ class PTBModel(object):
       if FLAGS.pretrained_embedding == False:
        self.embedding = tf.get_variable(name = "embedding", shape = [self.vocab_size, self.embedding_size], initializer = tf.truncated_normal_initializer, dtype=tf.float32)
       else:
-        if os.path.exists("./embedding.txt"):
-          self.loadEmbedding()
-        else:
-          self.usePreEmbedding("../Keras/w2c_financial.txt")
+        self.usePreEmbedding(FLAGS.embedding_path)
         self.embedding = tf.get_variable(name = "embedding", initializer=tf.convert_to_tensor(self.embedding), dtype=tf.float32)
-      inputs = tf.nn.embedding_lookup(self.embedding, input_.input_data)
+      inputs = util.embed_ids(self.embedding, input_.input_data)
 
     # get predict word's distribution
     output, state = self._build_rnn_graph(inputs, config, is_training)
@@ -92,6 +179,8 @@ class PTBModel(object):
     logits = tf.contrib.layers.fully_connected(output, 2, activation_fn=None)
     # Reshape logits to be a 3-D tensor for sequence loss
     logits = tf.reshape(logits, [self.batch_size, self.num_steps, 2])
+    # label [1,0] marks an error
+    self.error_proba = tf.nn.softmax(logits)[:, :, 0]
     
     label_reshape = tf.cast(tf.reshape(input_.targets, [self.batch_size, self.num_steps,2]), tf.float32)
     
@@ -117,23 +206,33 @@ class PTBModel(object):
     self._lr = tf.Variable(0.0, trainable=False)
     tvars = tf.trainable_variables()
     grads, _ = tf.clip_by_global_norm(tf.gradients(self._cost, tvars),config.max_grad_norm)
-    optimizer = tf.train.AdamOptimizer(self._lr)
+    if FLAGS.lazy_adam:
+      # only the embedding rows seen in the batch get their moments updated
+      optimizer = tf.contrib.opt.LazyAdamOptimizer(self._lr)
+    else:
+      optimizer = tf.train.AdamOptimizer(self._lr)
+    if FLAGS.num_workers > 1:
+      # average the gradients of all workers before every update
+      optimizer = self.sync_optimizer = tf.train.SyncReplicasOptimizer(
+          optimizer, replicas_to_aggregate=FLAGS.num_workers,
+          total_num_replicas=FLAGS.num_workers)
     self._train_op = optimizer.apply_gradients(zip(grads, tvars),global_step=tf.train.get_or_create_global_step())
 
     self._new_lr = tf.placeholder(tf.float32, shape=[], name="new_learning_rate")
     self._lr_update = tf.assign(self._lr, self._new_lr)
 
-  def resetInput(self, input_):
-    self._input = input_
-
   def _build_rnn_graph(self, inputs, config, is_training):
-    return self._build_rnn_graph_lstm(inputs, config, is_training)
+    if config.encoder == CONV:
+      return self._build_conv_graph(inputs, config, is_training)
+    if config.encoder == LSTM:
+      return self._build_rnn_graph_lstm(inputs, config, is_training)
+    raise ValueError("encoder %s not supported" % config.encoder)
 
   def _get_lstm_cell(self, config, is_training):
     if config.rnn_mode == BASIC:
       return tf.contrib.rnn.BasicLSTMCell(
           config.hidden_size, forget_bias=0.0, state_is_tuple=True,
-          reuse= not is_training)
+          reuse=tf.get_variable_scope().reuse)
     if config.rnn_mode == BLOCK:
       return tf.contrib.rnn.LSTMBlockCell(
           config.hidden_size, forget_bias=0.0)
@@ -158,50 +257,30 @@ class PTBModel(object):
     output = tf.reshape(outputs, [-1, config.hidden_size*2])
     return output, state
 
-  def usePreEmbedding(self, embeddingf ,save = True):
-    global embedding
-    # use pre-trained embedding
+  def _build_conv_graph(self, inputs, config, is_training):
+    # a step reads (conv_width-1)/2 * sum(conv_dilations) steps to each side,
+    # 63 for kernel 3 and dilations 1..32, so even the first and last steps
+    # see the whole sentence
+    reach = (config.conv_width - 1) // 2 * sum(config.conv_dilations)
+    if reach < self.num_steps - 1:
+      raise ValueError("conv_dilations reach %d steps, a row has %d" % (reach, self.num_steps))
+    self._initial_state_fw = self._initial_state_bw = None
+    mask = tf.expand_dims(tf.sequence_mask(self._input.seq_length, self.num_steps, dtype=data_type()), 2)
+    outputs = tf.layers.dense(inputs, config.hidden_size*2, name="conv_in") * mask
+    for i, rate in enumerate(config.conv_dilations):
+      layer = tf.layers.conv1d(outputs, config.hidden_size*2, config.conv_width, padding="same",
+                               dilation_rate=rate, activation=tf.nn.relu, name="conv_%d" % i)
+      if is_training and config.keep_prob < 1:
+        layer = tf.nn.dropout(layer, config.keep_prob)
+      # padding is zeroed so that no step reads past the end of its sentence
+      outputs = (outputs + layer) * mask
+    output = tf.reshape(outputs, [-1, config.hidden_size*2])
+    return output, (None, None)
+
+  def usePreEmbedding(self, embeddingf):
+    # use pre-trained embedding, cached as a .npy file keyed by vocabulary
     print("Using Pre-trained Embedding...")
-    embedding_dict = {}
-    f = codecs.open(embeddingf, "r", encoding="utf8",errors='ignore')
-    for line in f:
-      values = line.split()
-      word = values[0]
-      coefs = asarray(values[1:],dtype='float32')
-      embedding_dict[word] = coefs
-    f.close()
-    embedding = zeros( (vocab_size, 300), dtype=float32)
-    for word, i in reader.word_to_id.items():
-      embedding_vector = embedding_dict.get(word)
-      if embedding_vector is  None:
-        embedding_vector = zeros((1,300), dtype=float32)
-        for character in word:
-          if character in embedding_dict:
-            embedding_vector = embedding_vector + embedding_dict.get(character)
-        embedding_vector = embedding_vector / len(word)
-      embedding[i] = embedding_vector
-    if save == True:
-      saveEmebdding()
-    return embedding
-
-  def saveEmebdding(self):
-    global embedding
-    print("Saving Embedding...")
-    ff = open("./embedding.txt","wb")
-    for i in embedding:
-      savetxt(ff,i,fmt="%f")
-    ff.close()
-    print("Saving Embedding Finish")
-
-  def loadEmbedding(self):
-    global embedding
-    print("Loading Embedding...")
-    embedding = []
-    embedding  = loadtxt("./embedding.txt", dtype = float32)
-    embedding = reshape(embedding,[-1,300])
-    vocab_size = embedding.shape[0]
-    print("Loading Embedding Finish")
-    return embedding
+    self.embedding = embedding.load_embedding(embeddingf, reader.word_to_id, self.vocab_size)
 
   def assign_lr(self, session, lr_value):
     session.run(self._lr_update, feed_dict={self._new_lr: lr_value})
@@ -279,9 +358,12 @@ class MediumConfig(object):
   num_steps = 47
   vocab_size = 9174
   rnn_mode = BLOCK
+  encoder = LSTM
+  conv_width = 3
+  conv_dilations = (1, 2, 4, 8, 16, 32)
 
   def __str__(self):
-    return ("batch_size: {}, learning_rate: {}, keep_prob: {}, max_grad_norm: {}, init_scale: {}, hidden_size: {}, embedding_size: {}, num_layers: {}".format(self.batch_size,self.learning_rate,self.keep_prob,self.max_grad_norm,self.init_scale,self.hidden_size,self.embedding_size,self.num_layers))
+    return ("batch_size: {}, learning_rate: {}, keep_prob: {}, max_grad_norm: {}, init_scale: {}, hidden_size: {}, embedding_size: {}, num_layers: {}, encoder: {}".format(self.batch_size,self.learning_rate,self.keep_prob,self.max_grad_norm,self.init_scale,self.hidden_size,self.embedding_size,self.num_layers,self.encoder))
 
 def run_epoch(session, model, eval_op=None, verbose=False, is_training=True, save_file=None):
   
@@ -290,30 +372,53 @@ def run_epoch(session, model, eval_op=None, verbose=False, is_training=True, sav
   costs = 0.0
   iters = 0
   acc = 0.0
-  state_fw,state_bw = session.run([model.initial_state_fw,model.initial_state_bw])
   fetches = {
       "cost": model.cost,
-      "final_state_fw": model.final_state_fw,
-      "final_state_bw": model.final_state_bw,
       "accuracy": model.accuracy,
       "logits": model.logits,
       #"targets":model.targets,
       #"length":model.length
       #"loss_masked": model.loss_masked
   }
+  if FLAGS.stateless or model.initial_state_fw is None:
+    # rows are independent sentences, the graph starts from its zero state;
+    # the conv encoder has no state at all
+    state_fw = state_bw = None
+    if save_file is None:
+      del fetches["logits"]
+  else:
+    state_fw,state_bw = session.run([model.initial_state_fw,model.initial_state_bw])
+    fetches["final_state_fw"] = model.final_state_fw
+    fetches["final_state_bw"] = model.final_state_bw
   if eval_op is not None:
     fetches["eval_op"] = eval_op
   for step in range(model.input.epoch_size):
+    step_start = time.time()
     feed_dict = {}
-    for i, (c, h) in enumerate(model.initial_state_fw):
-      feed_dict[c] = state_fw[i].c
-      feed_dict[h] = state_fw[i].h
-
-    for i, (c, h) in enumerate(model.initial_state_bw):
-      feed_dict[c] = state_bw[i].c
-      feed_dict[h] = state_bw[i].h
-
-    vals = session.run(fetches, feed_dict )
+    if state_fw is not None:
+      for i, (c, h) in enumerate(model.initial_state_fw):
+        feed_dict[c] = state_fw[i].c
+        feed_dict[h] = state_fw[i].h
+
+      for i, (c, h) in enumerate(model.initial_state_bw):
+        feed_dict[c] = state_bw[i].c
+        feed_dict[h] = state_bw[i].h
+
+    dequeue = None
+    if isinstance(model.input, shard_feed.ShardFeed):
+      feed_start = time.time()
+      feed_dict.update(model.input.batch(step))
+      dequeue = time.time() - feed_start
+    elif timings is not None and eval_op is not None:
+      dequeue = timings.dequeue(session, model, feed_dict)
+    run_options, run_metadata = None, None
+    if profiler is not None:
+      run_options, run_metadata = profiler.options("train" if eval_op is not None else "eval")
+    run_start = time.time()
+    vals = session.run(fetches, feed_dict, options=run_options, run_metadata=run_metadata)
+    compute = time.time() - run_start
+    if run_metadata is not None:
+      profiler.collect("train" if eval_op is not None else "eval", run_metadata)
     if is_training==False:
       if save_file is not None:
         result = vals["logits"]
@@ -324,19 +429,23 @@ def run_epoch(session, model, eval_op=None, verbose=False, is_training=True, sav
         predict_result.genPredict(array(result,dtype=int32), test_path = FLAGS.test_path)
       
     cost = vals["cost"]
-    state_fw = vals["final_state_fw"]
-    state_bw = vals["final_state_bw"]
+    if state_fw is not None:
+      state_fw = vals["final_state_fw"]
+      state_bw = vals["final_state_bw"]
     costs += cost
     iters += model.input.num_steps
     acc += vals["accuracy"]
     if verbose and step % (model.input.epoch_size // 10) == 10:
-      print("%.3f Loss: %.3f Speed: %.0f wps Acc: %.3f" %(
+      print("%.3f Loss: %.3f Speed: %.0f wps %.2f steps/s Acc: %.3f" %(
           step * 1.0 / model.input.epoch_size, 
           np.exp(costs / iters),
           iters * model.input.batch_size * max(1, FLAGS.num_gpus) / (time.time() - start_time),
+          (step + 1) / (time.time() - start_time),
           acc / (iters//model.input.num_steps)
         )
       )
+    if timings is not None and eval_op is not None:
+      timings.record("train", dequeue, compute, time.time() - step_start)
 
   return np.exp(costs / iters), acc / (iters//model.input.num_steps)
 
@@ -347,16 +456,32 @@ def get_config():
   mode = 0
   if FLAGS.model == "test":
     mode = 1
+  elif FLAGS.model == "freeze":
+    mode = 2
   if FLAGS.rnn_mode:
     temconfig.rnn_mode = FLAGS.rnn_mode
+  if FLAGS.student_size:
+    temconfig.hidden_size = temconfig.embedding_size = FLAGS.student_size
+  if FLAGS.encoder:
+    temconfig.encoder = FLAGS.encoder
   if FLAGS.num_gpus != 1 or tf.__version__ < "1.3.0" :
     temconfig.rnn_mode = BASIC
   return temconfig, mode
 
 
 def main(_):
+  global timings, profiler
   if not FLAGS.data_path:
     raise ValueError("Must set --data_path to PTB data directory")
+  reader.shm_prefix = FLAGS.shm_prefix or None
+  if FLAGS.shard_cache_mb > 0 or FLAGS.shard_spill_dir:
+    reader.shard_cache = shard_cache.ShardCache(FLAGS.shard_cache_mb * 2**20, FLAGS.shard_spill_dir or None)
+  if FLAGS.instrument_csv:
+    timings = reader.timings = instrument.StepInstrument(FLAGS.instrument_csv, every=FLAGS.instrument_every)
+  if FLAGS.profile_steps:
+    profiler = profiling.StepProfiler(profiling.parse_steps(FLAGS.profile_steps), FLAGS.profile_dir)
+  if FLAGS.memwatch:
+    memwatch.watch = memwatch.MemWatch(trace=FLAGS.memwatch == "trace")
   gpus = [
       x.name for x in device_lib.list_local_devices() if x.device_type == "GPU"
   ]
@@ -374,22 +499,61 @@ def main(_):
   dev_config.keep_prob = 1
 
   if mode == 0:
+    if FLAGS.num_workers > 1 and not FLAGS.job_name:
+      return util.launch_local_cluster(FLAGS.num_workers)
+    server = None
+    device = None
+    is_chief = True
+    config_proto = tf.ConfigProto(allow_soft_placement=True)
+    if FLAGS.job_name:
+      cluster = util.local_cluster(FLAGS.num_workers, FLAGS.ps_port)
+      config_proto = util.worker_config(FLAGS.num_workers)
+      server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index, config=config_proto)
+      if FLAGS.job_name == "ps":
+        server.join()
+        return
+      is_chief = FLAGS.task_index == 0
+      device = tf.train.replica_device_setter(worker_device="/job:worker/task:%d" % FLAGS.task_index, cluster=cluster)
+
+    def load_round(train_round):
+      train_data,train_seq_length, dev_data, dev_seq_length = reader.ptb_raw_data(FLAGS.data_path, is_training = True, index = train_round)
+      if server is not None:
+        train_data,train_seq_length = util.worker_slice(train_data, train_seq_length, config.num_steps, FLAGS.task_index, FLAGS.num_workers)
+      return train_data,train_seq_length, dev_data, dev_seq_length
+
+    def round_seed(total_epoch, train_round, stream = 0):
+      return reader.epoch_seed(FLAGS.corrupt_seed, total_epoch, train_round, stream)
+
+    # forked before any session exists
+    pool = reader.CorruptionPool(FLAGS.corrupt_workers) if FLAGS.corrupt_workers > 0 else None
+    if FLAGS.teacher_path:
+      reader.get_dict()
+      reader.soft_labels = distill.Teacher(FLAGS.teacher_path, FLAGS.distill_alpha, len(reader.word_to_id))
+
     # train mode
     print("Enter Train Mode:")
-    train_data,train_seq_length, dev_data, dev_seq_length = reader.ptb_raw_data(FLAGS.data_path, is_training = True, index = 0)
+    state = resume.load(FLAGS.save_path)
+    # one dev set for the whole run, so that its losses can be compared: the
+    # dev rows of the first shard, corrupted with a seed of no outer epoch
+    _, _, dev_data, dev_seq_length = load_round(0)
+    dev_X, dev_y = reader.training_labels(dev_data, dev_seq_length, config.num_steps, "DevInput",
+                                          seed = round_seed(0, 0, 1))
     test_data,test_seq_length = reader.ptb_raw_data(FLAGS.test_path, is_training = False)
-    with tf.Graph().as_default():
+    with tf.Graph().as_default(), tf.device(device):
       initializer = tf.random_uniform_initializer(-config.init_scale,config.init_scale)
       with tf.name_scope("Train"):
-        train_input = PTBInput(config=config, data=train_data, seq_length= train_seq_length, name="TrainInput")
+        # every shard is fed to this one graph, see my/shard_feed.py
+        train_input = shard_feed.ShardFeed(config.batch_size, config.num_steps, [config.num_steps, 2], tf.float32, name="TrainInput")
         with tf.variable_scope("Model", reuse=None , initializer=initializer) as scope:
           m = PTBModel(is_training=True, config=config, input_=train_input)
           scope.reuse_variables()
         tf.summary.scalar("Training Loss", m.cost)
         tf.summary.scalar("Learning Rate", m.lr)
+        summary_op = tf.summary.merge_all()
       
       with tf.name_scope("Dev"):
-        dev_input = PTBInput(config=dev_config, data=dev_data, seq_length = dev_seq_length, name="DevInput")
+        dev_input = shard_feed.ShardFeed(dev_config.batch_size, dev_config.num_steps, [dev_config.num_steps, 2], tf.float32, name="DevInput")
+        dev_input.set(dev_X, dev_seq_length, dev_y)
         with tf.variable_scope("Model", reuse=True , initializer=initializer) as scope:
           devm = PTBModel(is_training=False, config=dev_config, input_=dev_input)
 
@@ -398,44 +562,156 @@ def main(_):
         with tf.variable_scope("Model", reuse=True , initializer=initializer) as scope:
           testm = PTBModel(is_training=False, config=eval_config, input_=test_input)
       
-      sv = tf.train.Supervisor(logdir=FLAGS.save_path)
-      config_proto = tf.ConfigProto(allow_soft_placement=True)
-      with sv.managed_session(config=config_proto) as session:
+      monitor = dev_monitor.DevMonitor(84, config.max_max_max_epoch, config.max_max_epoch,
+                                       patience=FLAGS.early_stop_patience, lr_patience=FLAGS.lr_patience,
+                                       lr_factor=FLAGS.lr_factor, sample_fraction=FLAGS.sample_shards,
+                                       seed=FLAGS.corrupt_seed)
+      if state is not None:
+        monitor.restore(state.get("monitor"))
+      shared = None
+      if m.sync_optimizer is not None:
+        # the other workers follow the chief's shard order and stop
+        shared = util.SharedMonitor(84)
+
+      def decide(session, order):
+        if shared is None:
+          return order, monitor.should_stop
+        order, stop = shared.decide(session, is_chief, order, monitor.should_stop)
+        monitor.follow(order)
+        return order, stop
+
+      def evaluate(session, devm, testm, position):
+        total_epoch, train_round, i = position
+        dev_perplexity ,acc= run_epoch(session, devm, is_training = False)
+        print("Epoch: %d Dev Loss: %.3f Acc: %.3f" % (i + 1, dev_perplexity, acc))
+
+        # test
+        length = reader.length
+        print(length)
+        _,acc = run_epoch(session,testm, is_training = False, save_file = "test")
+        test_acc, f1score = predict_result.savePredict(train_round, test_path = FLAGS.test_path, config= config, describ = FLAGS.save_path)
+        print("Epoch: %d Test Acc: %.3f Evaluate Acc: %.3f F1: %.3f" % (i + 1,acc, test_acc, f1score))
+        return dev_perplexity
+
+      evaluator = None
+      if FLAGS.async_eval and is_chief:
+        # dev and test models of their own, loaded from each snapshot
+        eval_graph = tf.Graph()
+        with eval_graph.as_default():
+          with tf.name_scope("Dev"):
+            eval_dev_input = shard_feed.ShardFeed(dev_config.batch_size, dev_config.num_steps, [dev_config.num_steps, 2], tf.float32, name="DevInput")
+            eval_dev_input.set(dev_X, dev_seq_length, dev_y)
+            with tf.variable_scope("Model", reuse=None):
+              eval_devm = PTBModel(is_training=False, config=dev_config, input_=eval_dev_input)
+          with tf.name_scope("Test"):
+            eval_test_input = PTBInput(config=eval_config, data=test_data, seq_length = test_seq_length, name="TestInput", is_training = False)
+            with tf.variable_scope("Model", reuse=True):
+              eval_testm = PTBModel(is_training=False, config=eval_config, input_=eval_test_input)
+        evaluator = background.BackgroundEvaluator(
+            tf.global_variables(), eval_graph,
+            lambda session, position, data: evaluate(session, eval_devm, eval_testm, position),
+            save_path=FLAGS.save_path, config=config_proto)
+
+      def apply_results():
+        # the monitor is only updated here, on the training thread
+        if evaluator is not None:
+          for position, dev_loss in evaluator.results():
+            monitor.update(position, dev_loss)
+
+      sync = util.SyncReplicas(m.sync_optimizer, is_chief, FLAGS.save_path)
+      sv = sync.supervisor
+      if timings is not None:
+        timings.summary_writer = sv.summary_writer
+      with sv.managed_session(server.target if server else "", config=config_proto) as session:
+        sync.start(session)
+        if is_chief:
+          resume.restore(session, sv.saver, state)
+        stop = False
         for total_epoch in range(config.max_max_max_epoch):
-          for train_round in range(84):
+          apply_results()
+          order, stop = decide(session, monitor.shard_order(total_epoch))
+          for train_round in order:
+            apply_results()
+            _, stop = decide(session, order)
+            if stop:
+              break
+            if resume.done(state, total_epoch, train_round, config.max_max_epoch - 1):
+              continue
             print("="*20)
             print("Now Training index: %d"%train_round)
 
-            tf.reset_default_graph()
-            train_data,train_seq_length, dev_data, dev_seq_length = reader.ptb_raw_data(FLAGS.data_path, is_training = True, index = train_round)
-            train_input = PTBInput(config=config, data=train_data, seq_length= train_seq_length, name="TrainInput")
-            dev_input = PTBInput(config=eval_config, data=dev_data, seq_length= dev_seq_length, name="DevInput")
-            m.resetInput(train_input)
-            devm.resetInput(dev_input)
+            corrupted = None
+            if pool is not None:
+              (train_data,train_seq_length, _, _), corrupted = pool.get(
+                  (total_epoch, train_round), lambda: load_round(train_round), config.num_steps, round_seed(total_epoch, train_round))
+              next_shard = monitor.next_shard(total_epoch, train_round)
+              if (next_shard is not None and next_shard[0] < config.max_max_max_epoch and
+                  not resume.done(state, next_shard[0], next_shard[1], config.max_max_epoch - 1)):
+                # loaded on the pool's thread, bind the shard now
+                pool.prefetch(next_shard, lambda index=next_shard[1]: load_round(index), config.num_steps, round_seed(*next_shard))
+            else:
+              train_data,train_seq_length, _, _ = load_round(train_round)
+            X, y = reader.training_labels(train_data, train_seq_length, config.num_steps, "TrainInput",
+                                          corrupted = corrupted, seed = round_seed(total_epoch, train_round), distill = True)
+            train_input.set(X, train_seq_length, y, seed = round_seed(total_epoch, train_round))
             for i in range(config.max_max_epoch):
+              if resume.done(state, total_epoch, train_round, i):
+                continue
               
               print("TrainTrain")
+              apply_results()
               lr_decay = config.lr_decay ** max(i + 1 - config.max_epoch, 0.0)
-              m.assign_lr(session, config.learning_rate * lr_decay)
+              lr_decay *= monitor.lr_scale
+              if is_chief:
+                # the learning rate is shared, only the chief's monitor scales it
+                m.assign_lr(session, config.learning_rate * lr_decay)
               print("Epoch: %d Learning rate: %.3f" % (i + 1, session.run(m.lr)))
               train_perplexity,acc = run_epoch(session, m, eval_op=m.train_op,verbose=True)
               print("Epoch: %d Train Loss: %.3f Acc: %.3f" % (i + 1, train_perplexity,acc))
-              
-              dev_perplexity ,acc= run_epoch(session, devm, is_training = False)
-              print("Epoch: %d Dev Loss: %.3f Acc: %.3f" % (i + 1, dev_perplexity, acc))
-              
-              # test
-              length = reader.length
-              print(length)
-              #save_file = open("./result_proba_"+str(train_round)+".txt","w")
-              _,acc = run_epoch(session,testm, is_training = False, save_file = "test")
-              test_acc, f1score = predict_result.savePredict(train_round, test_path = FLAGS.test_path, config= config, describ = FLAGS.save_path)
-              print("Epoch: %d Test Acc: %.3f Evaluate Acc: %.3f F1: %.3f" % (i + 1,acc, test_acc, f1score))
-              #save_file.close()
+              if timings is not None:
+                timings.summarize(session.run(sv.global_step))
+              if not is_chief:
+                continue
+              sv.summary_computed(session, session.run(summary_op, train_input.batch(0)))
+              if evaluator is not None:
+                evaluator.snapshot(session, (total_epoch, train_round, i), config.learning_rate * lr_decay, sv.global_step,
+                                   monitor=monitor.state())
+                continue
+              monitor.update((total_epoch, train_round, i), evaluate(session, devm, testm, (total_epoch, train_round, i)))
 
               if os.path.exists(FLAGS.save_path):
                 print("Saving model to %s." % FLAGS.save_path)
-                sv.saver.save(session, FLAGS.save_path+"model.ckpt", global_step=sv.global_step)
+                checkpoint = sv.saver.save(session, FLAGS.save_path+"model.ckpt", global_step=sv.global_step)
+                resume.save(FLAGS.save_path, (total_epoch, train_round, i), checkpoint, config.learning_rate * lr_decay,
+                            monitor.state())
+            if memwatch.watch is not None:
+              print(memwatch.watch.report("after shard %d" % train_round))
+          if evaluator is not None:
+            print(evaluator.report())
+          print(monitor)
+          if stop:
+            break
+        if evaluator is not None:
+          evaluator.join()
+          apply_results()
+
+    if pool is not None:
+      pool.close()
+    if reader.soft_labels is not None:
+      reader.soft_labels.close()
+
+  elif mode == 2:
+    print("Enter Freeze Mode:")
+    reader.get_dict()
+    eval_config.batch_size = FLAGS.freeze_batch_size
+    with tf.Graph().as_default():
+      with tf.name_scope("Freeze"):
+        feed = freeze.FeedInput(eval_config.batch_size, eval_config.num_steps)
+        with tf.variable_scope("Model", reuse=None):
+          m = PTBModel(is_training=False, config=eval_config, input_=feed)
+      with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
+        util.restore_for_inference(session, FLAGS.save_path)
+        print("Wrote %s" % freeze.export(session, feed, m.error_proba, FLAGS.save_path, freeze.ERROR_PROBA))
 
   else:
     print("Enter Test Mode:")
@@ -449,21 +725,14 @@ def main(_):
       with tf.name_scope("Train"):
         test_input = PTBInput(config=eval_config, data=test_data, seq_length = test_seq_length, name="TrainInput")
         with tf.variable_scope("Model", reuse=None, initializer=initializer):
-          m = PTBModel(is_training=True, config=eval_config, input_=test_input)
-          
-      sv = tf.train.Supervisor(logdir=FLAGS.save_path)
-      config_proto = tf.ConfigProto(allow_soft_placement=True)
-
-      with sv.managed_session(config=config_proto) as session:
-        ckpt = tf.train.get_checkpoint_state(checkpoint_dir=FLAGS.save_path)
-        sv.saver.restore(session,ckpt.model_checkpoint_path)
+          m = PTBModel(is_training=False, config=eval_config, input_=test_input)
 
+      config_proto = tf.ConfigProto(allow_soft_placement=True)
+      with util.inference_session(FLAGS.save_path, config_proto) as session:
         length = reader.length
-        save_file = open("./result_proba_"+str(train_round)+".txt","w")
         print(length)
         for sublength in range(length):
           run_epoch(session,m, is_training = False)
-        save_file.close()
         #predict_result.saveResult(-1, test_path = FLAGS.test_path)
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+"""Dev-loss driven early stopping, learning-rate plateaus and shard sampling."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+from random import Random
+
+
+class DevMonitor(object):
+  """Follows the dev loss reported after every pass over a shard.
+
+  Early stopping ends training after `patience` dev evaluations in a row
+  without a new best loss, 0 never stops. After `lr_patience` of them,
+  lr_scale is multiplied by lr_factor, 0 keeps the schedule unchanged.
+  With sample_fraction below 1, each outer epoch visits only that share of
+  the shards, drawn in proportion to how much the dev loss fell on their
+  last pass. Shards without a measured pass are always trained, and the order stays
+  ascending so that my/resume.py positions keep their meaning.
+
+  The losses are compared with each other, so they must all come from one
+  dev set, the same rows with the same corruption for the whole run.
+
+  state() is saved by my/resume.py with every position, and restore() puts
+  it back on restart, so a resumed run keeps its best loss, patience counts,
+  learning rate scale and shard weights.
+  """
+
+  def __init__(self, num_shards, max_epochs, epochs_per_shard=1, patience=0,
+               lr_patience=0, lr_factor=0.5, sample_fraction=1.0, seed=0):
+    self._num_shards = num_shards
+    self._max_epochs = max_epochs
+    self._epochs_per_shard = epochs_per_shard
+    self._patience = patience
+    self._lr_patience = lr_patience
+    self._lr_factor = lr_factor
+    self._sample_fraction = sample_fraction
+    self._seed = seed
+    self._order = list(range(num_shards))
+    self._last_loss = None
+    self._pass = None
+    self._pass_start_loss = None
+    self._bad_evals = 0
+    self._plateau_evals = 0
+    self._improvement = {}
+    self.best_loss = None
+    self.lr_scale = 1.0
+    self.should_stop = False
+    self.shard_passes = 0
+
+  def state(self):
+    """What update() has learnt so far, for my/resume.py."""
+    return {"last_loss": self._last_loss,
+            "pass": self._pass,
+            "pass_start_loss": self._pass_start_loss,
+            "bad_evals": self._bad_evals,
+            "plateau_evals": self._plateau_evals,
+            "improvement": dict(self._improvement),
+            "best_loss": self.best_loss,
+            "lr_scale": self.lr_scale,
+            "should_stop": self.should_stop,
+            "shard_passes": self.shard_passes}
+
+  def restore(self, state):
+    """Goes back to a state(), None keeps the fresh one."""
+    if state is None:
+      return
+    self._last_loss = state["last_loss"]
+    self._pass = state.get("pass")
+    self._pass_start_loss = state.get("pass_start_loss")
+    self._bad_evals = state["bad_evals"]
+    self._plateau_evals = state["plateau_evals"]
+    self._improvement = dict(state["improvement"])
+    self.best_loss = state["best_loss"]
+    self.lr_scale = state["lr_scale"]
+    self.should_stop = state["should_stop"]
+    self.shard_passes = state["shard_passes"]
+
+  def shard_order(self, total_epoch):
+    """The shards to train in this outer epoch, ascending."""
+    if self._sample_fraction >= 1:
+      self._order = list(range(self._num_shards))
+      return self._order
+    rng = Random(self._seed * 1000 + total_epoch)
+    count = max(1, int(math.ceil(self._sample_fraction * self._num_shards)))
+    unseen = [index for index in range(self._num_shards)
+              if index not in self._improvement]
+    # weighted sampling without replacement, key u ** (1 / weight)
+    keys = sorted(((rng.random() ** (1.0 / (max(improvement, 0.0) + 1e-6)), index)
+                   for index, improvement in self._improvement.items()),
+                  reverse=True)
+    drawn = [index for _, index in keys[:max(count - len(unseen), 0)]]
+    self._order = sorted(unseen + drawn)
+    return self._order
+
+  def follow(self, order):
+    """Takes the shard order another monitor drew, see util.SharedMonitor."""
+    self._order = list(order)
+
+  def next_shard(self, total_epoch, train_round):
+    """(total_epoch, train_round) of the next pass, None if not known yet."""
+    position = self._order.index(train_round)
+    if position + 1 < len(self._order):
+      return total_epoch, self._order[position + 1]
+    if self._sample_fraction >= 1:
+      return total_epoch + 1, 0
+    return None
+
+  def update(self, position, dev_loss):
+    """Records the dev loss measured after position (total_epoch, train_round, epoch).
+
+    A pass over a shard is all its epochs of one outer epoch. Its
+    improvement is how far the dev loss fell from before the pass, the loss
+    measured after the pass before it, to the latest loss of the pass.
+    """
+    total_epoch, train_round, _ = position
+    if self._pass != (total_epoch, train_round):
+      self._pass = (total_epoch, train_round)
+      self._pass_start_loss = self._last_loss
+    self.shard_passes += 1
+    if self._pass_start_loss is None:
+      # nothing to compare the first pass with, keep drawing that shard
+      self._improvement[train_round] = float("inf")
+    else:
+      self._improvement[train_round] = self._pass_start_loss - dev_loss
+    self._last_loss = dev_loss
+    if self.best_loss is None or dev_loss < self.best_loss:
+      self.best_loss = dev_loss
+      self._bad_evals = self._plateau_evals = 0
+      return
+    self._bad_evals += 1
+    self._plateau_evals += 1
+    if self._lr_patience and self._plateau_evals >= self._lr_patience:
+      self.lr_scale *= self._lr_factor
+      self._plateau_evals = 0
+      print("Dev loss plateaued at %.3f, learning rate scale now %g"
+            % (self.best_loss, self.lr_scale))
+    if self._patience and self._bad_evals >= self._patience:
+      self.should_stop = True
+      print("Dev loss has not improved on %.3f for %d evaluations, stopping."
+            % (self.best_loss, self._bad_evals))
+
+  def __str__(self):
+    planned = self._max_epochs * self._num_shards * self._epochs_per_shard
+    return ("Dev monitor: best dev loss %s, %d of %d planned shard passes "
+            "trained, %.0f%% saved" % (
+                "%.3f" % self.best_loss if self.best_loss is not None else "-",
+                self.shard_passes, planned,
+                100.0 * max(planned - self.shard_passes, 0) / planned))
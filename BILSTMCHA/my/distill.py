@@ -0,0 +1,43 @@
+"""Soft labels from a frozen teacher, for training a small student tagger.
+
+The teacher is any graph written by `--model freeze`, typically the
+BiRNNLM. It scores the corrupted rows of every training shard and its
+per-character error scores, in [0, 1] and 0.5 at its threshold, become the
+student's labels in place of the one-hot corruption labels.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from my import freeze
+from my import memwatch
+
+
+class Teacher(object):
+  """Relabels corrupted rows with a frozen model's error scores.
+
+  alpha mixes the corruption labels back in: the student learns
+  alpha * corruption + (1 - alpha) * teacher, so 0 is pure distillation.
+  Create it after the corruption workers fork, it holds a session.
+  """
+
+  def __init__(self, save_path, alpha=0.0, pad_id=None, threshold=None, config=None):
+    self.model = freeze.FrozenModel(save_path, threshold, config)
+    self.alpha = alpha
+    self.pad_id = pad_id
+
+  @memwatch.timed("distill/teacher")
+  def __call__(self, X, y, sequence_length, num_steps):
+    """Soft labels [rows*num_steps, 2] of the ids X and one-hot labels y."""
+    data = np.reshape(X, [-1, num_steps])
+    rows = len(data)
+    scores = self.model.score(data, np.asarray(sequence_length[:rows]), self.pad_id)
+    proba = self.model.error_score(scores).reshape(-1)
+    if self.alpha > 0:
+      proba = self.alpha * np.reshape(y, [-1, 2])[:, 0] + (1.0 - self.alpha) * proba
+    return np.stack([proba, 1.0 - proba], axis=1).astype(np.float32)
+
+  def close(self):
+    self.model.close()
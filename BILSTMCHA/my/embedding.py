@@ -0,0 +1,81 @@
+"""Binary cache of the pre-trained embedding matrix."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import codecs
+import hashlib
+import os
+
+import numpy as np
+
+
+def vocab_hash(word_to_id, embeddingf=""):
+  """Short digest of the vocabulary and source file, keys the cache file.
+
+  The source file counts by name, size and modification time, so a word2vec
+  file replaced under the same name gets a cache of its own.
+  """
+  h = hashlib.md5(os.path.basename(embeddingf).encode("utf8"))
+  if os.path.exists(embeddingf):
+    stat = os.stat(embeddingf)
+    h.update(("\t%d\t%d\n" % (stat.st_size, int(stat.st_mtime))).encode("utf8"))
+  for word, i in sorted(word_to_id.items(), key=lambda x: x[1]):
+    h.update(("%d\t%s\n" % (i, word)).encode("utf8"))
+  return h.hexdigest()[:12]
+
+
+def build_embedding(embeddingf, word_to_id, vocab_size):
+  """Reads the vectors of the vocabulary out of a word2vec text file.
+
+  The file is streamed and only the vocabulary words and their characters
+  are parsed. A word without its own vector gets the average of its
+  characters' vectors; the padding row stays zero.
+  """
+  needed = set(word_to_id)
+  for word in word_to_id:
+    needed.update(word)
+  vectors = {}
+  with codecs.open(embeddingf, "r", encoding="utf8", errors="ignore") as f:
+    for line in f:
+      values = line.split(None, 1)
+      if len(values) < 2 or values[0] not in needed or values[0] in vectors:
+        continue
+      coefs = np.array(values[1].split(), dtype=np.float32)
+      if coefs.shape[0] < 2:
+        # "<count> <dim>" header line
+        continue
+      vectors[values[0]] = coefs
+      if len(vectors) == len(needed):
+        break
+  dim = len(next(iter(vectors.values()))) if vectors else 300
+
+  embedding = np.zeros((vocab_size, dim), dtype=np.float32)
+  for word, i in word_to_id.items():
+    embedding_vector = vectors.get(word)
+    if embedding_vector is None:
+      embedding_vector = np.zeros(dim, dtype=np.float32)
+      for character in word:
+        if character in vectors:
+          embedding_vector = embedding_vector + vectors[character]
+      embedding_vector = embedding_vector / max(len(word), 1)
+    embedding[i] = embedding_vector
+  return embedding
+
+
+def load_embedding(embeddingf, word_to_id, vocab_size, cache_dir="./"):
+  """Returns the embedding matrix, memory-mapped from the .npy cache.
+
+  The cache file is built from `embeddingf` on first use.
+  """
+  path = os.path.join(
+      cache_dir, "embedding_%s.npy" % vocab_hash(word_to_id, embeddingf))
+  if not os.path.exists(path):
+    print("Building Embedding Cache %s..." % path)
+    embedding = build_embedding(embeddingf, word_to_id, vocab_size)
+    tmp_path = path + ".tmp.%d" % os.getpid()
+    with open(tmp_path, "wb") as f:
+      np.save(f, embedding)
+    os.rename(tmp_path, path)
+  print("Loading Embedding %s" % path)
+  return np.load(path, mmap_mode="r")
@@ -0,0 +1,99 @@
+"""Where the time of a training step goes: input wait, compute, host overhead."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import csv
+import time
+
+import tensorflow as tf
+
+
+class StepInstrument(object):
+  """Times training steps and input preparation, to CSV and TensorBoard.
+
+  Every `every`-th step, run_epoch dequeues the batch in a session.run of
+  its own and then feeds it to the step. This times the queue wait apart
+  from the step compute. Overhead is the rest of the step's wall time:
+  building feed_dict, copying states, bookkeeping and printing. Other steps
+  are timed as a whole. The readers add shard load and error-injection
+  times through event(). The means since the last summarize() go to
+  summary_writer, next to the Training Loss and Learning Rate summaries.
+  """
+
+  FIELDS = ["time", "kind", "name", "step", "seconds", "dequeue", "compute",
+            "overhead"]
+
+  def __init__(self, csv_path, summary_writer=None, every=1):
+    self.summary_writer = summary_writer
+    self._every = max(1, every)
+    self._file = open(csv_path, "a")
+    self._writer = csv.DictWriter(self._file, self.FIELDS)
+    if self._file.tell() == 0:
+      self._writer.writeheader()
+    self._step = 0
+    self._totals = collections.defaultdict(float)
+    self._counts = collections.defaultdict(int)
+
+  def dequeue(self, session, model, feed_dict):
+    """Dequeues the next batch into feed_dict on sampled steps.
+
+    Returns the seconds spent waiting for it, or None when the step is not
+    sampled or the input tensors are not in the session's graph.
+    """
+    if self._step % self._every:
+      return None
+    graph = session.graph
+    inputs = [model.input.input_data, model.input.targets, model.input.seq_length]
+    try:
+      inputs = [graph.get_tensor_by_name(t.name) if t.graph is not graph else t
+                for t in inputs]
+    except (KeyError, ValueError):
+      return None
+    start_time = time.time()
+    values = session.run(inputs)
+    feed_dict.update(zip(inputs, values))
+    return time.time() - start_time
+
+  def record(self, name, dequeue, compute, total):
+    """One step: dequeue wait (None if not split off), session.run, wall time."""
+    row = {"time": "%.3f" % time.time(), "kind": "step", "name": name,
+           "step": self._step, "seconds": "%.6f" % total,
+           "compute": "%.6f" % compute}
+    self._add(name + "/step", total)
+    self._add(name + "/compute", compute)
+    if dequeue is not None:
+      overhead = total - compute - dequeue
+      row["dequeue"] = "%.6f" % dequeue
+      row["overhead"] = "%.6f" % overhead
+      self._add(name + "/dequeue", dequeue)
+      self._add(name + "/overhead", overhead)
+    self._writer.writerow(row)
+    self._step += 1
+
+  def event(self, kind, index, seconds):
+    """A one-off cost outside the steps, such as shard_load or corruption."""
+    self._writer.writerow({"time": "%.3f" % time.time(), "kind": kind,
+                           "name": index, "step": self._step,
+                           "seconds": "%.6f" % seconds})
+    self._add(kind, seconds)
+
+  def _add(self, tag, seconds):
+    self._totals[tag] += seconds
+    self._counts[tag] += 1
+
+  def summarize(self, global_step):
+    """Writes the mean of every timing since the last call, in ms."""
+    self._file.flush()
+    if self.summary_writer is not None and self._counts:
+      summary = tf.Summary()
+      for tag in sorted(self._counts):
+        summary.value.add(tag="Timing/%s_ms" % tag,
+                          simple_value=1000.0 * self._totals[tag] / self._counts[tag])
+      self.summary_writer.add_summary(summary, global_step)
+    self._totals.clear()
+    self._counts.clear()
+
+  def close(self):
+    self._file.close()
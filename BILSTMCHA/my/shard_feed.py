@@ -0,0 +1,79 @@
+"""Training batches fed from numpy into one long-lived graph."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+
+class ShardFeed(object):
+  """PTBInput whose batches are fed through placeholders, shard after shard.
+
+  reader.ptb_producer folds its arrays into graph constants, so a model
+  built on it trains the shard it was built with and no other. The model
+  of a ShardFeed is built once; set() hands it the next shard, laid out as
+  ptb_producer lays one out: [batch_size, batch_len], batch i the columns
+  i*num_steps to (i+1)*num_steps. batch(step) is the feed_dict of one
+  step, the batches of a pass in a shuffled order as range_input_producer
+  gives them. The feed is keyed by tensor name, so it also fits a copy of
+  the graph brought back by import_meta_graph.
+
+  With labels None the targets are the ids shifted by one, as the language
+  models read them; otherwise labels is the shape [num_steps] + extra of
+  the targets of a row, and set() takes them as their own array.
+  """
+
+  def __init__(self, batch_size, num_steps, labels=None, label_dtype=tf.int32,
+               column=False, name=None):
+    self.batch_size = batch_size
+    self.num_steps = num_steps
+    self._labels = labels
+    self._column = column
+    with tf.name_scope(name, "ShardFeed"):
+      self.input_data = tf.placeholder(tf.int32, [batch_size, num_steps], name="input_data")
+      self.targets = tf.placeholder(
+          label_dtype, [batch_size] + (labels or [num_steps]), name="targets")
+      self.seq_length = tf.placeholder(
+          tf.int32, [batch_size, 1] if column else [batch_size], name="seq_length")
+    self._names = (self.input_data.name, self.targets.name, self.seq_length.name)
+    self.epoch_size = 0
+    self._rng = None
+    self._order = None
+
+  def set(self, data, sequence_length, targets=None, seed=None):
+    """Trains on data from now on; targets is [rows*num_steps, ...] when labelled."""
+    batch_len = np.size(data) // self.batch_size
+    self._data = np.reshape(data, [-1])[:self.batch_size * batch_len].reshape(
+        self.batch_size, batch_len)
+    if self._labels is not None:
+      extra = list(self._labels[1:])
+      self._targets = np.reshape(targets, [-1] + extra)[:self.batch_size * batch_len].reshape(
+          [self.batch_size, batch_len] + extra)
+      self.epoch_size = batch_len // self.num_steps
+    else:
+      # the targets of the last step reach one id further
+      self._targets = None
+      self.epoch_size = (batch_len - 1) // self.num_steps
+    rows = batch_len // self.num_steps
+    self._seq_length = np.reshape(sequence_length, [-1])[:self.batch_size * rows].reshape(
+        self.batch_size, rows)
+    if self.epoch_size <= 0:
+      raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
+    self._rng = np.random.RandomState(seed)
+    self._order = None
+
+  def batch(self, step):
+    """feed_dict of the step-th batch of the current pass."""
+    if step == 0 or self._order is None:
+      self._order = self._rng.permutation(self.epoch_size)
+    i = self._order[step]
+    start, stop = i * self.num_steps, (i + 1) * self.num_steps
+    if self._targets is None:
+      targets = self._data[:, start + 1:stop + 1]
+    else:
+      targets = self._targets[:, start:stop]
+    seq_length = self._seq_length[:, i]
+    if self._column:
+      seq_length = seq_length[:, None]
+    return dict(zip(self._names, (self._data[:, start:stop], targets, seq_length)))
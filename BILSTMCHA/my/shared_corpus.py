@@ -0,0 +1,105 @@
+"""Decoded corpus shards in shared memory, one copy for every trainer.
+
+Publish the shards once, from the directory holding cha_to_id.txt:
+
+$ python -m my.shared_corpus --data_path ./corpus/ --shards 84 --prefix corpus
+
+then start any number of trainers with --shm_prefix corpus. They attach the
+shards read-only and fall back to the files for shards that are not
+published. The publisher keeps the segments alive until it is interrupted.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+try:
+  from multiprocessing import resource_tracker
+  from multiprocessing import shared_memory
+except ImportError:
+  raise ImportError("--shm_prefix and my/shared_corpus.py need Python 3.8 or "
+                    "later for multiprocessing.shared_memory")
+
+import numpy as np
+
+# int64 [rows, data size], then int32 sequence_length[rows], int32 data[size]
+_HEADER_BYTES = 16
+
+# attached segments, kept open as long as the arrays viewing them live
+_segments = {}
+# segments created by this process
+_published = set()
+
+
+def segment_name(prefix, index):
+  return "%s_%02d" % (prefix, int(index))
+
+
+def publish(prefix, index, data, sequence_length):
+  """Copies one decoded shard into a new shared memory segment."""
+  rows = sequence_length.shape[0]
+  shm = shared_memory.SharedMemory(
+      name=segment_name(prefix, index), create=True,
+      size=_HEADER_BYTES + 4 * rows + 4 * data.size)
+  np.ndarray((2,), np.int64, shm.buf)[:] = (rows, data.size)
+  np.ndarray((rows,), np.int32, shm.buf, offset=_HEADER_BYTES)[:] = (
+      sequence_length)
+  np.ndarray((data.size,), np.int32, shm.buf,
+             offset=_HEADER_BYTES + 4 * rows)[:] = data.reshape(-1)
+  _published.add(shm.name)
+  return shm
+
+
+def attach(prefix, index):
+  """Read-only (data, sequence_length) views of a published shard, or None."""
+  name = segment_name(prefix, index)
+  if name not in _segments:
+    try:
+      shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+      return None
+    if shm.name not in _published:
+      # the publisher owns the segment, do not unlink it when this process exits
+      resource_tracker.unregister(shm._name, "shared_memory")
+    _segments[name] = shm
+  shm = _segments[name]
+  rows, size = np.ndarray((2,), np.int64, shm.buf)
+  sequence_length = np.ndarray((rows,), np.int32, shm.buf,
+                               offset=_HEADER_BYTES)
+  data = np.ndarray((size,), np.int32, shm.buf,
+                    offset=_HEADER_BYTES + 4 * rows)
+  sequence_length.flags.writeable = False
+  data.flags.writeable = False
+  return data, sequence_length
+
+
+def main():
+  from my import reader
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--data_path", default="./corpus/")
+  parser.add_argument("--shards", type=int, default=84)
+  parser.add_argument("--prefix", default="corpus")
+  args = parser.parse_args()
+
+  published = []
+  try:
+    for index in range(args.shards):
+      data, sequence_length = reader._read_shard(args.data_path, index)
+      published.append(publish(args.prefix, index, data, sequence_length))
+      print("Published %s: %d rows" % (segment_name(args.prefix, index),
+                                       sequence_length.shape[0]))
+    print("Serving %d shards, interrupt to unpublish." % len(published))
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for shm in published:
+      shm.close()
+      shm.unlink()
+
+
+if __name__ == "__main__":
+  main()
@@ -17,6 +17,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import multiprocessing
+import subprocess
+import sys
+import time
+
+import numpy as np
 import tensorflow as tf
 
 from tensorflow.core.framework import variable_pb2
@@ -93,4 +100,167 @@ def auto_parallel(metagraph, model):
   rewriter_config.auto_parallel.num_replicas = FLAGS.num_gpus
   optimized_graph = tf_optimizer.OptimizeGraph(rewriter_config, metagraph)
   metagraph.graph_def.CopyFrom(optimized_graph)
-  UpdateCollection(metagraph, model)
\ No newline at end of file
+  UpdateCollection(metagraph, model)
+
+
+def local_cluster(num_workers, ps_port):
+  """One parameter server and num_workers workers, all on localhost."""
+  return tf.train.ClusterSpec({
+      "ps": ["localhost:%d" % ps_port],
+      "worker": ["localhost:%d" % (ps_port + 1 + i)
+                 for i in range(num_workers)]})
+
+
+def worker_config(num_workers):
+  """Splits the cores of the machine evenly between the worker processes."""
+  threads = max(1, multiprocessing.cpu_count() // max(1, num_workers))
+  return tf.ConfigProto(allow_soft_placement=True,
+                        intra_op_parallelism_threads=threads,
+                        inter_op_parallelism_threads=threads)
+
+
+def launch_local_cluster(num_workers):
+  """Re-runs the current script as a parameter server and its workers."""
+  argv = [sys.executable] + sys.argv
+  ps = subprocess.Popen(argv + ["--job_name=ps", "--task_index=0"])
+  workers = [subprocess.Popen(argv + ["--job_name=worker",
+                                      "--task_index=%d" % i])
+             for i in range(num_workers)]
+  returncode = 0
+  for worker in workers:
+    returncode = worker.wait() or returncode
+  ps.terminate()
+  ps.wait()
+  return returncode
+
+
+def worker_slice(data, seq_length, num_steps, task_index, num_workers):
+  """Rows of a shard trained by one worker.
+
+  Every worker gets the same number of rows, so all of them run the same
+  number of synchronous steps.
+  """
+  rows = np.reshape(data, [-1, num_steps])
+  count = (rows.shape[0] // num_workers) * num_workers
+  return (rows[task_index:count:num_workers].reshape(-1),
+          seq_length[task_index:count:num_workers])
+
+
+def embed_ids(embedding, ids):
+  """embedding_lookup in which ids past the table read as zero vectors.
+
+  Such ids are reader.unknown_id(), the characters outside cha_to_id.txt,
+  so that they read neither as one known character nor as the padding.
+  """
+  known = tf.less(ids, tf.shape(embedding)[0])
+  inputs = tf.nn.embedding_lookup(embedding, tf.where(known, ids, tf.zeros_like(ids)))
+  return inputs * tf.expand_dims(tf.cast(known, inputs.dtype), -1)
+
+
+class SyncReplicas(object):
+  """Supervisor setup for SyncReplicasOptimizer workers.
+
+  Must be created before the graph is finalized. With sync_optimizer None
+  it is a plain single-process Supervisor. The training inputs are fed, so
+  the Supervisor runs no summary thread of its own; the trainer writes the
+  summaries with summary_computed.
+  """
+
+  def __init__(self, sync_optimizer, is_chief, logdir):
+    self._sync_optimizer = sync_optimizer
+    self.is_chief = is_chief
+    if sync_optimizer is None:
+      self.supervisor = tf.train.Supervisor(logdir=logdir, summary_op=None)
+      return
+    if is_chief:
+      local_init_op = sync_optimizer.chief_init_op
+      self._init_tokens_op = sync_optimizer.get_init_tokens_op()
+      self._chief_queue_runner = sync_optimizer.get_chief_queue_runner()
+    else:
+      local_init_op = sync_optimizer.local_step_init_op
+    self.supervisor = tf.train.Supervisor(
+        logdir=logdir if is_chief else None,
+        is_chief=is_chief,
+        local_init_op=tf.group(local_init_op,
+                               tf.local_variables_initializer()),
+        ready_for_local_init_op=sync_optimizer.ready_for_local_init_op,
+        summary_op=None,
+        recovery_wait_secs=1)
+
+  def start(self, session):
+    """Hands out the first gradient tokens, on the chief only."""
+    if self._sync_optimizer is not None and self.is_chief:
+      session.run(self._init_tokens_op)
+      self.supervisor.start_queue_runners(session, [self._chief_queue_runner])
+
+
+class SharedMonitor(object):
+  """The chief's DevMonitor decisions, handed to the other workers.
+
+  Only the chief evaluates, so only its monitor knows when to stop and
+  which shards an outer epoch samples. Every worker calls decide() at the
+  same points of the loops, with the same count: the chief writes its
+  shard order and stop flag to variables on the parameter servers, and
+  every worker waits until that count is written and reads them back.
+  Create it under the replica device setter, before SyncReplicas.
+  """
+
+  def __init__(self, num_shards, poll_seconds=0.5):
+    self._poll_seconds = poll_seconds
+    with tf.name_scope("SharedMonitor"):
+      self._count = tf.Variable(0, trainable=False, name="count")
+      self._order = tf.Variable(tf.ones([num_shards], tf.bool), trainable=False, name="order")
+      self._stop = tf.Variable(False, trainable=False, name="stop")
+      self._new_count = tf.placeholder(tf.int32, [], name="new_count")
+      self._new_order = tf.placeholder(tf.bool, [num_shards], name="new_order")
+      self._new_stop = tf.placeholder(tf.bool, [], name="new_stop")
+      self._publish = tf.group(tf.assign(self._count, self._new_count),
+                               tf.assign(self._order, self._new_order),
+                               tf.assign(self._stop, self._new_stop))
+    self._num_shards = num_shards
+    self._decisions = 0
+
+  def decide(self, session, is_chief, order, should_stop):
+    """(shard order, stop) of the chief; order and should_stop are the caller's."""
+    self._decisions += 1
+    if is_chief:
+      chosen = np.zeros(self._num_shards, dtype=bool)
+      chosen[list(order)] = True
+      session.run(self._publish, {self._new_count: self._decisions,
+                                  self._new_order: chosen,
+                                  self._new_stop: should_stop})
+    while True:
+      count, chosen, stop = session.run([self._count, self._order, self._stop])
+      if count >= self._decisions or stop:
+        return [int(i) for i in np.flatnonzero(chosen)], bool(stop)
+      time.sleep(self._poll_seconds)
+
+
+def restore_for_inference(session, save_path):
+  """Restores the variables of the default graph from the latest checkpoint.
+
+  Meant for graphs holding only forward models, is_training=False: the
+  saver then covers the weights alone and the learning rate, global step
+  and optimizer slots of the training checkpoint stay on disk.
+  """
+  checkpoint = tf.train.latest_checkpoint(save_path)
+  if checkpoint is None:
+    raise ValueError("No checkpoint in %s" % save_path)
+  tf.train.Saver(tf.global_variables()).restore(session, checkpoint)
+  return checkpoint
+
+
+@contextlib.contextmanager
+def inference_session(save_path, config=None):
+  """Session over the default graph, weights restored, input queues running."""
+  with tf.Session(config=config) as session:
+    session.run(tf.local_variables_initializer())
+    print("Restored %s" % restore_for_inference(session, save_path))
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(session, coord)
+    try:
+      yield session
+    finally:
+      coord.request_stop()
+      coord.join(threads)
+
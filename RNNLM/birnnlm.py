@@ -6,6 +6,16 @@ import tensorflow as tf
 from my import reader
 #import reader
 from my import util
+from my import embedding
+from my import shard_cache
+from my import shard_feed
+from my import resume
+from my import background
+from my import instrument
+from my import profiling
+from my import memwatch
+from my import freeze
+from my import candidates
 import os
 from tensorflow.python.client import device_lib
 import predict_result
@@ -14,7 +24,7 @@ flags = tf.flags
 logging = tf.logging
 
 flags.DEFINE_string("model", "train",
-    "A type of model. Possible options are: train, test.")
+    "A type of model. Possible options are: train, test, freeze, candidates.")
 flags.DEFINE_string("data_path", "./corpus/",
                     "Where the training/test data is stored.")
 flags.DEFINE_string("save_path", "./model/model_total_bi_no_emb/",
@@ -23,6 +33,56 @@ flags.DEFINE_string("test_path", "./test/new_test",
                     "Model test file.")
 flags.DEFINE_bool("use_fp16", False,
                   "Train using 16-bit floats instead of 32bit floats")
+flags.DEFINE_bool("lazy_adam", False,
+                  "Use LazyAdam, which updates the Adam moments of the "
+                  "embedding only for the ids in the batch.")
+flags.DEFINE_bool("stateless", False,
+                  "Start every batch from the zero LSTM state instead of "
+                  "feeding back the previous final state.")
+flags.DEFINE_integer("num_workers", 1,
+                     "If larger than 1, train synchronously with this many "
+                     "local worker processes and one parameter server.")
+flags.DEFINE_string("job_name", "",
+                    "Set by the launcher: ps or worker.")
+flags.DEFINE_integer("task_index", 0, "Set by the launcher: worker index.")
+flags.DEFINE_integer("ps_port", 2222,
+                     "Port of the local parameter server, workers use the "
+                     "following ports.")
+flags.DEFINE_string("shm_prefix", "",
+                    "Attach training shards published by my/shared_corpus.py "
+                    "under this name prefix instead of reading the files.")
+flags.DEFINE_integer("shard_cache_mb", 0,
+                     "Keep up to this many MB of decoded shards in memory "
+                     "across outer epochs, 0 disables the cache.")
+flags.DEFINE_string("shard_spill_dir", "",
+                    "Spill shards evicted from the shard cache to .npy files "
+                    "in this directory.")
+flags.DEFINE_bool("async_eval", False,
+                  "Snapshot the weights after every shard and leave checkpointing "
+                  "and test evaluation to a background thread.")
+flags.DEFINE_string("instrument_csv", "",
+                    "Append per-step input wait, compute and overhead times, "
+                    "shard load and error-injection times to this CSV file.")
+flags.DEFINE_integer("instrument_every", 1,
+                     "Split the input wait off every this many training steps.")
+flags.DEFINE_string("profile_steps", "",
+                    "Trace these run_epoch steps, counted per train/eval pass "
+                    "over the run, e.g. \"100,200-202\".")
+flags.DEFINE_string("profile_dir", "./profile/",
+                    "Where traced steps write Chrome-trace timelines and op tables.")
+flags.DEFINE_string("memwatch", "",
+                    "Time the reader, producer and evaluation stages and print "
+                    "their memory watermarks after every shard: \"rss\", or "
+                    "\"trace\" to add tracemalloc peaks.")
+flags.DEFINE_integer("freeze_batch_size", 64,
+                     "Batch size of the graph written by --model freeze, and of --model candidates.")
+flags.DEFINE_string("similar_path", "./similarList.txt",
+                    "Similar characters scored by --model candidates.")
+flags.DEFINE_integer("max_candidates", 0,
+                     "Candidates per character for --model candidates, the character "
+                     "included; 0 scores all of its similar characters.")
+flags.DEFINE_string("embedding_path", "../Keras/w2c_financial.txt",
+                    "Pre-trained word2vec text file, cached as embedding_<hash>.npy.")
 flags.DEFINE_bool("pretrained_embedding", False, "Determing whether to use pre-trained embedding or not")
 flags.DEFINE_integer("num_gpus", 1,
                      "If larger than 1, Grappler AutoParallel optimizer "
@@ -33,6 +93,10 @@ flags.DEFINE_string("rnn_mode", "BLOCK",
                     "BASIC, and BLOCK, representing cudnn_lstm, basic_lstm, "
                     "and lstm_block_cell classes.")
 FLAGS = flags.FLAGS
+# my/instrument.StepInstrument when --instrument_csv is set
+timings = None
+# my/profiling.StepProfiler when --profile_steps is set
+profiler = None
 BASIC = "basic"
 CUDNN = "cudnn"
 BLOCK = "block"
@@ -59,6 +123,7 @@ class PTBModel(object):
     self._input = input_
     self._rnn_params = None
     self._cell = None
+    self.sync_optimizer = None
     self.batch_size = input_.batch_size
     self.num_steps = input_.num_steps
     self.hidden_size = config.hidden_size
@@ -70,12 +135,9 @@ class PTBModel(object):
       if FLAGS.pretrained_embedding == False:
        self.embedding = tf.get_variable(name = "embedding", shape = [self.vocab_size, self.embedding_size], initializer = tf.truncated_normal_initializer, dtype=tf.float32)
       else:
-        if os.path.exists("./embedding.txt"):
-          self.loadEmbedding()
-        else:
-          self.usePreEmbedding("../Keras/w2c_financial.txt")
+        self.usePreEmbedding(FLAGS.embedding_path)
         self.embedding = tf.get_variable(name = "embedding", initializer=tf.convert_to_tensor(self.embedding), dtype=tf.float32)
-      inputs = tf.nn.embedding_lookup(self.embedding, input_.input_data)
+      inputs = util.embed_ids(self.embedding, input_.input_data)
 
     # get predict word's distribution
     output, state = self._build_rnn_graph(inputs, config, is_training)
@@ -95,6 +157,9 @@ class PTBModel(object):
     self._final_state_bw = state[1]
 
     self.logits = tf.nn.softmax(logits)
+    self._candidates = self._candidate_logprob = None
+    if config.score_candidates:
+      self._build_candidate_graph(output, logits, config)
 
     if not is_training:
       return
@@ -111,7 +176,16 @@ class PTBModel(object):
     self._lr = tf.Variable(0.0, trainable=False)
     tvars = tf.trainable_variables()
     grads, _ = tf.clip_by_global_norm(tf.gradients(self._cost, tvars), config.max_grad_norm)
-    optimizer = tf.train.AdamOptimizer(self._lr)
+    if FLAGS.lazy_adam:
+      # only the embedding rows seen in the batch get their moments updated
+      optimizer = tf.contrib.opt.LazyAdamOptimizer(self._lr)
+    else:
+      optimizer = tf.train.AdamOptimizer(self._lr)
+    if FLAGS.num_workers > 1:
+      # average the gradients of all workers before every update
+      optimizer = self.sync_optimizer = tf.train.SyncReplicasOptimizer(
+          optimizer, replicas_to_aggregate=FLAGS.num_workers,
+          total_num_replicas=FLAGS.num_workers)
     self._train_op = optimizer.apply_gradients(
         zip(grads, tvars),
         global_step=tf.train.get_or_create_global_step())
@@ -120,48 +194,43 @@ class PTBModel(object):
     self._lr_update = tf.assign(self._lr, self._new_lr)
 
 
-  def resetInput(self, input_):
-    self._input = input_
-
-  def usePreEmbedding(self, embeddingf ,save = True):
-    # use pre-trained embedding
+  def usePreEmbedding(self, embeddingf):
+    # use pre-trained embedding, cached as a .npy file keyed by vocabulary
     print("Using Pre-trained Embedding...")
-    embedding_dict = {}
-    f = codecs.open(embeddingf, "r", encoding="utf8",errors='ignore')
-    for line in f:
-      values = line.split()
-      word = values[0]
-      coefs = asarray(values[1:],dtype='float32')
-      embedding_dict[word] = coefs
-    f.close()
-    self.embedding = zeros( (self.vocab_size, 300), dtype=float32)
-    for word, i in reader.word_to_id.items():
-      embedding_vector = embedding_dict.get(word)
-      if embedding_vector is  None:
-        embedding_vector = zeros((1,300), dtype=float32)
-        for character in word:
-          if character in embedding_dict:
-            embedding_vector = embedding_vector + embedding_dict.get(character)
-        embedding_vector = embedding_vector / len(word)
-      self.embedding[i] = embedding_vector
-    if save == True:
-      self.saveEmebdding()
-  
-  def saveEmebdding(self):
-    print("Saving Embedding...")
-    ff = open("./embedding.txt","wb")
-    for i in self.embedding:
-      savetxt(ff,i,fmt="%f")
-    ff.close()
-    print("Saving Embedding Finish")
-
-  def loadEmbedding(self):
-    print("Loading Embedding...")
-    self.embedding = []
-    self.embedding  = loadtxt("./embedding.txt", dtype = float32)
-    self.embedding = reshape(self.embedding,[-1,300])
-    self.vocab_size = self.embedding.shape[0]
-    print("Loading Embedding Finish")
+    self.embedding = embedding.load_embedding(embeddingf, reader.word_to_id, self.vocab_size)
+
+  def _build_candidate_graph(self, output, logits, config):
+    """Scores only the ids fed through `candidates`, for my/candidates.py.
+
+    `candidates` is [batch_size, num_steps, k]; `candidate_logprob[b, t, j]`
+    scores candidates[b, t, j] at output step t from the k gathered rows of
+    the output projection alone. config.candidate_normalizer picks what the
+    score is normalized over: "candidates", the default, gives log p of
+    each candidate within its position's candidate set; "none" leaves the
+    raw logits, which rank the candidates the same way; "exact" gives the
+    full log p, but needs the whole vocab_size projection for its logsumexp
+    and so is no faster than the full softmax.
+    """
+    self._candidates = tf.placeholder(
+        tf.int32, [self.batch_size, self.num_steps, None], name="candidates")
+    with tf.variable_scope("fully_connected", reuse=True):
+      softmax_w = tf.get_variable("weights")
+      softmax_b = tf.get_variable("biases")
+    # rows of the projection, [batch, steps, k, hidden*2]
+    candidate_w = tf.gather(tf.transpose(softmax_w), self._candidates)
+    output = tf.reshape(output, [self.batch_size, self.num_steps, -1])
+    candidate_logits = tf.einsum("btkh,bth->btk", candidate_w, output)
+    candidate_logits += tf.gather(softmax_b, self._candidates)
+    if config.candidate_normalizer == "candidates":
+      candidate_logits -= tf.expand_dims(
+          tf.reduce_logsumexp(candidate_logits, axis=-1), -1)
+    elif config.candidate_normalizer == "exact":
+      candidate_logits -= tf.expand_dims(
+          tf.reduce_logsumexp(logits, axis=-1), -1)
+    elif config.candidate_normalizer != "none":
+      raise ValueError("candidate_normalizer %s not supported"
+                       % config.candidate_normalizer)
+    self._candidate_logprob = candidate_logits
 
   def _build_rnn_graph(self, inputs, config, is_training):
     return self._build_rnn_graph_lstm(inputs, config, is_training)
@@ -170,7 +239,7 @@ class PTBModel(object):
     if config.rnn_mode == BASIC:
       return tf.contrib.rnn.BasicLSTMCell(
           config.hidden_size, forget_bias=0.0, state_is_tuple=True,
-          reuse= not is_training)
+          reuse=tf.get_variable_scope().reuse)
     if config.rnn_mode == BLOCK:
       return tf.contrib.rnn.LSTMBlockCell(
           config.hidden_size, forget_bias=0.0)
@@ -216,6 +285,14 @@ class PTBModel(object):
   @property
   def output(self):
     return self.logits
+
+  @property
+  def candidates(self):
+    return self._candidates
+
+  @property
+  def candidate_logprob(self):
+    return self._candidate_logprob
   
   @property
   def cost(self):
@@ -257,6 +334,10 @@ class MediumConfig(object):
   num_steps = 47
   vocab_size = 9174
   rnn_mode = BLOCK
+  # "candidates", "none" or "exact", see PTBModel._build_candidate_graph
+  candidate_normalizer = "candidates"
+  # set by --model candidates
+  score_candidates = False
 
   def __str__(self):
     return ("batch_size: {}, learning_rate: {}, keep_prob: {}, max_grad_norm: {}, init_scale: {}, hidden_size: {}, embedding_size: {}, num_layers: {}".format(self.batch_size,self.learning_rate,self.keep_prob,self.max_grad_norm,self.init_scale,self.hidden_size,self.embedding_size,self.num_layers))
@@ -267,41 +348,61 @@ def run_epoch(session, model, eval_op=None, verbose=False, is_training=True, sav
   start_time = time.time()
   costs = 0.0
   iters = 0
-  state_fw, state_bw = session.run([model.initial_state_fw, model.initial_state_bw])
-
   if is_training == True:
     fetches = {
         "cost": model.cost,
-        "final_state_fw": model.final_state_fw,
-        "final_state_bw": model.final_state_bw,
         "logits": model.logits
     }
   else:
     fetches = {
-        "final_state_fw": model.final_state_fw,
-        "final_state_bw": model.final_state_bw,
         "logits": model.logits
     }
+  if FLAGS.stateless:
+    # rows are independent sentences, the graph starts from its zero state
+    state_fw = state_bw = None
+    if is_training == True:
+      del fetches["logits"]
+  else:
+    state_fw, state_bw = session.run([model.initial_state_fw, model.initial_state_bw])
+    fetches["final_state_fw"] = model.final_state_fw
+    fetches["final_state_bw"] = model.final_state_bw
   if eval_op is not None:
     fetches["eval_op"] = eval_op
   for step in range(model.input.epoch_size):
+    step_start = time.time()
     feed_dict = {}
-    for i, (c, h) in enumerate(model.initial_state_fw):
-      feed_dict[c] = state_fw[i].c
-      feed_dict[h] = state_fw[i].h
-
-    for i, (c, h) in enumerate(model.initial_state_bw):
-      feed_dict[c] = state_bw[i].c
-      feed_dict[h] = state_bw[i].h
-
-    vals = session.run(fetches, feed_dict)
+    if state_fw is not None:
+      for i, (c, h) in enumerate(model.initial_state_fw):
+        feed_dict[c] = state_fw[i].c
+        feed_dict[h] = state_fw[i].h
+
+      for i, (c, h) in enumerate(model.initial_state_bw):
+        feed_dict[c] = state_bw[i].c
+        feed_dict[h] = state_bw[i].h
+
+    dequeue = None
+    if isinstance(model.input, shard_feed.ShardFeed):
+      feed_start = time.time()
+      feed_dict.update(model.input.batch(step))
+      dequeue = time.time() - feed_start
+    elif timings is not None and eval_op is not None:
+      dequeue = timings.dequeue(session, model, feed_dict)
+    run_options, run_metadata = None, None
+    if profiler is not None:
+      run_options, run_metadata = profiler.options("train" if eval_op is not None else "eval")
+    run_start = time.time()
+    vals = session.run(fetches, feed_dict, options=run_options, run_metadata=run_metadata)
+    compute = time.time() - run_start
+    if run_metadata is not None:
+      profiler.collect("train" if eval_op is not None else "eval", run_metadata)
     
-    state_fw = vals["final_state_fw"]
-    state_bw = vals["final_state_bw"]
+    if state_fw is not None:
+      state_fw = vals["final_state_fw"]
+      state_bw = vals["final_state_bw"]
     iters += model.input.num_steps
-    result = vals["logits"] 
 
     if is_training==False:
+      result = vals["logits"]
       r1 = []
       for word in (result[0]):
         for backup in word:
@@ -316,10 +417,13 @@ def run_epoch(session, model, eval_op=None, verbose=False, is_training=True, sav
       costs += cost
 
     if verbose and step % (model.input.epoch_size // 10) == 10:
-      print("%.3f perplexity: %.3f speed: %.0f wps" %
+      print("%.3f perplexity: %.3f speed: %.0f wps %.2f steps/s" %
             (step * 1.0 / model.input.epoch_size, np.exp(costs / iters),
              iters * model.input.batch_size * max(1, FLAGS.num_gpus) /
-             (time.time() - start_time)))
+             (time.time() - start_time),
+             (step + 1) / (time.time() - start_time)))
+    if timings is not None and eval_op is not None:
+      timings.record("train", dequeue, compute, time.time() - step_start)
 
   return np.exp(costs / iters)
 
@@ -329,6 +433,10 @@ def get_config():
   mode = 0
   if FLAGS.model == "test":
     mode = 1
+  elif FLAGS.model == "freeze":
+    mode = 2
+  elif FLAGS.model == "candidates":
+    mode = 3
   if FLAGS.rnn_mode:
     temconfig.rnn_mode = FLAGS.rnn_mode
   if FLAGS.num_gpus != 1 or tf.__version__ < "1.3.0" :
@@ -337,8 +445,18 @@ def get_config():
 
 
 def main(_):
+  global timings, profiler
   if not FLAGS.data_path:
     raise ValueError("Must set --data_path to PTB data directory")
+  reader.shm_prefix = FLAGS.shm_prefix or None
+  if FLAGS.shard_cache_mb > 0 or FLAGS.shard_spill_dir:
+    reader.shard_cache = shard_cache.ShardCache(FLAGS.shard_cache_mb * 2**20, FLAGS.shard_spill_dir or None)
+  if FLAGS.instrument_csv:
+    timings = reader.timings = instrument.StepInstrument(FLAGS.instrument_csv, every=FLAGS.instrument_every)
+  if FLAGS.profile_steps:
+    profiler = profiling.StepProfiler(profiling.parse_steps(FLAGS.profile_steps), FLAGS.profile_dir)
+  if FLAGS.memwatch:
+    memwatch.watch = memwatch.MemWatch(trace=FLAGS.memwatch == "trace")
   gpus = [
       x.name for x in device_lib.list_local_devices() if x.device_type == "GPU"
   ]
@@ -354,56 +472,141 @@ def main(_):
   eval_config.batch_size = 1
 
   if mode == 0:
+    if FLAGS.num_workers > 1 and not FLAGS.job_name:
+      return util.launch_local_cluster(FLAGS.num_workers)
+    server = None
+    device = None
+    is_chief = True
+    config_proto = tf.ConfigProto(allow_soft_placement=True)
+    if FLAGS.job_name:
+      cluster = util.local_cluster(FLAGS.num_workers, FLAGS.ps_port)
+      config_proto = util.worker_config(FLAGS.num_workers)
+      server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index, config=config_proto)
+      if FLAGS.job_name == "ps":
+        server.join()
+        return
+      is_chief = FLAGS.task_index == 0
+      device = tf.train.replica_device_setter(worker_device="/job:worker/task:%d" % FLAGS.task_index, cluster=cluster)
+
     # train mod
     print("Enter Train Mode:")
-    train_data,train_seq_length = reader.ptb_raw_data(FLAGS.data_path, is_training = True, index = 0)
+    state = resume.load(FLAGS.save_path)
     test_data,test_seq_length = reader.ptb_raw_data(FLAGS.test_path, is_training = False)
-    with tf.Graph().as_default():
+    with tf.Graph().as_default(), tf.device(device):
       initializer = tf.random_uniform_initializer(-config.init_scale, config.init_scale)
       with tf.name_scope("Train"):
-        train_input = PTBInput(config=config, data=train_data, seq_length= train_seq_length, name="TrainInput")
+        # every shard is fed to this one graph, see my/shard_feed.py
+        train_input = shard_feed.ShardFeed(config.batch_size, config.num_steps, name="TrainInput")
         with tf.variable_scope("Model", reuse=None , initializer=initializer) as scope:
           m = PTBModel(is_training=True, config=config, input_=train_input)
           scope.reuse_variables()
         tf.summary.scalar("Training Loss", m.cost)
         tf.summary.scalar("Learning Rate", m.lr)
+        summary_op = tf.summary.merge_all()
 
       with tf.name_scope("Test"):
         test_input = PTBInput(config=eval_config, data=test_data, seq_length = test_seq_length, name="TestInput")
         with tf.variable_scope("Model", reuse=True , initializer=initializer) as scope:
           testm = PTBModel(is_training=False, config=eval_config, input_=test_input)
 
-      sv = tf.train.Supervisor(logdir=FLAGS.save_path)
-      config_proto = tf.ConfigProto(allow_soft_placement=True)
-      with sv.managed_session(config=config_proto) as session:
+      def evaluate(session, testm, position):
+        total_epoch, train_round, i = position
+        length = reader.length
+        print(length)
+        for sublength in range(length):
+          run_epoch(session,testm, is_training = False)
+        predict_result.saveResult(train_round, test_path = FLAGS.test_path, config = config, describ = FLAGS.save_path)
+
+      evaluator = None
+      if FLAGS.async_eval and is_chief:
+        # a test model of its own, loaded from each snapshot
+        eval_graph = tf.Graph()
+        with eval_graph.as_default():
+          with tf.name_scope("Test"):
+            eval_test_input = PTBInput(config=eval_config, data=test_data, seq_length = test_seq_length, name="TestInput")
+            with tf.variable_scope("Model", reuse=None):
+              eval_testm = PTBModel(is_training=False, config=eval_config, input_=eval_test_input)
+        evaluator = background.BackgroundEvaluator(
+            tf.global_variables(), eval_graph,
+            lambda session, position, data: evaluate(session, eval_testm, position),
+            save_path=FLAGS.save_path, config=config_proto)
+
+      sync = util.SyncReplicas(m.sync_optimizer, is_chief, FLAGS.save_path)
+      sv = sync.supervisor
+      if timings is not None:
+        timings.summary_writer = sv.summary_writer
+      with sv.managed_session(server.target if server else "", config=config_proto) as session:
+        sync.start(session)
+        if is_chief:
+          resume.restore(session, sv.saver, state)
         for total_epoch in range(config.max_max_max_epoch):
           for train_round in range(14):
+            if resume.done(state, total_epoch, train_round, config.max_max_epoch - 1):
+              continue
             print("=================")
             print("Now Training index: %d"%train_round)
 
-            tf.reset_default_graph()
             train_data,train_seq_length = reader.ptb_raw_data(FLAGS.data_path, is_training = True, index = train_round)
-            train_input = PTBInput(config=config, data=train_data, seq_length= train_seq_length, name="TrainInput")
-            m.resetInput(train_input)
+            if server is not None:
+              train_data,train_seq_length = util.worker_slice(train_data, train_seq_length, config.num_steps, FLAGS.task_index, FLAGS.num_workers)
+            train_input.set(train_data, train_seq_length, seed = train_round)
             
             for i in range(config.max_max_epoch):
+              if resume.done(state, total_epoch, train_round, i):
+                continue
               lr_decay = config.lr_decay ** max(i + 1 - config.max_epoch, 0.0)
               m.assign_lr(session, config.learning_rate * lr_decay)
               print("Epoch: %d Learning rate: %.3f" % (i + 1, session.run(m.lr)))
               train_perplexity = run_epoch(session, m, eval_op=m.train_op, verbose=True)
               print("Epoch: %d Train Perplexity: %.3f" % (i + 1, train_perplexity))
-            
-              length = reader.length
-              #save_file = open("./result_proba_"+str(train_round)+".txt","w")
-              print(length)
-              for sublength in range(length):
-                run_epoch(session,testm, is_training = False)
-              #save_file.close()
-              predict_result.saveResult(train_round, test_path = FLAGS.test_path, config = config, describ = FLAGS.save_path)
+              if timings is not None:
+                timings.summarize(session.run(sv.global_step))
+              if not is_chief:
+                continue
+              sv.summary_computed(session, session.run(summary_op, train_input.batch(0)))
+              if evaluator is not None:
+                evaluator.snapshot(session, (total_epoch, train_round, i), config.learning_rate * lr_decay, sv.global_step)
+                continue
+              evaluate(session, testm, (total_epoch, train_round, i))
 
               if os.path.exists(FLAGS.save_path):
                 print("Saving model to %s." % FLAGS.save_path)
-                sv.saver.save(session, os.path.join(FLAGS.save_path,"model.ckpt"), global_step=sv.global_step)
+                checkpoint = sv.saver.save(session, os.path.join(FLAGS.save_path,"model.ckpt"), global_step=sv.global_step)
+                resume.save(FLAGS.save_path, (total_epoch, train_round, i), checkpoint, config.learning_rate * lr_decay)
+            if memwatch.watch is not None:
+              print(memwatch.watch.report("after shard %d" % train_round))
+          if evaluator is not None:
+            print(evaluator.report())
+        if evaluator is not None:
+          evaluator.join()
+
+  elif mode == 2:
+    print("Enter Freeze Mode:")
+    reader.get_dict()
+    eval_config.batch_size = FLAGS.freeze_batch_size
+    with tf.Graph().as_default():
+      with tf.name_scope("Freeze"):
+        feed = freeze.FeedInput(eval_config.batch_size, eval_config.num_steps)
+        with tf.variable_scope("Model", reuse=None):
+          m = PTBModel(is_training=False, config=eval_config, input_=feed)
+      with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
+        util.restore_for_inference(session, FLAGS.save_path)
+        print("Wrote %s" % freeze.export(session, feed, freeze.token_logprob(m.logits, feed.input_data, feed.seq_length), FLAGS.save_path, freeze.LOGPROB))
+
+  elif mode == 3:
+    print("Enter Candidates Mode:")
+    reader.get_dict()
+    eval_config.batch_size = FLAGS.freeze_batch_size
+    eval_config.score_candidates = True
+    with tf.Graph().as_default():
+      with tf.name_scope("Candidates"):
+        feed = freeze.FeedInput(eval_config.batch_size, eval_config.num_steps)
+        with tf.variable_scope("Model", reuse=None):
+          m = PTBModel(is_training=False, config=eval_config, input_=feed)
+      with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
+        util.restore_for_inference(session, FLAGS.save_path)
+        print("Wrote %s" % candidates.score_file(session, m, feed, eval_config.candidate_normalizer, FLAGS.test_path,
+                                                 FLAGS.similar_path, FLAGS.max_candidates))
 
   else:
     print("Enter Test Mode:")
@@ -416,15 +619,10 @@ def main(_):
       with tf.name_scope("Train"):
         test_input = PTBInput(config=eval_config, data=test_data, seq_length = test_seq_length, name="TrainInput")
         with tf.variable_scope("Model", reuse=None, initializer=initializer):
-          m = PTBModel(is_training=True, config=eval_config, input_=test_input)
+          m = PTBModel(is_training=False, config=eval_config, input_=test_input)
 
-      sv = tf.train.Supervisor(logdir=FLAGS.save_path)
       config_proto = tf.ConfigProto(allow_soft_placement=True)
-
-      with sv.managed_session(config=config_proto) as session:
-        ckpt = tf.train.get_checkpoint_state(checkpoint_dir=FLAGS.save_path)
-        sv.saver.restore(session,ckpt.model_checkpoint_path)
-
+      with util.inference_session(FLAGS.save_path, config_proto) as session:
         length = reader.length
         #save_file = open("./result_proba_"+str(train_round)+".txt","w")
         print(length)
@@ -0,0 +1,132 @@
+"""Checkpoint writing and evaluation on weight snapshots, off the training thread."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import tensorflow as tf
+
+from my import resume
+
+
+class BackgroundEvaluator(object):
+  """Saves and evaluates snapshots of the training weights in a worker thread.
+
+  snapshot() reads every training variable in a single session.run and
+  queues the values, and the trainer moves on to its next shard. The worker
+  writes them to a checkpoint that the trainer's Saver and my/resume.py
+  read, loads them into the models of eval_graph, and calls
+  evaluate(eval_session, position, data) to run the dev and test sets and
+  write the reports; data is what the trainer passed to snapshot(), such
+  as the dev rows of the shard, which may have moved on by then.
+  Session.run releases the GIL, so the evaluation runs next to training.
+  One snapshot at most waits in the queue, and snapshot() blocks when the
+  worker is further behind than that.
+
+  Whatever evaluate returns, such as the dev loss, waits in results() for
+  the training thread, so state the trainer keeps on it is only touched
+  there. It comes back a snapshot or two late: the shards trained in the
+  meantime use the state from before it. monitor, given to snapshot(), is
+  saved with the position by my/resume.py and so lags the same way.
+  """
+
+  def __init__(self, train_variables, eval_graph, evaluate, save_path=None,
+               config=None):
+    self._train_variables = list(train_variables)
+    self._evaluate = evaluate
+    self._save_path = save_path
+    names = [v.op.name for v in self._train_variables]
+    with eval_graph.as_default():
+      eval_variables = dict((v.op.name, v) for v in tf.global_variables())
+      self._mirrors = []
+      for name, variable in zip(names, self._train_variables):
+        if name not in eval_variables:
+          # optimizer slots and counters, only needed in the checkpoint
+          eval_variables[name] = tf.Variable(
+              tf.zeros(variable.shape, variable.dtype.base_dtype),
+              trainable=False, name="snapshot/" + name)
+        self._mirrors.append(eval_variables[name])
+      self._saver = tf.train.Saver(dict(zip(names, self._mirrors)))
+      self._session = tf.Session(config=config)
+      self._coord = tf.train.Coordinator()
+      self._threads = tf.train.start_queue_runners(self._session, self._coord)
+    self._queue = queue.Queue(maxsize=1)
+    self._results = queue.Queue()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+    self._snapshot_seconds = 0.0
+    self._wait_seconds = 0.0
+    self._background_seconds = 0.0
+    self._count = 0
+
+  def snapshot(self, session, position, learning_rate, global_step=None, data=None,
+               monitor=None):
+    """Queues the weights after position (total_epoch, train_round, epoch)."""
+    start_time = time.time()
+    if global_step is None:
+      values, step = session.run(self._train_variables), None
+    else:
+      values, step = session.run([self._train_variables, global_step])
+    ready_time = time.time()
+    self._queue.put((values, step, tuple(position), learning_rate, data, monitor))
+    self._wait_seconds += time.time() - ready_time
+    self._snapshot_seconds += ready_time - start_time
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      values, step, position, learning_rate, data, monitor = item
+      start_time = time.time()
+      for mirror, value in zip(self._mirrors, values):
+        mirror.load(value, self._session)
+      if self._save_path and os.path.exists(self._save_path):
+        print("Saving model to %s." % self._save_path)
+        checkpoint = self._saver.save(
+            self._session, os.path.join(self._save_path, "model.ckpt"),
+            global_step=step, write_meta_graph=False)
+        resume.save(self._save_path, position, checkpoint, learning_rate, monitor)
+      self._results.put((position, self._evaluate(self._session, position, data)))
+      self._background_seconds += time.time() - start_time
+      self._count += 1
+
+  def results(self):
+    """(position, what evaluate returned) of the snapshots finished since last asked."""
+    finished = []
+    while True:
+      try:
+        finished.append(self._results.get_nowait())
+      except queue.Empty:
+        return finished
+
+  def report(self):
+    """Time recovered since the previous report, and resets the counters."""
+    text = ("Background evaluation: %d snapshots, %.1f s of checkpointing and "
+            "evaluation off the training thread, %.1f s snapshotting, %.1f s "
+            "waiting for the worker, %.1f s recovered" % (
+                self._count, self._background_seconds, self._snapshot_seconds,
+                self._wait_seconds,
+                self._background_seconds - self._snapshot_seconds -
+                self._wait_seconds))
+    self._snapshot_seconds = self._wait_seconds = 0.0
+    self._background_seconds = 0.0
+    self._count = 0
+    return text
+
+  def join(self):
+    """Finishes the queued snapshots and closes the evaluation session."""
+    self._queue.put(None)
+    self._thread.join()
+    self._coord.request_stop()
+    self._coord.join(self._threads)
+    self._session.close()
@@ -0,0 +1,104 @@
+"""Log p of the similar characters that could replace each test character.
+
+$ python RNNLM/birnnlm.py --model candidates --save_path ./model/model_bi/ \
+    --test_path ./test/test_total --similar_path ./similarList.txt
+
+Every character but the first is scored with its candidates: itself and
+its entries in similarList.txt. Only the rows of those candidates in the
+output projection are computed, see PTBModel._build_candidate_graph, not
+the softmax over the whole vocabulary. The scores are written to
+test_path + "_candidates", one line per character,
+
+  sentence position character<TAB>candidate:logp candidate:logp ...
+
+best first, sentences numbered as encode_lines keeps them.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from my import reader
+
+
+def candidate_lists(data, seq_length, similar, vocabulary, max_candidates=0):
+  """Candidate ids [sentences, num_steps, k] and how many of them count.
+
+  Character i of a sentence of length n, i >= 1, is scored at output step
+  num_steps - n + i, as predict_result.genPredict reads the softmax. Its
+  candidates are itself, then its similar characters inside vocabulary;
+  the unused slots repeat it. Words outside the vocabulary get none.
+  """
+  num_steps = data.shape[1]
+  lists = {}
+  rows = []
+  for b in range(len(data)):
+    n = int(seq_length[b])
+    for i in range(1, n):
+      word = int(data[b, i])
+      if word >= vocabulary:
+        continue
+      if word not in lists:
+        others = [int(w) for w in similar.get(word, []) if int(w) != word and int(w) < vocabulary]
+        if max_candidates > 0:
+          others = others[:max_candidates - 1]
+        lists[word] = [word] + others
+      rows.append((b, num_steps - n + i, lists[word]))
+  k = max([len(words) for _, _, words in rows] or [1])
+  ids = np.zeros((len(data), num_steps, k), dtype=np.int32)
+  counts = np.zeros((len(data), num_steps), dtype=np.int32)
+  for b, step, words in rows:
+    ids[b, step, :len(words)] = words
+    ids[b, step, len(words):] = words[0]
+    counts[b, step] = len(words)
+  return ids, counts
+
+
+def score(session, model, feed, data, seq_length, ids):
+  """candidate_logprob of ids, [sentences, num_steps, k], in feed's batch size."""
+  batch_size = feed.batch_size
+  scores = np.zeros(ids.shape, dtype=np.float32)
+  for start in range(0, len(data), batch_size):
+    rows = len(data[start:start + batch_size])
+    batch = np.full((batch_size, data.shape[1]), len(reader.word_to_id), dtype=np.int32)
+    lengths = np.ones(batch_size, dtype=np.int32)
+    candidates = np.zeros((batch_size,) + ids.shape[1:], dtype=np.int32)
+    batch[:rows] = data[start:start + batch_size]
+    lengths[:rows] = seq_length[start:start + batch_size]
+    candidates[:rows] = ids[start:start + batch_size]
+    if feed.column:
+      lengths = lengths.reshape([-1, 1])
+    scores[start:start + rows] = session.run(model.candidate_logprob, {
+        feed.input_data: batch, feed.seq_length: lengths,
+        model.candidates: candidates})[:rows]
+  return scores
+
+
+def score_file(session, model, feed, normalizer, test_path, similar_path, max_candidates=0):
+  """Scores the candidates of test_path, returns the path written."""
+  with open(similar_path) as f:
+    similar = eval(f.read())
+  with open(test_path) as f:
+    lines = f.read().strip().split("\n")
+  data, seq_length, _ = reader.encode_lines(lines)
+  ids, counts = candidate_lists(data, seq_length, similar, len(reader.word_to_id), max_candidates)
+  scores = score(session, model, feed, data, seq_length, ids)
+  id_to_word = dict((v, k) for k, v in reader.word_to_id.items())
+  num_steps = data.shape[1]
+  path = test_path + "_candidates"
+  with open(path, "w") as f:
+    for b in range(len(data)):
+      n = int(seq_length[b])
+      for step in np.flatnonzero(counts[b]):
+        count = counts[b, step]
+        logp = scores[b, step, :count]
+        if normalizer == "candidates":
+          # the repeated slots took part in the graph's normalization
+          logp = logp - np.logaddexp.reduce(logp)
+        order = np.argsort(-logp)
+        position = step - num_steps + n
+        f.write("%d %d %s\t%s\n" % (
+            b, position, id_to_word[int(data[b, position])],
+            " ".join("%s:%.4f" % (id_to_word[int(ids[b, step, j])], logp[j]) for j in order)))
+  return path
@@ -0,0 +1,139 @@
+"""Frozen inference graphs with placeholder inputs and a per-token score.
+
+`--model freeze` writes frozen.pb, the forward pass with the checkpoint's
+variables folded into constants, and frozen.json, the names of its input
+and output tensors. A frozen graph runs without the trainer, its flags or
+its `my` package, so models of different directories load side by side in
+one process, each into a graph and session of its own.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+GRAPH_FILE = "frozen.pb"
+META_FILE = "frozen.json"
+
+# score of a tagger: P(error), an error above the threshold
+ERROR_PROBA = "error_proba"
+# score of a language model: log p(character), an error below the threshold
+LOGPROB = "logprob"
+DEFAULT_THRESHOLDS = {ERROR_PROBA: 0.5, LOGPROB: -9.0}
+
+
+class FeedInput(object):
+  """PTBInput stand-in whose batch is fed through placeholders.
+
+  The RNNLM producer gives seq_length as a [batch_size, 1] column, the
+  other inputs reshape it to a vector; column follows the model.
+  """
+
+  def __init__(self, batch_size, num_steps, column=False):
+    self.batch_size = batch_size
+    self.num_steps = num_steps
+    self.epoch_size = 1
+    self.column = column
+    self.input_data = tf.placeholder(tf.int32, [batch_size, num_steps], name="input_data")
+    self.targets = tf.placeholder(tf.int32, None, name="targets")
+    self.seq_length = tf.placeholder(
+        tf.int32, [batch_size, 1] if column else [batch_size], name="seq_length")
+
+
+def token_logprob(probs, input_data, seq_length):
+  """log p of every character, [batch_size, num_steps], as genPredict reads it.
+
+  predict_result.genPredict scores character i of a sentence of length n
+  with output step num_steps - n + i. The first character and the padding
+  have no score and get 0.
+  """
+  batch_size, num_steps = input_data.shape.as_list()
+  length = tf.reshape(seq_length, [-1, 1])
+  position = tf.range(num_steps)[None, :]
+  step = tf.clip_by_value(num_steps - length + position, 0, num_steps - 1)
+  batch = tf.tile(tf.range(batch_size)[:, None], [1, num_steps])
+  # the pad id is past the BiRNNLM softmax, reader.unknown_id() past both
+  ids = tf.minimum(input_data, tf.shape(probs)[2] - 1)
+  proba = tf.gather_nd(probs, tf.stack([batch, step, ids], axis=2))
+  valid = tf.logical_and(position >= 1, position < length)
+  return tf.where(valid, tf.log(tf.maximum(proba, 1e-30)), tf.zeros_like(proba))
+
+
+def export(session, input_, score, save_path, kind):
+  """Freezes the graph that computes score, returns the path written."""
+  graph_def = tf.graph_util.convert_variables_to_constants(
+      session, session.graph.as_graph_def(), [score.op.name])
+  path = os.path.join(save_path, GRAPH_FILE)
+  with open(path, "wb") as f:
+    f.write(graph_def.SerializeToString())
+  with open(os.path.join(save_path, META_FILE), "w") as f:
+    json.dump({"kind": kind, "batch_size": input_.batch_size,
+               "num_steps": input_.num_steps, "column": input_.column,
+               "input_data": input_.input_data.name,
+               "seq_length": input_.seq_length.name, "score": score.name},
+              f, indent=2, sort_keys=True)
+  return path
+
+
+class FrozenModel(object):
+  """A frozen graph loaded into a graph and session of its own.
+
+  score() runs any number of sentences, in the graph's batch size, the
+  last batch padded. error_score() maps scores to [0, 1], 0.5 at the
+  threshold, so that taggers and language models can be weighed together.
+  """
+
+  def __init__(self, save_path, threshold=None, config=None):
+    with open(os.path.join(save_path, META_FILE)) as f:
+      self.meta = json.load(f)
+    self.name = os.path.basename(os.path.normpath(save_path))
+    self.kind = self.meta["kind"]
+    self.batch_size = self.meta["batch_size"]
+    self.threshold = DEFAULT_THRESHOLDS[self.kind] if threshold is None else threshold
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      graph_def = tf.GraphDef()
+      with open(os.path.join(save_path, GRAPH_FILE), "rb") as f:
+        graph_def.ParseFromString(f.read())
+      tf.import_graph_def(graph_def, name="")
+    self._input_data = self.graph.get_tensor_by_name(self.meta["input_data"])
+    self._seq_length = self.graph.get_tensor_by_name(self.meta["seq_length"])
+    self._score = self.graph.get_tensor_by_name(self.meta["score"])
+    self.session = tf.Session(graph=self.graph, config=config)
+
+  def score(self, data, seq_length, pad_id):
+    """Scores [sentences, num_steps] of ids, returns [sentences, num_steps]."""
+    scores = np.zeros(data.shape, dtype=np.float32)
+    for start in range(0, len(data), self.batch_size):
+      rows = data[start:start + self.batch_size]
+      batch = np.full((self.batch_size, data.shape[1]), pad_id, dtype=np.int32)
+      lengths = np.ones(self.batch_size, dtype=np.int32)
+      batch[:len(rows)] = rows
+      lengths[:len(rows)] = seq_length[start:start + self.batch_size]
+      if self.meta["column"]:
+        lengths = lengths.reshape([-1, 1])
+      scores[start:start + len(rows)] = self.session.run(
+          self._score, {self._input_data: batch, self._seq_length: lengths})[:len(rows)]
+    return scores
+
+  def valid(self, seq_length, num_steps):
+    """Positions the model scores: all characters, the first one not for an LM."""
+    mask = np.arange(num_steps)[None, :] < np.reshape(seq_length, [-1, 1])
+    if self.kind == LOGPROB:
+      mask[:, 0] = False
+    return mask
+
+  def error_score(self, scores):
+    if self.kind == LOGPROB:
+      return 1.0 / (1.0 + np.exp(scores - self.threshold))
+    # P(error) rescaled piecewise so that the threshold lands on 0.5
+    low = 0.5 * scores / self.threshold
+    high = 0.5 + 0.5 * (scores - self.threshold) / (1.0 - self.threshold)
+    return np.where(scores < self.threshold, low, high)
+
+  def close(self):
+    self.session.close()
@@ -22,15 +22,23 @@ from __future__ import print_function
 import collections
 import os
 import sys
+import time
 
 import tensorflow as tf
 import numpy as np
 from numpy import *
+from my import memwatch
 
 Py3 = sys.version_info[0] == 3
 length = 0
 sequence_length = []
 word_to_id = {}
+# name prefix of a corpus published by my/shared_corpus.py, None reads files
+shm_prefix = None
+# my/shard_cache.ShardCache kept across outer epochs, None reloads every time
+shard_cache = None
+# my/instrument.StepInstrument recording shard load and corruption times
+timings = None
 
 def _read_words(filename):
   with tf.gfile.GFile(filename, "r") as f:
@@ -68,6 +76,191 @@ def _file_to_word_ids(filename):
   return [word_to_id[word] for word in data if word in word_to_id]
 
 
+# bytes of shard text scanned at a time when counting row widths
+WIDTH_CHUNK = 1 << 24
+# ids moved at a time when dropping rows of the wrong width
+MOVE_IDS = 1 << 20
+
+def _row_widths(text):
+  """Number of ids on every line of text, blank lines at either end skipped."""
+  b = frombuffer(text, dtype = uint8)
+  start, end = 0, len(b)
+  while start < end and b[start] <= 32:
+    start += 1
+  while end > start and b[end-1] <= 32:
+    end -= 1
+  widths = []
+  while start < end:
+    stop = end
+    if start + WIDTH_CHUNK < end:
+      stop = start + WIDTH_CHUNK
+      # whole lines only
+      cut = text.rfind(b"\n", start, stop) + 1
+      stop = cut if cut > start else (text.find(b"\n", stop, end) + 1 or end)
+    part = b[start:stop]
+    space = part <= 32
+    first = ~space
+    first[1:] &= space[:-1]
+    line_ends = flatnonzero(part == 10)
+    if stop == end:
+      line_ends = append(line_ends, len(part))
+    widths.append(diff(searchsorted(flatnonzero(first), line_ends), prepend = 0))
+    start = stop
+  return concatenate(widths) if widths else zeros(0, dtype = int64)
+
+def _parse_rows(train_path, num_steps = 47):
+  """(ids, keep) of a shard file: the ids of its num_steps wide lines, flat.
+
+  The text is parsed once into a single int32 buffer. keep marks the lines
+  that are num_steps wide; the others are squeezed out of the buffer in
+  place, so the rows are never split into lists or copied as a whole.
+  """
+  with open(train_path, "rb") as f:
+    text = f.read()
+  data = np.fromstring(text, dtype = int32, sep = " ")
+  widths = _row_widths(text)
+  del text
+  keep = widths == num_steps
+  if keep.all():
+    return data, keep
+  with memwatch.stage("read_shard/filter_rows"):
+    offsets = concatenate([[0], cumsum(widths)])
+    edges = flatnonzero(diff(concatenate([[0], keep.astype(int8), [0]])))
+    dst = 0
+    for first, last in zip(edges[0::2], edges[1::2]):
+      src, size = offsets[first], offsets[last] - offsets[first]
+      # front to back, a block is written no further than it was read
+      for done in range(0, size, MOVE_IDS):
+        block = MOVE_IDS if size - done > MOVE_IDS else size - done
+        data[dst+done:dst+done+block] = data[src+done:src+done+block]
+      dst += size
+    return data[:dst], keep
+
+
+@memwatch.timed("load_shard")
+def _load_shard(data_path, index):
+  """Decoded (train_data, sequence_length) of one shard, rows not 47 wide dropped."""
+  if shm_prefix:
+    # multiprocessing.shared_memory needs Python 3.8, import it only when asked
+    from my import shared_corpus
+    shard = shared_corpus.attach(shm_prefix, index)
+    if shard is not None:
+      print("Attached shared shard %d"%index)
+      return shard
+  if shard_cache is not None:
+    shard = shard_cache.get(index, lambda: _read_shard(data_path, index))
+    print(shard_cache)
+    return shard
+  return _read_shard(data_path, index)
+
+
+@memwatch.timed("read_shard")
+def _read_shard(data_path, index):
+  if(index<10):
+    index = "0"+str(index)
+  #train_path = os.path.join(data_path, "conv.txt")
+  #train_path = os.path.join(data_path, "corpus_cha.txt")
+  #train_path = os.path.join(data_path, "pro_cha.txt")
+  train_path = os.path.join(data_path, "corpus/total_"+str(index))
+  with memwatch.stage("read_shard/parse"):
+    train_data, keep = _parse_rows(train_path)
+  
+  #word_to_id = _build_vocab(train_path)
+  #f = open("./cha_to_id.txt","w")
+  #f.write(str(word_to_id))
+  #f.close()
+  
+  #data_path = os.path.join(data_path,"conv_length.txt")
+  data_path = os.path.join(data_path,"length/length_"+str(index))
+  #data_path = os.path.join(data_path,"corpus_cha_length.txt")
+  #data_path = os.path.join(data_path,"pro_cha_length.txt")
+  sequence_length = open(data_path).read().strip().split()
+
+  if len(sequence_length)<=1:
+    sequence_length =  open(data_path).read().strip().split("\n")
+  sequence_length = array(sequence_length, dtype = int32)
+
+  print("length before filter: %d"%shape(sequence_length)[0])
+
+  if len(keep) != len(sequence_length):
+    raise ValueError("%s has %d lines but %s has %d lengths" % (train_path, len(keep), data_path, len(sequence_length)))
+  if not keep.all():
+    print("length deleted index: %d"%(len(keep) - count_nonzero(keep)))
+    sequence_length = sequence_length[keep]
+    
+  print("length after filter: %d"%shape(sequence_length)[0])
+  return train_data, sequence_length
+
+
+# test lines encoded at a time
+ENCODE_LINES = 1 << 16
+# str.split() whitespace, by code point; none lies above U+3000
+_SPACE = array([chr(c).isspace() for c in range(0x3001)])
+# (sentence, position) of every test character not in cha_to_id.txt
+oov_positions = None
+
+def unknown_id():
+  """Id of the words not in cha_to_id.txt, one past the pad id.
+
+  It has no row of its own: util.embed_ids reads it as a zero vector.
+  """
+  return len(word_to_id) + 1
+
+def encode_lines(lines, num_steps = 47):
+  """(ids [sentences, num_steps], sequence_length, oov) of test lines.
+
+  Lines longer than num_steps are skipped. Lines are split into words on
+  arrays of code points and single character words are looked up in a
+  table indexed by code point, so no per-word strings are made; the rare
+  longer words go through word_to_id. Ids are written straight into one
+  preallocated array, right padded with len(word_to_id). Words missing
+  from word_to_id get unknown_id() instead of raising KeyError, so the pad
+  id only ever follows the end of a sentence, and oov lists their
+  (sentence, position) pairs.
+  """
+  pad = len(word_to_id)
+  table = full(0x110000, -1, dtype = int32)
+  for word, i in word_to_id.items():
+    if len(word) == 1:
+      table[ord(word)] = i
+  data = full((len(lines), num_steps), pad, dtype = int32)
+  sequence_length = zeros(len(lines), dtype = int32)
+  oov = []
+  rows = 0
+  for chunk in range(0, len(lines), ENCODE_LINES):
+    text = "\n".join(lines[chunk:chunk+ENCODE_LINES])
+    points = frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype = uint32)
+    space = ones(len(points), dtype = bool_)
+    low = points <= 0x3000
+    space[low] = _SPACE[points[low]]
+    space[~low] = False
+    starts = ~space
+    starts[1:] &= space[:-1]
+    ends = ~space
+    ends[:-1] &= space[1:]
+    starts, ends = flatnonzero(starts), flatnonzero(ends) + 1
+    line_ends = append(flatnonzero(points == 10), len(points))
+    widths = diff(searchsorted(starts, line_ends), prepend = 0)
+    ids = table[points[starts]]
+    for k in flatnonzero(ends - starts > 1):
+      ids[k] = word_to_id.get(text[starts[k]:ends[k]], -1)
+    keep = widths <= num_steps
+    if not keep.all():
+      ids = ids[repeat(keep, widths)]
+      widths = widths[keep]
+    mask = arange(num_steps) < widths[:, None]
+    missing = ids < 0
+    if missing.any():
+      ids[missing] = unknown_id()
+      sentence, position = nonzero(mask)
+      oov.append(stack([sentence[missing] + rows, position[missing]], axis = 1))
+    data[rows:rows+len(widths)][mask] = ids
+    sequence_length[rows:rows+len(widths)] = widths
+    rows += len(widths)
+  oov = concatenate(oov) if oov else zeros((0, 2), dtype = int64)
+  return data[:rows], sequence_length[:rows], oov
+
+
 def ptb_raw_data(data_path=None, is_training = True, index=0):
   #valid_path = os.path.join(data_path, "ptb.valid.txt")
 
@@ -107,77 +300,34 @@ def ptb_raw_data(data_path=None, is_training = True, index=0):
   global word_to_id
   word_to_id = eval(open("./cha_to_id.txt").read())
   if is_training == True:
-    if(index<10):
-      index = "0"+str(index)
-    #train_path = os.path.join(data_path, "conv.txt")
-    #train_path = os.path.join(data_path, "corpus_cha.txt")
-    #train_path = os.path.join(data_path, "pro_cha.txt")
-    train_path = os.path.join(data_path, "corpus/total_"+str(index))
-    train_data = array(open(train_path).read().strip().replace("\n"," ").split(),dtype=int32)
-    
-    #word_to_id = _build_vocab(train_path)
-    #f = open("./cha_to_id.txt","w")
-    #f.write(str(word_to_id))
-    #f.close()
-    
-    #data_path = os.path.join(data_path,"conv_length.txt")
-    data_path = os.path.join(data_path,"length/length_"+str(index))
-    #data_path = os.path.join(data_path,"corpus_cha_length.txt")
-    #data_path = os.path.join(data_path,"pro_cha_length.txt")
-    sequence_length = open(data_path).read().strip().split()
-
-    if len(sequence_length)<=1:
-      sequence_length =  open(data_path).read().strip().split("\n")
-    sequence_length = array(sequence_length, dtype = int32)
-
-    print("length before filter: %d"%shape(sequence_length)[0])
-
-    if len(train_data)%47 != 0:
-      train_data = array([i.split() for i in open(train_path).read().strip().split("\n")])
-      tem_index = []
-      for i in range(len(train_data)):
-        if len(train_data[i]) != 47:
-          tem_index.append(i)
-      print("length deleted index: %d"%(len(tem_index)))
-      train_data = delete(train_data, tem_index)
-      train_data = array(concatenate(train_data),dtype=int32)
-      sequence_length = delete(sequence_length, tem_index)
-      
-    print("length after filter: %d"%shape(sequence_length)[0])
-
+    start_time = time.time()
+    train_data, sequence_length = _load_shard(data_path, index)
+    if timings is not None:
+      timings.event("shard_load", index, time.time() - start_time)
 
   else:
     #test_path = os.path.join(data_path, "")
     #test_path = os.path.join(data_path, "test_normal.txt")
-    global length
-    sequence_length = []
-    test_data = open(data_path).read().strip().split("\n")
-    length = len(test_data)
-    train_data = ""
-    for line in test_data:
-      line = line.split()
-      temlen = len(line)
-      if temlen>47:
-        continue
-      tems = ""
-      sequence_length.append(temlen)
-      for word in line:
-        tems += str(word_to_id[word])+" "
-      tems += "9173 "*(47-temlen)
-      train_data +=tems
-    train_data = array(train_data.strip().split(),dtype=int32)
-    print(shape(train_data))
-
-    sequence_length = array(sequence_length, dtype=int32)
+    global length, oov_positions
+    with memwatch.stage("ptb_raw_data/test_encode"):
+      test_data = open(data_path).read().strip().split("\n")
+      length = len(test_data)
+      train_data, sequence_length, oov_positions = encode_lines(test_data)
+      train_data = train_data.reshape(-1)
+      print(shape(train_data))
+      if len(oov_positions):
+        print("%d test characters not in cha_to_id.txt, encoded as %d" % (len(oov_positions), unknown_id()))
   print("Getting Data Finish")
   return train_data, sequence_length
 
 
+@memwatch.timed()
 def ptb_producer(raw_data,sequence_length, batch_size, num_steps, name=None):
   print("Producing batch...")
   with tf.name_scope(name, "PTBProducer", [raw_data, sequence_length, batch_size, num_steps]):
-    raw_data = tf.convert_to_tensor(raw_data, name="raw_data", dtype=tf.int32)
-    sequence_length = tf.convert_to_tensor(sequence_length, name="sequence_length", dtype=tf.int32)
+    with memwatch.stage("ptb_producer/to_tensors"):
+      raw_data = tf.convert_to_tensor(raw_data, name="raw_data", dtype=tf.int32)
+      sequence_length = tf.convert_to_tensor(sequence_length, name="sequence_length", dtype=tf.int32)
     data_len = tf.size(raw_data)
     batch_len = data_len // batch_size
     data = tf.reshape(raw_data[0 : batch_size * batch_len],
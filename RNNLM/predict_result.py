@@ -1,9 +1,11 @@
 from numpy import * 
 from my import reader
+from my import memwatch
 import evaluation
 
 counter = 0
 sentence = ""
+@memwatch.timed()
 def genPredict(result, test_path):
 	global sentence
 	result = reshape(result,[-1,47,9174])
@@ -32,6 +34,7 @@ def genPredict(result, test_path):
 		#print(i)
 	sentence += ("===================\n")
 
+@memwatch.timed()
 def saveResult(index, test_path, config = None, describ = None):
 	global counter,sentence
 	evaluation.generate(sentence, index, test_path, config, describ)
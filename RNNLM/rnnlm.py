@@ -63,6 +63,16 @@ import tensorflow as tf
 from my import reader
 #import reader
 from my import util
+from my import embedding
+from my import shard_cache
+from my import shard_feed
+from my import resume
+from my import background
+from my import instrument
+from my import profiling
+from my import memwatch
+from my import freeze
+from my import candidates
 import os
 from tensorflow.python.client import device_lib
 import predict_result
@@ -71,7 +81,7 @@ flags = tf.flags
 logging = tf.logging
 
 flags.DEFINE_string("model", "train",
-    "A type of model. Possible options are: train, test.")
+    "A type of model. Possible options are: train, test, freeze, candidates.")
 flags.DEFINE_string("data_path", "./corpus/",
                     "Where the training/test data is stored.")
 flags.DEFINE_string("save_path", "./model/model_total_e2/",
@@ -80,6 +90,44 @@ flags.DEFINE_string("test_path", "./test/test_check",
                     "Model test file.")
 flags.DEFINE_bool("use_fp16", False,
                   "Train using 16-bit floats instead of 32bit floats")
+flags.DEFINE_bool("stateless", False,
+                  "Start every batch from the zero LSTM state instead of "
+                  "feeding back the previous final state.")
+flags.DEFINE_string("shm_prefix", "",
+                    "Attach training shards published by my/shared_corpus.py "
+                    "under this name prefix instead of reading the files.")
+flags.DEFINE_integer("shard_cache_mb", 0,
+                     "Keep up to this many MB of decoded shards in memory "
+                     "across outer epochs, 0 disables the cache.")
+flags.DEFINE_string("shard_spill_dir", "",
+                    "Spill shards evicted from the shard cache to .npy files "
+                    "in this directory.")
+flags.DEFINE_bool("async_eval", False,
+                  "Snapshot the weights after every shard and leave checkpointing "
+                  "and test evaluation to a background thread.")
+flags.DEFINE_string("instrument_csv", "",
+                    "Append per-step input wait, compute and overhead times, "
+                    "shard load and error-injection times to this CSV file.")
+flags.DEFINE_integer("instrument_every", 1,
+                     "Split the input wait off every this many training steps.")
+flags.DEFINE_string("profile_steps", "",
+                    "Trace these run_epoch steps, counted per train/eval pass "
+                    "over the run, e.g. \"100,200-202\".")
+flags.DEFINE_string("profile_dir", "./profile/",
+                    "Where traced steps write Chrome-trace timelines and op tables.")
+flags.DEFINE_string("memwatch", "",
+                    "Time the reader, producer and evaluation stages and print "
+                    "their memory watermarks after every shard: \"rss\", or "
+                    "\"trace\" to add tracemalloc peaks.")
+flags.DEFINE_integer("freeze_batch_size", 64,
+                     "Batch size of the graph written by --model freeze, and of --model candidates.")
+flags.DEFINE_string("similar_path", "./similarList.txt",
+                    "Similar characters scored by --model candidates.")
+flags.DEFINE_integer("max_candidates", 0,
+                     "Candidates per character for --model candidates, the character "
+                     "included; 0 scores all of its similar characters.")
+flags.DEFINE_string("embedding_path", "../Keras/w2c_financial.txt",
+                    "Pre-trained word2vec text file, cached as embedding_<hash>.npy.")
 flags.DEFINE_integer("num_gpus", 1,
                      "If larger than 1, Grappler AutoParallel optimizer "
                      "will create multiple training replicas with each GPU "
@@ -89,6 +137,10 @@ flags.DEFINE_string("rnn_mode", "BLOCK",
                     "BASIC, and BLOCK, representing cudnn_lstm, basic_lstm, "
                     "and lstm_block_cell classes.")
 FLAGS = flags.FLAGS
+# my/instrument.StepInstrument when --instrument_csv is set
+timings = None
+# my/profiling.StepProfiler when --profile_steps is set
+profiler = None
 BASIC = "basic"
 CUDNN = "cudnn"
 BLOCK = "block"
@@ -127,13 +179,10 @@ class PTBModel(object):
     #self.embedding = tf.get_variable(
     #    "embedding", [self.vocab_size, size], dtype=tf.float32)
     #self.embedding = tf.concat([tf.zeros([1,size]), self.embedding[1:]],axis=0 )
-      if os.path.exists("./embedding.txt"):
-        self.loadEmbedding()
-      else:
-        self.usePreEmbedding("../Keras/w2c_financial.txt")
+      self.usePreEmbedding(FLAGS.embedding_path)
       self.embedding = tf.get_variable(name = "embedding", initializer=tf.convert_to_tensor(self.embedding), dtype=tf.float32)
       #self.embedding = tf.Variable((self.embedding), dtype=tf.float32)
-      inputs = tf.nn.embedding_lookup(self.embedding, input_.input_data)
+      inputs = util.embed_ids(self.embedding, input_.input_data)
 
     # get predict word's distribution
     output, state = self._build_rnn_graph(inputs, config, is_training)
@@ -149,10 +198,11 @@ class PTBModel(object):
     
     # Reshape logits to be a 3-D tensor for sequence loss
     logits = tf.reshape(logits, [self.batch_size, self.num_steps, self.vocab_size])
-    # Use the contrib sequence loss and average over the batches
+    # Use the contrib sequence loss and average over the batches; the test
+    # targets may hold reader.unknown_id(), past the softmax
     loss = tf.contrib.seq2seq.sequence_loss(
         logits,
-        input_.targets,
+        tf.minimum(input_.targets, self.vocab_size - 1),
         tf.ones([self.batch_size, self.num_steps], dtype=data_type()),
         average_across_timesteps=False,
         average_across_batch=True)
@@ -161,6 +211,9 @@ class PTBModel(object):
     self._final_state = state
 
     self.logits = tf.nn.softmax(logits)
+    self._candidates = self._candidate_logprob = None
+    if config.score_candidates:
+      self._build_candidate_graph(output, logits, config)
     if not is_training:
       return
 
@@ -177,49 +230,44 @@ class PTBModel(object):
         tf.float32, shape=[], name="new_learning_rate")
     self._lr_update = tf.assign(self._lr, self._new_lr)
 
-  def resetInput(self, input_):
-    self._input = input_
-
 
-  def usePreEmbedding(self, embeddingf ,save = True):
-    # use pre-trained embedding
+  def usePreEmbedding(self, embeddingf):
+    # use pre-trained embedding, cached as a .npy file keyed by vocabulary
     print("Using Pre-trained Embedding...")
-    embedding_dict = {}
-    f = codecs.open(embeddingf, "r", encoding="utf8",errors='ignore')
-    for line in f:
-      values = line.split()
-      word = values[0]
-      coefs = asarray(values[1:],dtype='float32')
-      embedding_dict[word] = coefs
-    f.close()
-    self.embedding = zeros( (self.vocab_size, 300), dtype=float32)
-    for word, i in reader.word_to_id.items():
-      embedding_vector = embedding_dict.get(word)
-      if embedding_vector is  None:
-        embedding_vector = zeros((1,300), dtype=float32)
-        for character in word:
-          if character in embedding_dict:
-            embedding_vector = embedding_vector + embedding_dict.get(character)
-        embedding_vector = embedding_vector / len(word)
-      self.embedding[i] = embedding_vector
-    if save == True:
-      self.saveEmebdding()
-  
-  def saveEmebdding(self):
-    print("Saving Embedding...")
-    ff = open("./embedding.txt","wb")
-    for i in self.embedding:
-      savetxt(ff,i,fmt="%f")
-    ff.close()
-    print("Saving Embedding Finish")
-
-  def loadEmbedding(self):
-    print("Loading Embedding...")
-    self.embedding = []
-    self.embedding  = loadtxt("./embedding.txt", dtype = float32)
-    self.embedding = reshape(self.embedding,[-1,300])
-    self.vocab_size = self.embedding.shape[0]
-    print("Loading Embedding Finish")
+    self.embedding = embedding.load_embedding(embeddingf, reader.word_to_id, self.vocab_size)
+
+  def _build_candidate_graph(self, output, logits, config):
+    """Scores only the ids fed through `candidates`, for my/candidates.py.
+
+    `candidates` is [batch_size, num_steps, k]; `candidate_logprob[b, t, j]`
+    scores candidates[b, t, j] at output step t from the k gathered rows of
+    the output projection alone. config.candidate_normalizer picks what the
+    score is normalized over: "candidates", the default, gives log p of
+    each candidate within its position's candidate set; "none" leaves the
+    raw logits, which rank the candidates the same way; "exact" gives the
+    full log p, but needs the whole vocab_size projection for its logsumexp
+    and so is no faster than the full softmax.
+    """
+    self._candidates = tf.placeholder(
+        tf.int32, [self.batch_size, self.num_steps, None], name="candidates")
+    with tf.variable_scope("fully_connected", reuse=True):
+      softmax_w = tf.get_variable("weights")
+      softmax_b = tf.get_variable("biases")
+    # rows of the projection, [batch, steps, k, hidden]
+    candidate_w = tf.gather(tf.transpose(softmax_w), self._candidates)
+    output = tf.reshape(output, [self.batch_size, self.num_steps, -1])
+    candidate_logits = tf.einsum("btkh,bth->btk", candidate_w, output)
+    candidate_logits += tf.gather(softmax_b, self._candidates)
+    if config.candidate_normalizer == "candidates":
+      candidate_logits -= tf.expand_dims(
+          tf.reduce_logsumexp(candidate_logits, axis=-1), -1)
+    elif config.candidate_normalizer == "exact":
+      candidate_logits -= tf.expand_dims(
+          tf.reduce_logsumexp(logits, axis=-1), -1)
+    elif config.candidate_normalizer != "none":
+      raise ValueError("candidate_normalizer %s not supported"
+                       % config.candidate_normalizer)
+    self._candidate_logprob = candidate_logits
 
   def _build_rnn_graph(self, inputs, config, is_training):
     if config.rnn_mode == CUDNN:
@@ -255,7 +303,7 @@ class PTBModel(object):
     if config.rnn_mode == BASIC:
       return tf.contrib.rnn.BasicLSTMCell(
           config.hidden_size, forget_bias=0.0, state_is_tuple=True,
-          reuse= not is_training)
+          reuse=tf.get_variable_scope().reuse)
     if config.rnn_mode == BLOCK:
       return tf.contrib.rnn.LSTMBlockCell(
           config.hidden_size, forget_bias=0.0)
@@ -318,6 +366,10 @@ class PTBModel(object):
         ops.update(rnn_params=self._rnn_params)
     #else:
     ops.update({util.with_prefix(self._name, "output"):self.logits})
+    if self._candidates is not None:
+      ops.update({util.with_prefix(self._name, "candidates"): self._candidates,
+                  util.with_prefix(self._name, "candidate_logprob"):
+                      self._candidate_logprob})
     for name, op in ops.items():
       tf.add_to_collection(name, op)
     self._initial_state_name = util.with_prefix(self._name, "initial")
@@ -345,6 +397,11 @@ class PTBModel(object):
     #else:
     self.logits = tf.get_collection_ref(util.with_prefix(self._name, "output"))[0]
     self._cost = tf.get_collection_ref(util.with_prefix(self._name, "cost"))[0]
+    if self._candidates is not None:
+      self._candidates = tf.get_collection_ref(
+          util.with_prefix(self._name, "candidates"))[0]
+      self._candidate_logprob = tf.get_collection_ref(
+          util.with_prefix(self._name, "candidate_logprob"))[0]
     num_replicas = FLAGS.num_gpus if self._name == "Train" else 1
     self._initial_state = util.import_state_tuples(
         self._initial_state, self._initial_state_name, num_replicas)
@@ -363,6 +420,14 @@ class PTBModel(object):
   def output(self):
     return self.logits
   
+  @property
+  def candidates(self):
+    return self._candidates
+
+  @property
+  def candidate_logprob(self):
+    return self._candidate_logprob
+
   @property
   def cost(self):
     return self._cost
@@ -407,10 +472,19 @@ class MediumConfig(object):
   num_steps = 47
   vocab_size = 9174
   rnn_mode = BLOCK
+  # "candidates", "none" or "exact", see PTBModel._build_candidate_graph
+  candidate_normalizer = "candidates"
+  # set by --model candidates
+  score_candidates = False
 
 def run_epoch(session, model, eval_op=None, verbose=False, is_training=True, save_file=None):
   if is_training==False:
-    result = session.run(model.logits)
+    run_options, run_metadata = None, None
+    if profiler is not None:
+      run_options, run_metadata = profiler.options("eval")
+    result = session.run(model.logits, options=run_options, run_metadata=run_metadata)
+    if run_metadata is not None:
+      profiler.collect("eval", run_metadata)
     r1 = []
     for word in (result[0]):
       for backup in word:
@@ -424,32 +498,56 @@ def run_epoch(session, model, eval_op=None, verbose=False, is_training=True, sav
   start_time = time.time()
   costs = 0.0
   iters = 0
-  state = session.run(model.initial_state)
-
-  fetches = {
-      "cost": model.cost,
-      "final_state": model.final_state,
-  }
+  if FLAGS.stateless:
+    # rows are independent sentences, the graph starts from its zero state
+    state = None
+    fetches = {"cost": model.cost}
+  else:
+    state = session.run(model.initial_state)
+    fetches = {
+        "cost": model.cost,
+        "final_state": model.final_state,
+    }
   if eval_op is not None:
     fetches["eval_op"] = eval_op
   for step in range(model.input.epoch_size):
+    step_start = time.time()
     feed_dict = {}
-    for i, (c, h) in enumerate(model.initial_state):
-      feed_dict[c] = state[i].c
-      feed_dict[h] = state[i].h
-
-    vals = session.run(fetches, feed_dict)
+    if state is not None:
+      for i, (c, h) in enumerate(model.initial_state):
+        feed_dict[c] = state[i].c
+        feed_dict[h] = state[i].h
+
+    dequeue = None
+    if isinstance(model.input, shard_feed.ShardFeed):
+      feed_start = time.time()
+      feed_dict.update(model.input.batch(step))
+      dequeue = time.time() - feed_start
+    elif timings is not None and eval_op is not None:
+      dequeue = timings.dequeue(session, model, feed_dict)
+    run_options, run_metadata = None, None
+    if profiler is not None:
+      run_options, run_metadata = profiler.options("train" if eval_op is not None else "eval")
+    run_start = time.time()
+    vals = session.run(fetches, feed_dict, options=run_options, run_metadata=run_metadata)
+    compute = time.time() - run_start
+    if run_metadata is not None:
+      profiler.collect("train" if eval_op is not None else "eval", run_metadata)
     
     cost = vals["cost"]
-    state = vals["final_state"]
+    if state is not None:
+      state = vals["final_state"]
     costs += cost
     iters += model.input.num_steps
 
     if verbose and step % (model.input.epoch_size // 10) == 10:
-      print("%.3f perplexity: %.3f speed: %.0f wps" %
+      print("%.3f perplexity: %.3f speed: %.0f wps %.2f steps/s" %
             (step * 1.0 / model.input.epoch_size, np.exp(costs / iters),
              iters * model.input.batch_size * max(1, FLAGS.num_gpus) /
-             (time.time() - start_time)))
+             (time.time() - start_time),
+             (step + 1) / (time.time() - start_time)))
+    if timings is not None and eval_op is not None:
+      timings.record("train", dequeue, compute, time.time() - step_start)
 
   return np.exp(costs / iters)
 
@@ -460,6 +558,10 @@ def get_config():
   mode = 0
   if FLAGS.model == "test":
     mode = 1
+  elif FLAGS.model == "freeze":
+    mode = 2
+  elif FLAGS.model == "candidates":
+    mode = 3
   if FLAGS.rnn_mode:
     temconfig.rnn_mode = FLAGS.rnn_mode
   if FLAGS.num_gpus != 1 or tf.__version__ < "1.3.0" :
@@ -468,8 +570,18 @@ def get_config():
 
 
 def main(_):
+  global timings, profiler
   if not FLAGS.data_path:
     raise ValueError("Must set --data_path to PTB data directory")
+  reader.shm_prefix = FLAGS.shm_prefix or None
+  if FLAGS.shard_cache_mb > 0 or FLAGS.shard_spill_dir:
+    reader.shard_cache = shard_cache.ShardCache(FLAGS.shard_cache_mb * 2**20, FLAGS.shard_spill_dir or None)
+  if FLAGS.instrument_csv:
+    timings = reader.timings = instrument.StepInstrument(FLAGS.instrument_csv, every=FLAGS.instrument_every)
+  if FLAGS.profile_steps:
+    profiler = profiling.StepProfiler(profiling.parse_steps(FLAGS.profile_steps), FLAGS.profile_dir)
+  if FLAGS.memwatch:
+    memwatch.watch = memwatch.MemWatch(trace=FLAGS.memwatch == "trace")
   gpus = [
       x.name for x in device_lib.list_local_devices() if x.device_type == "GPU"
   ]
@@ -487,13 +599,15 @@ def main(_):
   if mode == 0:
     # train mode
     print("Enter Train Mode:")
-    train_data,train_seq_length = reader.ptb_raw_data(FLAGS.data_path, is_training = True, index = 0)
+    state = resume.load(FLAGS.save_path)
     test_data,test_seq_length = reader.ptb_raw_data(FLAGS.test_path, is_training = False)
     with tf.Graph().as_default():
       initializer = tf.random_uniform_initializer(-config.init_scale,
                                                   config.init_scale)
       with tf.name_scope("Train"):
-        train_input = PTBInput(config=config, data=train_data, seq_length= train_seq_length, name="TrainInput")
+        # every shard is fed to this one graph, see my/shard_feed.py; the feed
+        # is keyed by name, so it reaches the imported copy below as well
+        train_input = shard_feed.ShardFeed(config.batch_size, config.num_steps, column=True, name="TrainInput")
         with tf.variable_scope("Model", reuse=None , initializer=initializer) as scope:
           m = PTBModel(is_training=True, config=config, input_=train_input)
           scope.reuse_variables()
@@ -522,36 +636,100 @@ def main(_):
       m.is_training = True
       for model in models.values():
         model.import_ops()
-      sv = tf.train.Supervisor(logdir=FLAGS.save_path)
       config_proto = tf.ConfigProto(allow_soft_placement=soft_placement)
+      summary_op = tf.summary.merge_all()
+
+      def evaluate(session, testm, position):
+        total_epoch, train_round, i = position
+        length = reader.length
+        print(length)
+        for sublength in range(length):
+          run_epoch(session,testm, is_training = False)
+        predict_result.saveResult(train_round, test_path = FLAGS.test_path)
+
+      evaluator = None
+      if FLAGS.async_eval:
+        # a test model of its own, loaded from each snapshot
+        eval_graph = tf.Graph()
+        with eval_graph.as_default():
+          with tf.name_scope("Test"):
+            eval_test_input = PTBInput(config=eval_config, data=test_data, seq_length = test_seq_length, name="TestInput")
+            with tf.variable_scope("Model", reuse=None):
+              eval_testm = PTBModel(is_training=False, config=eval_config, input_=eval_test_input)
+        evaluator = background.BackgroundEvaluator(
+            tf.global_variables(), eval_graph,
+            lambda session, position, data: evaluate(session, eval_testm, position),
+            save_path=FLAGS.save_path, config=config_proto)
+
+      # the training inputs are fed, summaries are written after every epoch
+      sv = tf.train.Supervisor(logdir=FLAGS.save_path, summary_op=None)
+      if timings is not None:
+        timings.summary_writer = sv.summary_writer
       with sv.managed_session(config=config_proto) as session:
+        resume.restore(session, sv.saver, state)
         for total_epoch in range(config.max_max_max_epoch):
           for train_round in range(21):
+            if resume.done(state, total_epoch, train_round, config.max_max_epoch - 1):
+              continue
             print("=================")
             print("Now Training index: %d"%train_round)
-            tf.reset_default_graph()
             train_data,train_seq_length = reader.ptb_raw_data(FLAGS.data_path, is_training = True, index = train_round)
-            train_input = PTBInput(config=config, data=train_data, seq_length= train_seq_length, name="TrainInput")
-            m.resetInput(train_input)
+            train_input.set(train_data, train_seq_length, seed = train_round)
             for i in range(config.max_max_epoch):
+              if resume.done(state, total_epoch, train_round, i):
+                continue
               lr_decay = config.lr_decay ** max(i + 1 - config.max_epoch, 0.0)
               m.assign_lr(session, config.learning_rate * lr_decay)
               print("Epoch: %d Learning rate: %.3f" % (i + 1, session.run(m.lr)))
               train_perplexity = run_epoch(session, m, eval_op=m.train_op,
                                            verbose=True)
               print("Epoch: %d Train Perplexity: %.3f" % (i + 1, train_perplexity))
-            
-              length = reader.length
-              #save_file = open("./result_proba_"+str(train_round)+".txt","w")
-              print(length)
-              for sublength in range(length):
-                run_epoch(session,testm, is_training = False)
-              #save_file.close()
-              predict_result.saveResult(train_round, test_path = FLAGS.test_path)
+              if timings is not None:
+                timings.summarize(session.run(sv.global_step))
+              sv.summary_computed(session, session.run(summary_op, train_input.batch(0)))
+              if evaluator is not None:
+                evaluator.snapshot(session, (total_epoch, train_round, i), config.learning_rate * lr_decay, sv.global_step)
+                continue
+              evaluate(session, testm, (total_epoch, train_round, i))
 
               if os.path.exists(FLAGS.save_path):
                 print("Saving model to %s." % FLAGS.save_path)
-                sv.saver.save(session, FLAGS.save_path+"model.ckpt", global_step=sv.global_step)
+                checkpoint = sv.saver.save(session, FLAGS.save_path+"model.ckpt", global_step=sv.global_step)
+                resume.save(FLAGS.save_path, (total_epoch, train_round, i), checkpoint, config.learning_rate * lr_decay)
+            if memwatch.watch is not None:
+              print(memwatch.watch.report("after shard %d" % train_round))
+          if evaluator is not None:
+            print(evaluator.report())
+        if evaluator is not None:
+          evaluator.join()
+
+  elif mode == 2:
+    print("Enter Freeze Mode:")
+    reader.get_dict()
+    eval_config.batch_size = FLAGS.freeze_batch_size
+    with tf.Graph().as_default():
+      with tf.name_scope("Freeze"):
+        feed = freeze.FeedInput(eval_config.batch_size, eval_config.num_steps, column=True)
+        with tf.variable_scope("Model", reuse=None):
+          m = PTBModel(is_training=False, config=eval_config, input_=feed)
+      with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
+        util.restore_for_inference(session, FLAGS.save_path)
+        print("Wrote %s" % freeze.export(session, feed, freeze.token_logprob(m.logits, feed.input_data, feed.seq_length), FLAGS.save_path, freeze.LOGPROB))
+
+  elif mode == 3:
+    print("Enter Candidates Mode:")
+    reader.get_dict()
+    eval_config.batch_size = FLAGS.freeze_batch_size
+    eval_config.score_candidates = True
+    with tf.Graph().as_default():
+      with tf.name_scope("Candidates"):
+        feed = freeze.FeedInput(eval_config.batch_size, eval_config.num_steps, column=True)
+        with tf.variable_scope("Model", reuse=None):
+          m = PTBModel(is_training=False, config=eval_config, input_=feed)
+      with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as session:
+        util.restore_for_inference(session, FLAGS.save_path)
+        print("Wrote %s" % candidates.score_file(session, m, feed, eval_config.candidate_normalizer, FLAGS.test_path,
+                                                 FLAGS.similar_path, FLAGS.max_candidates))
 
   else:
     print("Enter Test Mode:")
@@ -565,18 +743,10 @@ def main(_):
       with tf.name_scope("Train"):
         test_input = PTBInput(config=eval_config, data=test_data, seq_length = test_seq_length, name="TrainInput")
         with tf.variable_scope("Model", reuse=None, initializer=initializer):
-          m = PTBModel(is_training=True, config=eval_config, input_=test_input)
+          m = PTBModel(is_training=False, config=eval_config, input_=test_input)
 
-      #tf.train.import_meta_graph("/media/zedom/Study/temp/-17148.meta")
-      #m.is_training = False
-      #m.import_ops()
-      sv = tf.train.Supervisor(logdir=FLAGS.save_path)
       config_proto = tf.ConfigProto(allow_soft_placement=True)
-
-      with sv.managed_session(config=config_proto) as session:
-        ckpt = tf.train.get_checkpoint_state(checkpoint_dir=FLAGS.save_path)
-        sv.saver.restore(session,ckpt.model_checkpoint_path)
-
+      with util.inference_session(FLAGS.save_path, config_proto) as session:
         length = reader.length
         #save_file = open("./result_proba_"+str(train_round)+".txt","w")
         print(length)
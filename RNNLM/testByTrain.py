@@ -1,7 +1,12 @@
+import glob
+import math
 import os
 import random
+import sys
 
 trainPath = "./corpus/total_cha.txt"
+corpusPath = "./corpus/"
+similarPath = "./similarList.txt"
 modelPath = "./model/model_big_e2/"
 testPath  = "./test/test_total"
 
@@ -38,8 +43,107 @@ def genTestFile( num = 500, correct_rate = 0.3 ):
 	ansf.close()
 
 
+def sampleCorpus( num, rng, corpus_path = corpusPath, parse = None ):
+	"""num rows drawn uniformly from every corpus/total_* shard, read as a stream.
 
-if not os.path.exists(testPath):
-	genTestFile()
+	Reservoir sampling with geometric skips (Li's algorithm L): only the
+	num kept rows are held in memory, so the shards may be far bigger than
+	memory. parse turns a line into the row to sample, or None for a line
+	that may not be drawn; those are left out before sampling, so that
+	fewer than num rows come back only when fewer are usable. parse runs on
+	every line to tell which ones are usable, so with it the skipped rows
+	are parsed too.
+	"""
+	reservoir = []
+	if num <= 0:
+		return reservoir
+	seen = 0
+	w = math.exp(math.log(rng.random())/num)
+	nextInd = num + int(math.log(rng.random())/math.log(1-w))
+	for shard in sorted(glob.glob(os.path.join(corpus_path, "total_*"))):
+		with open(shard) as f:
+			for line in f:
+				if parse is not None:
+					line = parse(line)
+					if line is None:
+						continue
+				if len(reservoir) < num:
+					reservoir.append(line)
+				elif seen == nextInd:
+					reservoir[rng.randint(0,num-1)] = line
+					w *= math.exp(math.log(rng.random())/num)
+					nextInd += 1 + int(math.log(rng.random())/math.log(1-w))
+				seen += 1
+	if seen < num:
+		print("Only %d usable rows in %s, sampling all of them instead of %d." % (seen, corpus_path, num))
+	return reservoir
 
-os.system("python3 rnnlm.py --model test --test_path %s --save_path %s"%(testPath, modelPath))
+
+def injectErrors( line, count, similar, rng ):
+	"""Replaces up to count characters of line by similar ones, returns their positions.
+
+	Like reader._corrupt_line of the BiLSTM models the first and last
+	characters are kept, and only characters with a similar one other than
+	themselves are replaced, so a sentence may get fewer errors than asked.
+	"""
+	choices = {}
+	for i in range(1,len(line)-1):
+		others = [str(w) for w in similar.get(int(line[i]),[]) if str(w) != line[i]]
+		if others:
+			choices[i] = others
+	positions = sorted(rng.sample(sorted(choices), min(count,len(choices))))
+	for i in positions:
+		line[i] = rng.choice(choices[i])
+	return positions
+
+
+def genTestSet( num = 500, rates = (0.3,0.5,0.2), max_errors = 3, seed = 0, test_path = testPath, corpus_path = corpusPath ):
+	"""Writes num test sentences sampled from all shards, with test_path+"_ans".
+
+	rates are the shares of sentences with 0, 1 and 2..max_errors errors;
+	errors come from similarList.txt and every position is written to the
+	_ans file as genTestFile does, -1 for a correct sentence. The same seed
+	and corpus give the same files.
+	"""
+	rng = random.Random(seed)
+	word_to_id = eval(open("./cha_to_id.txt").read())
+	id_to_word = {str(v):k for k,v in word_to_id.items()}
+	pad = str(len(word_to_id))
+	similar = eval(open(similarPath).read())
+	total = float(sum(rates))
+	bounds = [sum(rates[:i+1])/total for i in range(len(rates))]
+
+	def parse( row ):
+		line = [i for i in row.split() if i!=pad]
+		return line if len(line) >= 3 else None
+
+	counts = [0]*len(rates)
+	with open(test_path,"w") as testf, open(test_path+"_ans","w") as ansf:
+		for line in sampleCorpus(num, rng, corpus_path, parse):
+			r = rng.random()
+			kind = [r < b for b in bounds].index(True)
+			count = kind if kind < 2 else rng.randint(2,max(2,max_errors))
+			positions = injectErrors(line, count, similar, rng) if count else []
+			counts[min(len(positions),2)] += 1
+			testf.write(' '.join(id_to_word[word] for word in line)+"\n")
+			ansf.write((' '.join(str(i) for i in positions) if positions else "-1")+"\n")
+	print("Wrote %s: %d correct, %d with one error, %d with more." % (test_path, counts[0], counts[1], counts[2]))
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Generate a test set from the corpus shards and test the RNNLM on it.")
+	parser.add_argument("--num", type=int, default=500, help="Sentences to sample.")
+	parser.add_argument("--rates", default="0.3,0.5,0.2", help="Shares of sentences with 0, 1 and 2+ errors.")
+	parser.add_argument("--max_errors", type=int, default=3)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--test_path", default=testPath)
+	parser.add_argument("--corpus_path", default=corpusPath)
+	parser.add_argument("--regenerate", action="store_true", help="Overwrite an existing test set.")
+	parser.add_argument("--generate_only", action="store_true", help="Do not run the test afterwards.")
+	args = parser.parse_args()
+
+	if args.regenerate or not os.path.exists(args.test_path):
+		genTestSet(args.num, [float(r) for r in args.rates.split(",")], args.max_errors, args.seed, args.test_path, args.corpus_path)
+	if not args.generate_only:
+		os.system("%s rnnlm.py --model test --test_path %s --save_path %s"%(sys.executable, args.test_path, modelPath))
@@ -0,0 +1,143 @@
+"""Times one trainer's reader, producer, training step, inference step and report.
+
+Run by benchmark/suite.py from a directory made by benchmark/synthetic.py,
+since the readers load ./cha_to_id.txt and ./similarList.txt on import:
+
+$ cd /tmp/bench && python $REPO/benchmark/bench_model.py \
+    --model $REPO/BILSTMCHA/bilstm.py --out bilstm.json
+
+Flags the script does not know are passed on to the trainer, e.g.
+--rnn_mode BASIC or --stateless.
+"""
+import argparse
+import importlib
+import inspect
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+def _stats(times):
+  return {"median_s": float(np.median(times)), "min_s": float(np.min(times)),
+          "repeats": len(times)}
+
+
+def timed(fn, repeats):
+  """(last result, timing stats) of calling fn() repeats times."""
+  times = []
+  result = None
+  for _ in range(repeats):
+    start_time = time.time()
+    result = fn()
+    times.append(time.time() - start_time)
+  return result, _stats(times)
+
+
+def step_times(session, fetch, steps, warmup):
+  for _ in range(warmup):
+    session.run(fetch)
+  times = []
+  for _ in range(steps):
+    start_time = time.time()
+    session.run(fetch)
+    times.append(time.time() - start_time)
+  return _stats(times)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--model", required=True, help="Path of the trainer script.")
+  parser.add_argument("--data_dir", default="./")
+  parser.add_argument("--test_path", default="./test/test_synthetic")
+  parser.add_argument("--out", required=True, help="JSON file to write.")
+  parser.add_argument("--batch_size", type=int, default=0,
+                      help="Override the config batch size, 0 keeps it.")
+  parser.add_argument("--repeats", type=int, default=3)
+  parser.add_argument("--steps", type=int, default=20)
+  parser.add_argument("--warmup", type=int, default=3)
+  args, trainer_argv = parser.parse_known_args()
+
+  model_dir, script = os.path.split(os.path.abspath(args.model))
+  sys.path.insert(0, model_dir)
+  trainer = importlib.import_module(os.path.splitext(script)[0])
+  trainer.FLAGS([sys.argv[0], "--data_path", args.data_dir,
+                 "--test_path", args.test_path] + trainer_argv)
+  reader = trainer.reader
+  predict_result = trainer.predict_result
+  import tensorflow as tf
+
+  results = {}
+  shard, results["ptb_raw_data_train"] = timed(
+      lambda: reader.ptb_raw_data(args.data_dir, is_training=True, index=0),
+      args.repeats)
+  (test_data, test_seq_length), results["ptb_raw_data_test"] = timed(
+      lambda: reader.ptb_raw_data(args.test_path, is_training=False),
+      args.repeats)
+  train_data, train_seq_length = shard[0], shard[1]
+  if hasattr(reader, "corrupt"):
+    _, results["error_injection"] = timed(
+        lambda: reader.corrupt(train_data, train_seq_length, 47, seed=0),
+        args.repeats)
+
+  config, _ = trainer.get_config()
+  if args.batch_size:
+    config.batch_size = args.batch_size
+  eval_config, _ = trainer.get_config()
+  eval_config.batch_size = config.batch_size
+  eval_config.keep_prob = 1
+  test_kwargs = {}
+  if "is_training" in inspect.signature(trainer.PTBInput.__init__).parameters:
+    test_kwargs["is_training"] = False
+
+  with tf.Graph().as_default():
+    initializer = tf.random_uniform_initializer(-config.init_scale, config.init_scale)
+    start_time = time.time()
+    train_input = trainer.PTBInput(config=config, data=train_data,
+                                   seq_length=train_seq_length, name="TrainInput")
+    # one build, the producer folds the shard into graph constants
+    results["ptb_producer"] = _stats([time.time() - start_time])
+    with tf.variable_scope("Model", reuse=None, initializer=initializer):
+      m = trainer.PTBModel(is_training=True, config=config, input_=train_input)
+    test_input = trainer.PTBInput(config=eval_config, data=test_data,
+                                  seq_length=test_seq_length, name="TestInput",
+                                  **test_kwargs)
+    with tf.variable_scope("Model", reuse=True, initializer=initializer):
+      mtest = trainer.PTBModel(is_training=False, config=eval_config, input_=test_input)
+    with tf.Session() as session:
+      session.run(tf.global_variables_initializer())
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(session, coord)
+      m.assign_lr(session, config.learning_rate)
+      results["train_step"] = step_times(session, m.train_op, args.steps, args.warmup)
+      results["infer_step"] = step_times(
+          session, getattr(mtest, "unary_scores", mtest.logits), args.steps, args.warmup)
+      coord.request_stop()
+      coord.join(threads)
+
+  rng = np.random.RandomState(0)
+  if hasattr(predict_result, "savePredict"):
+    tags = rng.randint(0, 2, (len(test_seq_length), 47)).astype(np.int32)
+
+    def report():
+      predict_result.genPredict(tags, test_path=args.test_path)
+      return predict_result.savePredict(0, test_path=args.test_path)
+    _, results["savePredict"] = timed(report, args.repeats)
+  else:
+    lines = open(args.test_path).read().strip().split("\n")
+    sentence = "".join(
+        "".join("%s %f\n" % (c, -rng.rand() * 15) for c in line.split()[1:]) +
+        "===================\n" for line in lines)
+    _, results["evaluation_generate"] = timed(
+        lambda: predict_result.evaluation.generate(
+            sentence, 0, args.test_path, None), args.repeats)
+
+  with open(args.out, "w") as f:
+    json.dump({"model": args.model, "batch_size": config.batch_size,
+               "results": results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,77 @@
+"""Throughput and F1 of the BILSTMCHA encoders, BiLSTM against dilated conv.
+
+$ python benchmark/encoders.py --work_dir /tmp/bench
+$ python benchmark/encoders.py --work_dir /tmp/bench --test_path ./test/test_total \
+    --frozen ./model_proba/proba_total_bi/,./model_proba/proba_total_conv/
+
+Times the training and inference step of bilstm.py with --encoder lstm and
+--encoder conv, both on the same synthetic shard, with benchmark/
+bench_model.py. For F1, train both encoders with the same --corrupt_seed
+on the same shards, freeze them (pass --encoder again), and give their
+save paths to --frozen; ensemble/tradeoff.py then scores them on
+--test_path from the current directory.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import synthetic
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENCODERS = ["lstm", "conv"]
+
+
+def time_encoder(encoder, args, trainer_argv):
+  out = os.path.join(args.work_dir, "bilstm_%s.json" % encoder)
+  command = [sys.executable, os.path.join(REPO, "benchmark", "bench_model.py"),
+             "--model", os.path.join(REPO, "BILSTMCHA", "bilstm.py"), "--out", out,
+             "--repeats", "1", "--steps", str(args.steps),
+             "--batch_size", str(args.batch_size), "--encoder", encoder] + trainer_argv
+  print("Timing --encoder %s" % encoder)
+  with open(os.path.join(args.work_dir, "bilstm_%s.log" % encoder), "w") as log:
+    subprocess.check_call(command, cwd=args.work_dir, stdout=log, stderr=subprocess.STDOUT)
+  with open(out) as f:
+    result = json.load(f)
+  return result["batch_size"], result["results"]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--work_dir", default="./bench_data/")
+  parser.add_argument("--rows", type=int, default=20000, help="Rows of the synthetic shard.")
+  parser.add_argument("--test_rows", type=int, default=500)
+  parser.add_argument("--batch_size", type=int, default=0,
+                      help="Override the model batch size, 0 keeps the config's.")
+  parser.add_argument("--steps", type=int, default=20)
+  parser.add_argument("--frozen", default="",
+                      help="Save paths of the frozen lstm and conv models, for F1.")
+  parser.add_argument("--test_path", default="./test/test_total")
+  args, trainer_argv = parser.parse_known_args()
+
+  args.work_dir = os.path.abspath(args.work_dir)
+  if not os.path.exists(os.path.join(args.work_dir, "cha_to_id.txt")):
+    synthetic.generate(args.work_dir, 1, args.rows, args.test_rows)
+  timings = dict((encoder, time_encoder(encoder, args, trainer_argv)) for encoder in ENCODERS)
+
+  print("%-8s %14s %14s %16s %16s" % (
+      "encoder", "train ms/step", "infer ms/step", "train sent/s", "infer sent/s"))
+  for encoder in ENCODERS:
+    batch_size, results = timings[encoder]
+    train, infer = results["train_step"]["median_s"], results["infer_step"]["median_s"]
+    # the inference step of bench_model runs the batch size of the config too
+    print("%-8s %14.2f %14.2f %16.1f %16.1f" % (
+        encoder, 1000 * train, 1000 * infer, batch_size / train, batch_size / infer))
+  lstm, conv = timings["lstm"][1], timings["conv"][1]
+  print("conv speedup: train %.2fx, inference %.2fx" % (
+      lstm["train_step"]["median_s"] / conv["train_step"]["median_s"],
+      lstm["infer_step"]["median_s"] / conv["infer_step"]["median_s"]))
+
+  if args.frozen:
+    subprocess.check_call([sys.executable, os.path.join(REPO, "ensemble", "tradeoff.py"),
+                           "--models", args.frozen, "--test_path", args.test_path])
+
+
+if __name__ == "__main__":
+  main()
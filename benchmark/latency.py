@@ -0,0 +1,388 @@
+"""Online detection latency by sentence length and batch size, against an SLO.
+
+$ python benchmark/latency.py --work_dir /tmp/bench --out latency.json \
+    --checkpoints ./model/,./model_proba/proba_total_bi/,./model_crf/
+$ python benchmark/latency.py --work_dir /tmp/bench --random_init \
+    --concurrency 4 --rate 200 --out new.json --baseline latency.json
+
+Restores each model from its checkpoint into an inference graph fed from
+placeholders, one copy of the model per --batch_sizes entry sharing the
+same variables, and replays the test file as single-sentence requests.
+--concurrency workers serve the requests. A worker takes the requests that
+are waiting, up to the largest batch size, pads them to the smallest batch
+size that holds them and runs one session.run. With --rate, requests arrive
+as a Poisson process of that many per second and latency counts the time
+spent queued. Without it the whole file is queued at once, the workers run
+full batches back to back and latency counts from when a worker takes the
+request, which measures service time at saturation.
+
+Latency percentiles are reported per sentence length bucket
+(--length_buckets, upper bounds covering 1-47) and per batch size run,
+with the process CPU utilization over the replay. Groups whose p99 is
+above --slo_ms fail. The results are written as JSON, labelled with the
+git revision, so that runs of different builds compare with --baseline:
+p99 slowdowns above --tolerance are regressions. Either failure exits 1.
+
+Each model runs in a subprocess of its own, like benchmark/suite.py, with
+the work dir made by benchmark/synthetic.py as working directory.
+--random_init skips the checkpoint, to time the harness itself.
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS = ["RNNLM/rnnlm.py", "BILSTMCHA/bilstm.py", "BILSTM-CRF/lstm_crf.py"]
+NUM_STEPS = 47
+
+# imported by serve_model, once the trainer has parsed its flags
+tf = None
+
+
+def parse_ints(spec):
+  return sorted(int(part) for part in spec.split(",") if part.strip())
+
+
+class FeedInput(object):
+  """PTBInput stand-in whose batch is fed through placeholders.
+
+  The RNNLM producer gives seq_length as a [batch_size, 1] column, the
+  BiLSTM inputs reshape it to a vector; column follows the model.
+  """
+
+  def __init__(self, batch_size, num_steps, column=False):
+    self.batch_size = batch_size
+    self.num_steps = num_steps
+    self.epoch_size = 1
+    self.input_data = tf.placeholder(tf.int32, [batch_size, num_steps], name="input_data")
+    self.targets = tf.placeholder(tf.int32, None, name="targets")
+    self.seq_length = tf.placeholder(
+        tf.int32, [batch_size, 1] if column else [batch_size], name="seq_length")
+    self.column = column
+
+
+class Server(object):
+  """One inference graph per batch size over the restored variables."""
+
+  def __init__(self, trainer, batch_sizes, checkpoint, column, threads=0):
+    config, _ = trainer.get_config()
+    config.keep_prob = 1
+    self.pad_id = len(trainer.reader.word_to_id)
+    self.batch_sizes = batch_sizes
+    self.graph = tf.Graph()
+    self.models = {}
+    with self.graph.as_default():
+      initializer = tf.random_uniform_initializer(-config.init_scale, config.init_scale)
+      for i, batch_size in enumerate(batch_sizes):
+        config.batch_size = batch_size
+        with tf.name_scope("Serve_%d" % batch_size):
+          input_ = FeedInput(batch_size, config.num_steps, column)
+          with tf.variable_scope("Model", reuse=i > 0, initializer=initializer):
+            model = trainer.PTBModel(is_training=False, config=config, input_=input_)
+        # the CRF decodes in the graph, the others fetch per-step outputs
+        self.models[batch_size] = (input_, getattr(model, "decode_tags", model.logits))
+      saver = tf.train.Saver(tf.global_variables())
+      init = tf.global_variables_initializer()
+    self.session = tf.Session(graph=self.graph, config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads))
+    if checkpoint:
+      saver.restore(self.session, checkpoint)
+    else:
+      self.session.run(init)
+
+  def bucket(self, n):
+    for batch_size in self.batch_sizes:
+      if batch_size >= n:
+        return batch_size
+    return self.batch_sizes[-1]
+
+  def run(self, rows, lengths):
+    """Answers len(rows) requests in one step, returns the batch size run."""
+    batch_size = self.bucket(len(rows))
+    input_, fetch = self.models[batch_size]
+    data = np.full((batch_size, input_.num_steps), self.pad_id, dtype=np.int32)
+    seq_length = np.ones(batch_size, dtype=np.int32)
+    data[:len(rows)] = rows
+    seq_length[:len(rows)] = lengths
+    if input_.column:
+      seq_length = seq_length.reshape([-1, 1])
+    self.session.run(fetch, {input_.input_data: data, input_.seq_length: seq_length})
+    return batch_size
+
+
+def replay(server, data, lengths, args):
+  """Serves every test sentence once, returns per-request records and CPU use."""
+  requests = queue.Queue()
+  records = []
+  lock = threading.Lock()
+  max_batch = server.batch_sizes[-1]
+  rng = np.random.RandomState(args.seed)
+  order = np.arange(len(lengths))
+  if args.requests:
+    order = rng.choice(order, args.requests)
+
+  def worker():
+    while True:
+      item = requests.get()
+      if item is None:
+        return
+      batch = [item]
+      deadline = time.time() + args.batch_wait_ms / 1000.0
+      while len(batch) < max_batch:
+        try:
+          item = requests.get(timeout=max(0.0, deadline - time.time())) \
+              if args.batch_wait_ms else requests.get_nowait()
+        except queue.Empty:
+          break
+        if item is None:
+          requests.put(None)
+          break
+        batch.append(item)
+      now = time.time()
+      index = [i for i, _ in batch]
+      # without --rate a request arrives when a worker picks it up
+      arrival = [now if t is None else t for _, t in batch]
+      start_time = time.time()
+      batch_size = server.run(data[index], lengths[index])
+      done = time.time()
+      with lock:
+        for i, t in zip(index, arrival):
+          records.append((int(lengths[i]), batch_size, len(batch), done - t,
+                          done - start_time))
+
+  for batch_size in server.batch_sizes:
+    for _ in range(args.warmup):
+      server.run(data[:batch_size], lengths[:batch_size])
+
+  threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+  cpu_start = os.times()
+  start_time = time.time()
+  for thread in threads:
+    thread.start()
+  if args.rate > 0:
+    arrival = start_time + np.cumsum(rng.exponential(1.0 / args.rate, len(order)))
+    for i, t in zip(order, arrival):
+      delay = t - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      requests.put((i, t))
+  else:
+    for i in order:
+      requests.put((i, None))
+  for _ in threads:
+    requests.put(None)
+  for thread in threads:
+    thread.join()
+  wall = time.time() - start_time
+  cpu_end = os.times()
+  cpu = (cpu_end[0] - cpu_start[0]) + (cpu_end[1] - cpu_start[1])
+  return records, {"wall_s": wall, "cpu_s": cpu,
+                   "cpu_cores": cpu / wall if wall else 0.0,
+                   "cpu_util": cpu / wall / multiprocessing.cpu_count() if wall else 0.0,
+                   "throughput_rps": len(records) / wall if wall else 0.0}
+
+
+def _percentiles(latencies):
+  ms = 1000.0 * np.asarray(latencies)
+  return {"count": len(ms), "mean_ms": float(ms.mean()),
+          "p50_ms": float(np.percentile(ms, 50)), "p90_ms": float(np.percentile(ms, 90)),
+          "p99_ms": float(np.percentile(ms, 99)), "max_ms": float(ms.max())}
+
+
+def summarize(records, length_buckets):
+  """Latency percentiles overall, per length bucket and per batch size run."""
+  groups = {"all": [r[3] for r in records]}
+  low = 1
+  for high in length_buckets:
+    latencies = [r[3] for r in records if low <= r[0] <= high]
+    if latencies:
+      groups["length:%02d-%02d" % (low, high)] = latencies
+    low = high + 1
+  for batch_size in sorted(set(r[1] for r in records)):
+    groups["batch:%03d" % batch_size] = [r[3] for r in records if r[1] == batch_size]
+  summary = dict((name, _percentiles(latencies)) for name, latencies in groups.items())
+  summary["all"]["service_p50_ms"] = float(np.percentile([r[4] for r in records], 50) * 1000.0)
+  summary["all"]["mean_fill"] = float(np.mean([r[2] / float(r[1]) for r in records]))
+  return summary
+
+
+def serve_model(args, trainer_argv):
+  """Runs in the model's subprocess, writes its JSON to args.out."""
+  global tf
+  model_dir, script = os.path.split(os.path.abspath(args.model))
+  sys.path.insert(0, model_dir)
+  trainer = importlib.import_module(os.path.splitext(script)[0])
+  trainer.FLAGS([sys.argv[0], "--data_path", args.work_dir,
+                 "--test_path", args.test_path] + trainer_argv)
+  import tensorflow as tf
+
+  checkpoint = None
+  if not args.random_init:
+    checkpoint_dir = args.checkpoint or trainer.FLAGS.save_path
+    checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+    if checkpoint is None:
+      sys.exit("No checkpoint in %s, train first or pass --random_init." % checkpoint_dir)
+  data, lengths = trainer.reader.ptb_raw_data(args.test_path, is_training=False)
+  data = np.asarray(data, dtype=np.int32).reshape([-1, NUM_STEPS])
+  lengths = np.asarray(lengths, dtype=np.int32).reshape([-1])[:len(data)]
+
+  batch_sizes = parse_ints(args.batch_sizes)
+  server = Server(trainer, batch_sizes, checkpoint,
+                  column=os.path.basename(model_dir) == "RNNLM", threads=args.threads)
+  records, cpu = replay(server, data, lengths, args)
+  with open(args.out, "w") as f:
+    json.dump({"model": args.model, "checkpoint": checkpoint, "cpu": cpu,
+               "latency": summarize(records, parse_ints(args.length_buckets))},
+              f, indent=2, sort_keys=True)
+
+
+def run_model(model, checkpoint, args, trainer_argv):
+  out = os.path.join(args.work_dir, "latency_" + os.path.basename(model) + ".json")
+  command = [sys.executable, os.path.abspath(__file__), "--model", os.path.join(REPO, model),
+             "--out", out, "--work_dir", args.work_dir, "--test_path", args.test_path,
+             "--batch_sizes", args.batch_sizes, "--length_buckets", args.length_buckets,
+             "--concurrency", str(args.concurrency), "--rate", str(args.rate),
+             "--batch_wait_ms", str(args.batch_wait_ms), "--requests", str(args.requests),
+             "--warmup", str(args.warmup), "--threads", str(args.threads),
+             "--seed", str(args.seed)]
+  if checkpoint:
+    command += ["--checkpoint", os.path.abspath(checkpoint)]
+  if args.random_init:
+    command.append("--random_init")
+  print("Replaying %s" % model)
+  with open(out[:-len(".json")] + ".log", "w") as log:
+    subprocess.check_call(command + trainer_argv, cwd=args.work_dir, stdout=log,
+                          stderr=subprocess.STDOUT)
+  with open(out) as f:
+    result = json.load(f)
+  return {"cpu": result["cpu"], "latency": result["latency"],
+          "checkpoint": result["checkpoint"]}
+
+
+def check(results, baseline, slo_ms, tolerance):
+  """Prints every group's p99 against the SLO and baseline, returns failures."""
+  failures = []
+  print("%-24s %-14s %7s %9s %9s %9s %10s %8s" % (
+      "model", "group", "count", "p50", "p99", "SLO", "baseline", "change"))
+  for model in sorted(results):
+    latency = results[model]["latency"]
+    for name in sorted(latency):
+      p99 = latency[name]["p99_ms"]
+      old = baseline.get(model, {}).get("latency", {}).get(name, {}).get("p99_ms")
+      flags = []
+      if slo_ms and p99 > slo_ms:
+        flags.append("SLO")
+        failures.append((model, name, "slo"))
+      change = ""
+      if old:
+        change = "%+7.1f%%" % (100.0 * (p99 / old - 1.0))
+        if p99 / old - 1.0 > tolerance:
+          flags.append("REGRESSION")
+          failures.append((model, name, "regression"))
+      print("%-24s %-14s %7d %8.2fms %8.2fms %9s %10s %8s %s" % (
+          model, name, latency[name]["count"], latency[name]["p50_ms"], p99,
+          "%.1fms" % slo_ms if slo_ms else "-", "%.2fms" % old if old else "-",
+          change, " ".join(flags)))
+    cpu = results[model]["cpu"]
+    print("%-24s %.1f req/s, %.2f cores, %.1f%% CPU utilization" % (
+        model, cpu["throughput_rps"], cpu["cpu_cores"], 100.0 * cpu["cpu_util"]))
+  return failures
+
+
+def revision():
+  try:
+    return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                   cwd=REPO, stderr=subprocess.STDOUT).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return ""
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--work_dir", default="./bench_data/")
+  parser.add_argument("--test_path", default="./test/test_synthetic")
+  parser.add_argument("--out", default="", help="Write the results to this JSON file.")
+  parser.add_argument("--models", default=",".join(MODELS))
+  parser.add_argument("--checkpoints", default="",
+                      help="Checkpoint dir per model, empty keeps the trainer's save_path.")
+  parser.add_argument("--random_init", action="store_true",
+                      help="Serve initialized variables instead of a checkpoint.")
+  parser.add_argument("--batch_sizes", default="1,4,16,64",
+                      help="Batch sizes a worker can run, requests are padded up.")
+  parser.add_argument("--length_buckets", default="8,16,24,32,40,47",
+                      help="Upper bounds of the sentence length buckets.")
+  parser.add_argument("--concurrency", type=int, default=1, help="Serving workers.")
+  parser.add_argument("--rate", type=float, default=0.0,
+                      help="Poisson arrivals per second, 0 for a closed loop.")
+  parser.add_argument("--batch_wait_ms", type=float, default=0.0,
+                      help="How long a worker waits to fill its batch.")
+  parser.add_argument("--requests", type=int, default=0,
+                      help="Requests to replay, sampled from the test file; 0 sends each once.")
+  parser.add_argument("--warmup", type=int, default=3, help="Untimed runs per batch size.")
+  parser.add_argument("--threads", type=int, default=0,
+                      help="TensorFlow intra and inter op threads, 0 lets it choose.")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--slo_ms", type=float, default=0.0, help="p99 latency target.")
+  parser.add_argument("--label", default="", help="Build label, the git revision if empty.")
+  parser.add_argument("--baseline", default="", help="Results JSON to compare with.")
+  parser.add_argument("--compare", default="",
+                      help="Check this results JSON against --baseline, run nothing.")
+  parser.add_argument("--tolerance", type=float, default=0.10,
+                      help="p99 slowdown flagged as a regression, 0.10 is 10%%.")
+  parser.add_argument("--model", default="", help=argparse.SUPPRESS)
+  parser.add_argument("--checkpoint", default="", help=argparse.SUPPRESS)
+  args, trainer_argv = parser.parse_known_args()
+
+  if args.model:
+    return serve_model(args, trainer_argv)
+
+  if args.compare:
+    with open(args.compare) as f:
+      results = json.load(f)["results"]
+  else:
+    args.work_dir = os.path.abspath(args.work_dir)
+    models = args.models.split(",")
+    checkpoints = args.checkpoints.split(",") if args.checkpoints else [""] * len(models)
+    if len(checkpoints) != len(models):
+      sys.exit("--checkpoints needs one entry per model.")
+    results = {}
+    for model, checkpoint in zip(models, checkpoints):
+      results[model] = run_model(model, checkpoint, args, trainer_argv)
+    if args.out:
+      with open(args.out, "w") as f:
+        json.dump({"label": args.label or revision(),
+                   "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "host": platform.node(), "cpus": multiprocessing.cpu_count(),
+                   "python": platform.python_version(),
+                   "settings": dict((k, getattr(args, k)) for k in (
+                       "batch_sizes", "length_buckets", "concurrency", "rate",
+                       "batch_wait_ms", "requests", "threads", "random_init")),
+                   "results": results}, f, indent=2, sort_keys=True)
+
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)["results"]
+  failures = check(results, baseline, args.slo_ms, args.tolerance)
+  if failures:
+    print("%d groups over the SLO or regressed above %.0f%%" % (
+        len(failures), 100 * args.tolerance))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,72 @@
+"""Step time of Adam against LazyAdam on the BiLSTM tagger shapes.
+
+Builds the BILSTMCHA graph shape (9174x400 embedding, one BiLSTM layer of
+400 units, 2-way softmax, clipped gradients) on random batches, so no
+corpus is needed:
+
+$ python benchmark/optimizer_step.py --batch_size 128 --steps 100
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+flags = tf.flags
+flags.DEFINE_integer("batch_size", 128, "Sentences per step.")
+flags.DEFINE_integer("num_steps", 47, "Padded sentence length.")
+flags.DEFINE_integer("vocab_size", 9174, "Embedding rows.")
+flags.DEFINE_integer("hidden_size", 400, "LSTM units and embedding size.")
+flags.DEFINE_integer("steps", 100, "Timed steps per optimizer.")
+flags.DEFINE_integer("warmup", 10, "Untimed steps per optimizer.")
+FLAGS = flags.FLAGS
+
+
+def step_time(lazy):
+  with tf.Graph().as_default():
+    tf.set_random_seed(0)
+    inputs = tf.random_uniform([FLAGS.batch_size, FLAGS.num_steps],
+                               maxval=FLAGS.vocab_size, dtype=tf.int32)
+    labels = tf.random_uniform([FLAGS.batch_size, FLAGS.num_steps],
+                               maxval=2, dtype=tf.int32)
+    with tf.device("/cpu:0"):
+      embedding = tf.get_variable(
+          "embedding", [FLAGS.vocab_size, FLAGS.hidden_size])
+      embedded = tf.nn.embedding_lookup(embedding, inputs)
+    cell_fw = tf.contrib.rnn.LSTMBlockCell(FLAGS.hidden_size, forget_bias=0.0)
+    cell_bw = tf.contrib.rnn.LSTMBlockCell(FLAGS.hidden_size, forget_bias=0.0)
+    outputs, _ = tf.nn.bidirectional_dynamic_rnn(
+        cell_fw, cell_bw, embedded, dtype=tf.float32)
+    logits = tf.contrib.layers.fully_connected(
+        tf.concat(outputs, 2), 2, activation_fn=None)
+    cost = tf.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=labels, logits=logits))
+    tvars = tf.trainable_variables()
+    grads, _ = tf.clip_by_global_norm(tf.gradients(cost, tvars), 3)
+    if lazy:
+      optimizer = tf.contrib.opt.LazyAdamOptimizer(0.0001)
+    else:
+      optimizer = tf.train.AdamOptimizer(0.0001)
+    train_op = optimizer.apply_gradients(zip(grads, tvars))
+    with tf.Session() as session:
+      session.run(tf.global_variables_initializer())
+      for _ in range(FLAGS.warmup):
+        session.run(train_op)
+      times = []
+      for _ in range(FLAGS.steps):
+        start_time = time.time()
+        session.run(train_op)
+        times.append(time.time() - start_time)
+  return np.median(times), np.mean(times)
+
+
+def main(_):
+  print("batch_size: %d, vocab_size: %d, hidden_size: %d"
+        % (FLAGS.batch_size, FLAGS.vocab_size, FLAGS.hidden_size))
+  for name, lazy in (("Adam", False), ("LazyAdam", True)):
+    median, mean = step_time(lazy)
+    print("%-8s median %.1f ms/step, mean %.1f ms/step"
+          % (name, median * 1000, mean * 1000))
+
+
+if __name__ == "__main__":
+  tf.app.run()
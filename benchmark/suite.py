@@ -0,0 +1,111 @@
+"""Benchmark suite: reader, producer, model step and evaluation of every model.
+
+$ python benchmark/suite.py --work_dir /tmp/bench --out results.json
+$ python benchmark/suite.py --work_dir /tmp/bench --out new.json --baseline results.json
+$ python benchmark/suite.py --compare new.json --baseline results.json
+
+Builds a synthetic corpus in work_dir with benchmark/synthetic.py when
+there is none, then times each trainer in a subprocess of its own, because
+each model directory has its own `my` package. The results are written as
+JSON. Given a baseline, every timing that got slower by more than
+--tolerance is flagged as a regression and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import synthetic
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS = ["RNNLM/rnnlm.py", "BILSTMCHA/bilstm.py", "BILSTM-CRF/lstm_crf.py"]
+
+
+def run_model(model, args):
+  out = os.path.join(args.work_dir, os.path.basename(model) + ".json")
+  command = [sys.executable, os.path.join(REPO, "benchmark", "bench_model.py"),
+             "--model", os.path.join(REPO, model), "--out", out,
+             "--repeats", str(args.repeats), "--steps", str(args.steps),
+             "--batch_size", str(args.batch_size)]
+  print("Timing %s" % model)
+  with open(os.path.join(args.work_dir, os.path.basename(model) + ".log"), "w") as log:
+    subprocess.check_call(command, cwd=args.work_dir, stdout=log,
+                          stderr=subprocess.STDOUT)
+  with open(out) as f:
+    return json.load(f)["results"]
+
+
+def compare(results, baseline, tolerance):
+  """Prints current against baseline medians, returns the regressions."""
+  regressions = []
+  print("%-24s %-28s %10s %10s %8s" % ("model", "timing", "baseline", "current", "change"))
+  for model in sorted(results):
+    for name in sorted(results[model]):
+      if name not in baseline.get(model, {}):
+        continue
+      old = baseline[model][name]["median_s"]
+      new = results[model][name]["median_s"]
+      change = new / old - 1.0 if old > 0 else 0.0
+      flag = ""
+      if change > tolerance:
+        flag = "REGRESSION"
+        regressions.append((model, name, change))
+      print("%-24s %-28s %9.4fs %9.4fs %+7.1f%% %s" % (
+          model, name, old, new, 100.0 * change, flag))
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--work_dir", default="./bench_data/")
+  parser.add_argument("--out", default="", help="Write the results to this JSON file.")
+  parser.add_argument("--models", default=",".join(MODELS))
+  parser.add_argument("--shards", type=int, default=1)
+  parser.add_argument("--rows", type=int, default=20000, help="Rows per shard.")
+  parser.add_argument("--test_rows", type=int, default=500)
+  parser.add_argument("--batch_size", type=int, default=0,
+                      help="Override the model batch size, 0 keeps each config's.")
+  parser.add_argument("--repeats", type=int, default=3)
+  parser.add_argument("--steps", type=int, default=20)
+  parser.add_argument("--baseline", default="", help="Results JSON to compare with.")
+  parser.add_argument("--compare", default="",
+                      help="Compare this results JSON with --baseline, run nothing.")
+  parser.add_argument("--tolerance", type=float, default=0.10,
+                      help="Slowdown flagged as a regression, 0.10 is 10%%.")
+  args = parser.parse_args()
+
+  if args.compare:
+    with open(args.compare) as f:
+      results = json.load(f)["results"]
+  else:
+    args.work_dir = os.path.abspath(args.work_dir)
+    if not os.path.exists(os.path.join(args.work_dir, "cha_to_id.txt")):
+      synthetic.generate(args.work_dir, args.shards, args.rows, args.test_rows)
+    results = {}
+    for model in args.models.split(","):
+      results[model] = run_model(model, args)
+    if args.out:
+      with open(args.out, "w") as f:
+        json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "host": platform.node(), "python": platform.python_version(),
+                   "rows": args.rows, "test_rows": args.test_rows,
+                   "results": results}, f, indent=2, sort_keys=True)
+
+  if not args.baseline:
+    for model in sorted(results):
+      for name in sorted(results[model]):
+        print("%-24s %-28s %9.4fs" % (model, name, results[model][name]["median_s"]))
+    return
+  with open(args.baseline) as f:
+    baseline = json.load(f)["results"]
+  regressions = compare(results, baseline, args.tolerance)
+  if regressions:
+    print("%d regressions above %.0f%%" % (len(regressions), 100 * args.tolerance))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,75 @@
+"""Synthetic corpus in the layout the readers load, for the benchmarks.
+
+$ python benchmark/synthetic.py --out_dir /tmp/bench --shards 2 --rows 20000
+
+writes under out_dir:
+
+  cha_to_id.txt             9173 characters, ids 0..9172, 9173 pads
+  similarList.txt           confusion sets, id -> similar ids
+  corpus/total_XX           rows of 47 ids, padded with 9173
+  length/length_XX          sentence length of every row
+  test/test_synthetic       test sentences, one per line, characters
+  test/test_synthetic_ans   error positions of every test sentence, or -1
+
+The vocabulary size is fixed, the readers and reports assume 9173
+characters plus the pad id.
+"""
+import argparse
+import io
+import os
+
+import numpy as np
+
+VOCAB = 9173
+NUM_STEPS = 47
+
+
+def generate(out_dir, shards=2, rows=20000, test_rows=500, seed=0):
+  """Writes the corpus and returns the path of its test file."""
+  rng = np.random.RandomState(seed)
+  for sub in ("corpus", "length", "test", "report"):
+    if not os.path.exists(os.path.join(out_dir, sub)):
+      os.makedirs(os.path.join(out_dir, sub))
+
+  chars = [chr(0x4e00 + i) for i in range(VOCAB)]
+  with io.open(os.path.join(out_dir, "cha_to_id.txt"), "w", encoding="utf-8") as f:
+    f.write(repr(dict((c, i) for i, c in enumerate(chars))))
+  similar = {}
+  for i in rng.choice(VOCAB, VOCAB * 3 // 5, replace=False):
+    similar[int(i)] = [int(j) for j in rng.randint(0, VOCAB, rng.randint(2, 6))]
+  with open(os.path.join(out_dir, "similarList.txt"), "w") as f:
+    f.write(repr(similar))
+
+  for index in range(shards):
+    lengths = rng.randint(3, NUM_STEPS + 1, rows)
+    data = rng.randint(0, VOCAB, (rows, NUM_STEPS))
+    data[np.arange(NUM_STEPS)[None, :] >= lengths[:, None]] = VOCAB
+    np.savetxt(os.path.join(out_dir, "corpus", "total_%02d" % index), data, fmt="%d")
+    np.savetxt(os.path.join(out_dir, "length", "length_%02d" % index), lengths, fmt="%d")
+
+  test_path = os.path.join(out_dir, "test", "test_synthetic")
+  with io.open(test_path, "w", encoding="utf-8") as f, open(test_path + "_ans", "w") as ans:
+    for _ in range(test_rows):
+      length = rng.randint(3, NUM_STEPS + 1)
+      f.write(u" ".join(chars[i] for i in rng.randint(0, VOCAB, length)) + u"\n")
+      if rng.rand() < 0.5:
+        ans.write("-1\n")
+      else:
+        errors = sorted(set(rng.randint(1, length - 1, rng.randint(1, 3))))
+        ans.write(" ".join(str(e) for e in errors) + "\n")
+  return test_path
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--out_dir", default="./bench_data/")
+  parser.add_argument("--shards", type=int, default=2)
+  parser.add_argument("--rows", type=int, default=20000, help="Rows per shard.")
+  parser.add_argument("--test_rows", type=int, default=500)
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  print(generate(args.out_dir, args.shards, args.rows, args.test_rows, args.seed))
+
+
+if __name__ == "__main__":
+  main()
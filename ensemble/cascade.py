@@ -0,0 +1,174 @@
+"""Cascade: a cheap sentence gate in front of per-token language model scoring.
+
+Most test sentences hold no error, yet every one pays for the full softmax
+of the language model. The gate, a frozen BILSTMCHA tagger, scores every
+sentence first: its sentence score is the largest P(error) of any of its
+characters. Only sentences scoring at least --gate_threshold go on to the
+frozen RNNLM or BiRNNLM, whose flags are the cascade's output; the others
+are reported error free.
+
+$ python BILSTMCHA/bilstm.py --model freeze --save_path ./model_proba/proba_total_bi/
+$ python RNNLM/birnnlm.py --model freeze --save_path ./model/model_bi/
+$ python ensemble/cascade.py --test_path ./test/test_total \
+    --gate ./model_proba/proba_total_bi/ --scorer ./model/model_bi/ \
+    --gate_threshold 0.2 --sweep --plot ./report/cascade.png
+
+The scorer also runs over every sentence, as it does without the cascade,
+for the baseline. --sweep then replays the gate over a range of thresholds
+on the scores already computed: for each it prints the share of sentences
+passed, the throughput estimated from the measured gate and scorer time
+per sentence, the scorer flags lost to the gate and, with a test_path_ans,
+the recall lost against the ungated scorer. --plot draws recall loss
+against throughput gained, it needs matplotlib.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import ensemble
+from my import freeze
+
+
+def sentence_score(gate, scores, sequence_length):
+  """Largest P(error) the gate gives any character of each sentence."""
+  valid = gate.valid(sequence_length, scores.shape[1])
+  return np.where(valid, scores, 0.0).max(axis=1)
+
+
+def flags(model, scores, sequence_length):
+  return (model.error_score(scores) > 0.5) & model.valid(sequence_length, scores.shape[1])
+
+
+def timed_score(model, data, sequence_length, pad_id):
+  start_time = time.time()
+  scores = model.score(data, sequence_length, pad_id)
+  return scores, time.time() - start_time
+
+
+def sweep(thresholds, gated, full_flags, gate_time, scorer_time, answers):
+  """One row per gate threshold, from scores of every sentence by both models."""
+  sentences = len(gated)
+  full_found = full_flags.sum()
+  full_recall = None
+  if answers is not None:
+    full_recall = ensemble.precision_recall(ensemble.positions(full_flags), answers)[1]
+  rows = []
+  print("%9s %8s %12s %8s %10s %10s" % (
+      "threshold", "passed", "sentences/s", "speedup", "lost flags", "recall -"))
+  for threshold in thresholds:
+    passed = gated >= threshold
+    seconds = gate_time + scorer_time * passed.mean()
+    cascade_flags = full_flags & passed[:, None]
+    lost = 1.0 - cascade_flags.sum() / float(full_found) if full_found else 0.0
+    recall_loss = None
+    if answers is not None:
+      recall = ensemble.precision_recall(ensemble.positions(cascade_flags), answers)[1]
+      recall_loss = full_recall - recall
+    rows.append((threshold, passed.mean(), sentences / seconds, scorer_time / seconds,
+                 lost, recall_loss))
+    print("%9.3f %7.1f%% %12.1f %7.2fx %9.1f%% %10s" % (
+        threshold, 100 * passed.mean(), sentences / seconds, scorer_time / seconds,
+        100 * lost, "-" if recall_loss is None else "%.1f%%" % (100 * recall_loss)))
+  return rows
+
+
+def plot(rows, path):
+  try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+  except ImportError:
+    print("matplotlib is not installed, no plot")
+    return
+  speedup = [row[3] for row in rows]
+  # recall against _ans when there is one, else the scorer's own flags
+  if rows[0][5] is None:
+    loss, label = [100 * row[4] for row in rows], "scorer flags lost (%)"
+  else:
+    loss, label = [100 * row[5] for row in rows], "recall lost (%)"
+  fig, ax = plt.subplots()
+  ax.plot(speedup, loss, "o-")
+  for row, x, y in zip(rows, speedup, loss):
+    ax.annotate("%.2f" % row[0], (x, y), textcoords="offset points", xytext=(4, 4),
+                fontsize=7)
+  ax.set_xlabel("throughput gained (x ungated scorer)")
+  ax.set_ylabel(label)
+  ax.set_title("Cascade gate thresholds")
+  ax.grid(True)
+  fig.savefig(path, dpi=120)
+  print("Plot written to %s" % path)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--gate", required=True, help="Save path of the frozen tagger.")
+  parser.add_argument("--scorer", required=True,
+                      help="Save path of the frozen RNNLM or BiRNNLM.")
+  parser.add_argument("--test_path", default="./test/test_total")
+  parser.add_argument("--gate_threshold", type=float, default=0.2,
+                      help="Sentences whose largest P(error) is below this skip the scorer.")
+  parser.add_argument("--threshold", type=float, default=None,
+                      help="log p threshold of the scorer, its kind's default if unset.")
+  parser.add_argument("--threads", type=int, default=0,
+                      help="TensorFlow intra and inter op threads per session, 0 lets it choose.")
+  parser.add_argument("--out", default="", help="Write the positions found, _ans format.")
+  parser.add_argument("--sweep", action="store_true", help="Sweep the gate threshold.")
+  parser.add_argument("--sweep_thresholds", default="",
+                      help="Comma separated gate thresholds, 0.05 to 0.95 by default.")
+  parser.add_argument("--plot", default="", help="Write the sweep plot to this file.")
+  args = parser.parse_args()
+
+  import tensorflow as tf
+  config = tf.ConfigProto(intra_op_parallelism_threads=args.threads,
+                          inter_op_parallelism_threads=args.threads)
+  gate = freeze.FrozenModel(args.gate, config=config)
+  scorer = freeze.FrozenModel(args.scorer, args.threshold, config)
+  if gate.kind != freeze.ERROR_PROBA or scorer.kind != freeze.LOGPROB:
+    sys.exit("--gate needs a frozen tagger and --scorer a frozen language model.")
+
+  data, sequence_length = ensemble.encode(args.test_path)
+  pad_id = len(ensemble.reader.word_to_id)
+  # untimed, the first run of a graph sets it up
+  for model in (gate, scorer):
+    model.score(data[:1], sequence_length[:1], pad_id)
+
+  gate_scores, gate_time = timed_score(gate, data, sequence_length, pad_id)
+  gated = sentence_score(gate, gate_scores, sequence_length)
+  passed = gated >= args.gate_threshold
+  cascade_scores = np.zeros(data.shape, dtype=np.float32)
+  cascade_scores[passed], cascade_time = timed_score(
+      scorer, data[passed], sequence_length[passed], pad_id)
+  cascade_flags = flags(scorer, cascade_scores, sequence_length) & passed[:, None]
+  full_scores, scorer_time = timed_score(scorer, data, sequence_length, pad_id)
+  full_flags = flags(scorer, full_scores, sequence_length)
+  if args.out:
+    ensemble.write_ans(args.out, ensemble.positions(cascade_flags))
+
+  sentences = len(data)
+  print("%d sentences, %d (%.1f%%) passed the gate at %.3f" % (
+      sentences, passed.sum(), 100 * passed.mean(), args.gate_threshold))
+  print("scorer alone  %.2fs, %.1f sentences/s" % (scorer_time, sentences / scorer_time))
+  print("cascade       %.2fs (gate %.2fs), %.1f sentences/s, %.2fx" % (
+      gate_time + cascade_time, gate_time, sentences / (gate_time + cascade_time),
+      scorer_time / (gate_time + cascade_time)))
+  answers = ensemble.read_answers(args.test_path, data.shape[1])
+  if answers is not None:
+    ensemble.report(scorer.name, ensemble.positions(full_flags), answers)
+    ensemble.report("cascade", ensemble.positions(cascade_flags), answers)
+
+  if args.sweep or args.plot:
+    if args.sweep_thresholds:
+      thresholds = [float(t) for t in args.sweep_thresholds.split(",")]
+    else:
+      thresholds = np.linspace(0.05, 0.95, 19)
+    rows = sweep(thresholds, gated, full_flags, gate_time, scorer_time, answers)
+    if args.plot:
+      plot(rows, args.plot)
+  gate.close()
+  scorer.close()
+
+
+if __name__ == "__main__":
+  main()
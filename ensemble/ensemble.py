@@ -0,0 +1,208 @@
+"""Runs several frozen detectors on one encoding of a test file and combines them.
+
+Freeze every model once, from the directory holding cha_to_id.txt:
+
+$ python RNNLM/rnnlm.py --model freeze --save_path ./model/model_total_e2/
+$ python RNNLM/birnnlm.py --model freeze --save_path ./model/model_bi/
+$ python BILSTMCHA/bilstm.py --model freeze --save_path ./model_proba/proba_total_bi/
+
+then
+
+$ python ensemble/ensemble.py --test_path ./test/test_total --combine weight \
+    --models ./model/model_total_e2/,./model/model_bi/,./model_proba/proba_total_bi/ \
+    --weights 1,1,2 --out ./report/ensemble_total --sequential
+
+The test file is read and encoded once and cut into batches once. Every
+model scores all batches in a thread and a session of its own, so the
+models run side by side. Scores become error scores in [0, 1], 0.5 at the
+model's threshold: P(error) for a tagger, and for a language model a
+logistic of how far log p(character) falls below the threshold. With
+--combine vote a character is an error when at least --min_votes of the
+models that score it flag it. With --combine weight it is an error when
+the weighted mean of their error scores is above 0.5. The first character
+is judged by the taggers alone, the language models do not score it.
+
+The positions found are written to --out in the _ans format. Precision,
+recall and F1 against test_path_ans are printed when that file exists.
+With --sequential every model also runs alone, re-reading and re-encoding
+the file as separate runs do, to compare throughput.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# any model directory will do, they ship the same reader and freeze modules
+sys.path.insert(0, os.path.join(REPO, "RNNLM"))
+from my import freeze
+from my import reader
+
+
+def encode(test_path):
+  """(ids [sentences, 47], sequence_length) of the test file."""
+  reader.get_dict()
+  with open(test_path) as f:
+    lines = f.read().strip().split("\n")
+  data, sequence_length, oov = reader.encode_lines(lines)
+  if len(oov):
+    print("%d test characters not in cha_to_id.txt" % len(oov))
+  return data, sequence_length
+
+
+def score_all(models, data, sequence_length, batch_size, pad_id):
+  """Scores of every model, [models, sentences, 47], each model in a thread."""
+  scores = np.zeros((len(models),) + data.shape, dtype=np.float32)
+  errors = []
+
+  def run(index, model):
+    try:
+      for start in range(0, len(data), batch_size):
+        stop = start + batch_size
+        scores[index, start:stop] = model.score(
+            data[start:stop], sequence_length[start:stop], pad_id)
+    except Exception as e:
+      errors.append(e)
+      raise
+
+  threads = [threading.Thread(target=run, args=(i, model)) for i, model in enumerate(models)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+  return scores
+
+
+def combine(models, scores, sequence_length, how, weights, min_votes):
+  """Error flags [sentences, 47] from the scores of all models."""
+  num_steps = scores.shape[2]
+  valid = np.stack([m.valid(sequence_length, num_steps) for m in models])
+  error = np.stack([m.error_score(s) for m, s in zip(models, scores)])
+  if how == "vote":
+    votes = ((error > 0.5) & valid).sum(axis=0)
+    return votes >= np.minimum(min_votes, np.maximum(valid.sum(axis=0), 1))
+  weights = np.reshape(weights, [-1, 1, 1]) * valid
+  total = weights.sum(axis=0)
+  mean = (weights * error).sum(axis=0) / np.maximum(total, 1e-12)
+  return (mean > 0.5) & (total > 0)
+
+
+def positions(flags):
+  return [list(np.flatnonzero(row)) for row in flags]
+
+
+def write_ans(path, found):
+  with open(path, "w") as f:
+    for row in found:
+      f.write((" ".join(str(i) for i in row) if row else "-1") + "\n")
+
+
+def read_answers(test_path, num_steps):
+  """Error positions of the test sentences encode() keeps, None without _ans."""
+  if not os.path.exists(test_path + "_ans"):
+    return None
+  with open(test_path + "_ans") as f:
+    answers = [[int(i) for i in line.split() if int(i) >= 0]
+               for line in f.read().strip().split("\n")]
+  # encode_lines skips the lines it cannot hold
+  with open(test_path) as f:
+    kept = [len(line.split()) <= num_steps for line in f.read().strip().split("\n")]
+  return [a for a, k in zip(answers, kept) if k]
+
+
+def precision_recall(found, answers):
+  """Character-level (precision, recall, F1) against the _ans positions."""
+  tp = fp = fn = 0
+  for predicted, truth in zip(found, answers):
+    predicted, truth = set(predicted), set(truth)
+    tp += len(predicted & truth)
+    fp += len(predicted - truth)
+    fn += len(truth - predicted)
+  pre = tp / float(tp + fp) if tp + fp else 0.0
+  rec = tp / float(tp + fn) if tp + fn else 0.0
+  f1 = 2 * pre * rec / (pre + rec) if pre + rec else 0.0
+  return pre, rec, f1
+
+
+def report(name, found, answers):
+  print("%-28s precision %.3f recall %.3f F1 %.3f" % (
+      (name,) + precision_recall(found, answers)))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--models", required=True,
+                      help="Comma separated save paths holding frozen.pb and frozen.json.")
+  parser.add_argument("--test_path", default="./test/test_total")
+  parser.add_argument("--combine", default="weight", choices=["vote", "weight"])
+  parser.add_argument("--weights", default="", help="Weight per model, 1 each by default.")
+  parser.add_argument("--thresholds", default="",
+                      help="Threshold per model, empty entries keep the default of its kind.")
+  parser.add_argument("--min_votes", type=int, default=2)
+  parser.add_argument("--batch_size", type=int, default=256,
+                      help="Sentences per batch handed to every model.")
+  parser.add_argument("--threads", type=int, default=0,
+                      help="TensorFlow intra and inter op threads per session, 0 lets it choose.")
+  parser.add_argument("--out", default="", help="Write the positions found, _ans format.")
+  parser.add_argument("--sequential", action="store_true",
+                      help="Also time every model alone, as separate runs.")
+  args = parser.parse_args()
+
+  import tensorflow as tf
+  config = tf.ConfigProto(intra_op_parallelism_threads=args.threads,
+                          inter_op_parallelism_threads=args.threads)
+  paths = args.models.split(",")
+  thresholds = args.thresholds.split(",") if args.thresholds else [""] * len(paths)
+  weights = [float(w) for w in args.weights.split(",")] if args.weights else [1.0] * len(paths)
+  if len(thresholds) != len(paths) or len(weights) != len(paths):
+    sys.exit("--weights and --thresholds need one entry per model.")
+  models = [freeze.FrozenModel(path, float(t) if t else None, config)
+            for path, t in zip(paths, thresholds)]
+
+  start_time = time.time()
+  data, sequence_length = encode(args.test_path)
+  encode_time = time.time() - start_time
+  pad_id = len(reader.word_to_id)
+  # untimed, the first run of a graph sets it up
+  score_all(models, data[:1], sequence_length[:1], args.batch_size, pad_id)
+  start_time = time.time()
+  scores = score_all(models, data, sequence_length, args.batch_size, pad_id)
+  score_time = time.time() - start_time
+  flags = combine(models, scores, sequence_length, args.combine, weights, args.min_votes)
+  total = encode_time + score_time
+  found = positions(flags)
+  if args.out:
+    write_ans(args.out, found)
+
+  sentences = len(data)
+  print("%d sentences, encode %.2fs, %d models %.2fs, %.1f sentences/s" % (
+      sentences, encode_time, len(models), score_time, sentences / total))
+  if args.sequential:
+    sequential = 0.0
+    for model in models:
+      start_time = time.time()
+      alone_data, alone_length = encode(args.test_path)
+      model.score(alone_data, alone_length, pad_id)
+      seconds = time.time() - start_time
+      sequential += seconds
+      print("%-28s alone %.2fs, %.1f sentences/s" % (model.name, seconds, sentences / seconds))
+    print("sequential %.2fs, %.1f sentences/s; ensemble %.2fx faster" % (
+        sequential, sentences / sequential, sequential / total))
+
+  answers = read_answers(args.test_path, data.shape[1])
+  if answers is not None:
+    for model, score in zip(models, scores):
+      report(model.name, positions((model.error_score(score) > 0.5) &
+                                   model.valid(sequence_length, data.shape[1])), answers)
+    report("ensemble (%s)" % args.combine, found, answers)
+  for model in models:
+    model.close()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,91 @@
+"""Size, latency and F1 of frozen detectors, for choosing a distilled student.
+
+Train a student on the frozen BiRNNLM's scores, freeze it, then compare:
+
+$ python RNNLM/birnnlm.py --model freeze --save_path ./model/model_bi/
+$ python BILSTMCHA/bilstm.py --teacher_path ./model/model_bi/ --student_size 64 \
+    --save_path ./model_proba/student_64/
+$ python BILSTMCHA/bilstm.py --model freeze --student_size 64 --save_path ./model_proba/student_64/
+$ python ensemble/tradeoff.py --test_path ./test/test_total \
+    --models ./model/model_bi/,./model_proba/proba_total_bi/,./model_proba/student_64/
+
+Parameters are the elements of the frozen graph's constants. Latency is
+the median time of one batch of the graph's batch size, after warm-up;
+throughput is over the whole test file. F1 counts a character as an error
+where the model's error score is above 0.5, against test_path_ans.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+import ensemble
+from my import freeze
+
+
+def parameters(model):
+  total = 0
+  for op in model.graph.get_operations():
+    if op.type == "Const" and op.outputs[0].dtype.is_floating:
+      total += op.outputs[0].shape.num_elements() or 0
+  return total
+
+
+def batch_latency(model, data, sequence_length, pad_id, repeats):
+  """Median seconds of one full batch."""
+  rows = data[:model.batch_size]
+  lengths = sequence_length[:model.batch_size]
+  model.score(rows, lengths, pad_id)
+  seconds = []
+  for _ in range(repeats):
+    start_time = time.time()
+    model.score(rows, lengths, pad_id)
+    seconds.append(time.time() - start_time)
+  return float(np.median(seconds))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--models", required=True,
+                      help="Comma separated save paths holding frozen.pb and frozen.json.")
+  parser.add_argument("--test_path", default="./test/test_total")
+  parser.add_argument("--thresholds", default="",
+                      help="Threshold per model, empty entries keep the default of its kind.")
+  parser.add_argument("--repeats", type=int, default=20)
+  parser.add_argument("--threads", type=int, default=0,
+                      help="TensorFlow intra and inter op threads per session, 0 lets it choose.")
+  args = parser.parse_args()
+
+  import tensorflow as tf
+  config = tf.ConfigProto(intra_op_parallelism_threads=args.threads,
+                          inter_op_parallelism_threads=args.threads)
+  paths = args.models.split(",")
+  thresholds = args.thresholds.split(",") if args.thresholds else [""] * len(paths)
+  data, sequence_length = ensemble.encode(args.test_path)
+  pad_id = len(ensemble.reader.word_to_id)
+  answers = ensemble.read_answers(args.test_path, data.shape[1])
+
+  print("%-24s %-11s %10s %8s %6s %10s %12s %6s %6s %6s" % (
+      "model", "kind", "params", "pb MB", "batch", "ms/batch", "sentences/s",
+      "P", "R", "F1"))
+  for path, threshold in zip(paths, thresholds):
+    model = freeze.FrozenModel(path, float(threshold) if threshold else None, config)
+    latency = batch_latency(model, data, sequence_length, pad_id, args.repeats)
+    start_time = time.time()
+    scores = model.score(data, sequence_length, pad_id)
+    seconds = time.time() - start_time
+    quality = ("-", "-", "-")
+    if answers is not None:
+      flags = (model.error_score(scores) > 0.5) & model.valid(sequence_length, data.shape[1])
+      quality = tuple("%.3f" % v for v in
+                      ensemble.precision_recall(ensemble.positions(flags), answers))
+    print("%-24s %-11s %10d %8.1f %6d %10.2f %12.1f %6s %6s %6s" % (
+        (model.name, model.kind, parameters(model),
+         os.path.getsize(os.path.join(path, freeze.GRAPH_FILE)) / 1048576.0,
+         model.batch_size, 1000 * latency, len(data) / seconds) + quality))
+    model.close()
+
+
+if __name__ == "__main__":
+  main()